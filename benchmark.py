@@ -0,0 +1,76 @@
+from modules.mock import MockBehavior, MockServer
+import subprocess
+import argparse
+import json
+import sys
+import time
+
+def run_scenario(server: MockServer, backend: str, jobs: int, stream: bool, args) -> dict:
+    command = [sys.executable, "main.py", "--backend", backend, "--host", server.host, "--seed", str(args.seed), "--no-cache",
+               "--passes", str(args.passes), "--jobs", str(jobs)]
+    if not stream:
+        command.append("--no-stream")
+    if args.test_suite:
+        command.extend(["--test-suite", args.test_suite])
+
+    server.reset_stats()
+    start_time = time.time()
+    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    wall_time = time.time() - start_time
+
+    stats = dict(server.stats)
+    generations = stats["generations"]
+    active_time = stats["last_response"] - stats["first_request"] if stats["first_request"] else 0
+    result = {
+        "backend": backend,
+        "jobs": jobs,
+        "stream": stream,
+        "wall_time": wall_time,
+        "startup_time": stats["first_request"] - start_time if stats["first_request"] else wall_time,
+        "active_time": active_time,
+        "requests": stats["requests"],
+        "generations": generations,
+        "requests_per_second": generations / active_time if active_time > 0 else 0,
+        "server_time": stats["server_time"],
+    }
+    # With a single job the server time is spent serially, whatever is left is spent by the framework.
+    if jobs == 1 and generations:
+        result["overhead_per_request_ms"] = max(active_time - stats["server_time"], 0) / generations * 1000
+    return result
+
+def print_table(results: list[dict]):
+    print(f"{'Backend':<10} {'Jobs':>4} {'Stream':>6} {'Wall (s)':>9} {'Startup (s)':>11} {'Generations':>11} {'Req/s':>8} {'Overhead (ms/req)':>17}")
+    for result in results:
+        overhead = f"{result['overhead_per_request_ms']:.2f}" if "overhead_per_request_ms" in result else "-"
+        print(f"{result['backend']:<10} {result['jobs']:>4} {'yes' if result['stream'] else 'no':>6} {result['wall_time']:>9.2f} {result['startup_time']:>11.2f} {result['generations']:>11} {result['requests_per_second']:>8.1f} {overhead:>17}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Roleplay Test Framework - Benchmark against a mock inference server")
+    parser.add_argument("--backends", type=str, default="koboldcpp,llamacpp,ooba", help="comma separated backends to emulate (default: koboldcpp,llamacpp,ooba)")
+    parser.add_argument("--jobs", type=str, default="1", help="comma separated numbers of concurrent passes to run (default: 1)")
+    parser.add_argument("--passes", type=int, default=5, help="number of test passes (default: 5)")
+    parser.add_argument("--seed", type=int, default=1, help="rng seed of the runs (default: 1)")
+    parser.add_argument("--test-suite", type=str, help="run specific test suite")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds per generated token of the mock server (default: 0)")
+    parser.add_argument("--prompt-latency", type=float, default=0.0, help="seconds per prompt token of the mock server (default: 0)")
+    parser.add_argument("--busy-rate", type=float, default=0.0, help="probability of the mock server answering with 503 (default: 0)")
+    parser.add_argument("--port", type=int, default=0, help="port of the mock server (default: any free port)")
+    parser.add_argument("--output", type=str, help="save the results to this JSON file")
+    args = parser.parse_args()
+
+    server = MockServer(MockBehavior(args.token_latency, args.prompt_latency, args.busy_rate, seed=args.seed), port=args.port).start()
+
+    results = []
+    try:
+        for backend in args.backends.split(","):
+            for jobs in [int(jobs) for jobs in args.jobs.split(",")]:
+                for stream in [True, False]:
+                    results.append(run_scenario(server, backend, jobs, stream, args))
+    finally:
+        server.stop()
+
+    print_table(results)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
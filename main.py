@@ -1,93 +1,313 @@
 from typing import Callable
+from concurrent.futures import Executor, ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
 from tqdm import tqdm
 from colorama import Fore, init as colorama_init
-from modules.model import LanguageModel
-from modules.model.backends import KcppModel, LcppModel, LPY_PRESENT, OobaModel
-if LPY_PRESENT:
-    from modules.model.backends import LpyModel
+from modules.model import LanguageModel, BackendError, GenerationCache, Telemetry, Tokenizer, LlamaTokenizer, BackendTokenizer, backends
+from modules.model.backends import LPY_PRESENT
 from modules.prompt.styles import *
-from modules.log import Logger
-from modules.test import TestParams
+from modules.log import Logger, RunContext
+from modules.test import TestParams, StoppingRule, MajorityRule, SprtRule, RunStore, SuiteInfo, TestManifest, PromptProbe, order_by_prefix, SCORING_MODES
 from modules.test.csv_test import prepare_csv_test
+from modules.cluster import Coordinator, Worker
 import argparse
 import json
 import csv
-import glob
 import importlib
 import os
 import random
+import threading
 import time
 
-def load_csvs(folder: str) -> list[dict]:
-    script_paths = glob.glob(folder)
-    scripts = []
-
-    for script_path in script_paths:
-        script_name = os.path.splitext(os.path.basename(script_path))[0]
-        with open(script_path, "r") as file:
-            reader = csv.DictReader(file)
-            test = {}
-            test["canonical_name"] = script_name
-            test["name"] = ' '.join(word.capitalize() for word in script_name.split('_'))
-            settings_path = os.path.join("tests", f"{script_name}_settings.json")
-            if os.path.exists(settings_path):
-                with open(settings_path, "r") as file:
-                    test["settings"] = json.load(file)
-            else:
-                test["settings"] = {
-                    "card": "characters/Rin Tohsaka.json",
-                    "user": "Jin"
-                }
-            test["tests"] = [row for row in reader]
-            scripts.append(test)
-
-    return scripts
-
-def load_scripts(folder: str) -> list:
-    script_paths = glob.glob(folder)
-    scripts = []
-
-    for script_path in script_paths:
-        module = importlib.import_module(script_path[:-3].replace(os.sep, "."))
-        module.canonical_name = os.path.splitext(os.path.basename(script_path))[0]  # type: ignore
-        module.name = ' '.join(word.capitalize() for word in module.canonical_name.split('_'))  # type: ignore
-        scripts.append(module)
-
-    return scripts
+def load_csv(suite: SuiteInfo) -> dict:
+    with open(suite.path, "r") as file:
+        reader = csv.DictReader(file)
+        test = {}
+        test["canonical_name"] = suite.canonical_name
+        test["name"] = suite.name
+        test["folder"] = os.path.dirname(os.path.abspath(suite.path))
+        settings_path = os.path.join(test["folder"], f"{suite.canonical_name}_settings.json")
+        if os.path.exists(settings_path):
+            with open(settings_path, "r") as file:
+                test["settings"] = json.load(file)
+        else:
+            test["settings"] = {
+                "card": "characters/Rin Tohsaka.json",
+                "user": "Jin"
+            }
+        test["tests"] = [row for row in reader]
+    return test
+
+def load_script(suite: SuiteInfo):
+    module = importlib.import_module(suite.path[:-3].replace(os.sep, "."))
+    module.canonical_name = suite.canonical_name  # type: ignore
+    module.name = suite.name  # type: ignore
+    return module
+
+def load_suite(suite: SuiteInfo):
+    return load_csv(suite) if suite.path.endswith(".csv") else load_script(suite)
+
+def get_preparer(script) -> tuple[str, Callable[[TestParams], list[tuple[str, Callable]]]]:
+    if isinstance(script, dict):
+        return script["name"], lambda params, script=script: prepare_csv_test(params, script)
+    return script.name, getattr(script, "prepare_test")
+
+@dataclass
+class TestState:
+    description: str
+    test: Callable
+    suite: str = ""
+    cell: str = ""
+    submitted: int = 0
+    completed: int = 0
+    # A pass scored with the token probabilities counts as its score.
+    success_count: float = 0
+    decided: bool = False
+    start_time: float = 0.0
+    next_index: int = 0
+    # The (pass index, seed) of the passes an interrupted run didn't complete, run again first.
+    retry: list[tuple[int, int]] = field(default_factory=list)
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+
+def pass_seed(suite: str, test: str, pass_index: int) -> int:
+    # With a base seed, the seed of a pass only depends on the test and the pass index, so a test
+    # gets the same seeds whether it runs alone, in a full run, concurrently, on a worker or with
+    # another preset and format.
+    if LanguageModel.base_seed is None:
+        return random.randint(1, 0xFFFFFFFF)
+    return LanguageModel.derive_seed(LanguageModel.base_seed, suite, test, pass_index)
+
+def passed(result: bool | float) -> bool:
+    # A test scored with the token probabilities passes when the model gives the expected answer
+    # more often than not.
+    return result > 0.5 if isinstance(result, float) else bool(result)
+
+def run_pass(state: TestState, pass_index: int, seed: int) -> tuple[bool | float, float]:
+    LanguageModel.set_cancel_event(state.cancel_event)
+    LanguageModel.set_pass_seed(seed)
+    with RunContext.scope(suite=state.suite, test=state.description, pass_index=pass_index, **({"cell": state.cell} if state.cell else {})):
+        pass_start = time.time()
+        result = None
+        try:
+            result = state.test()
+            return result, time.time() - pass_start
+        finally:
+            LanguageModel.set_cancel_event(None)
+            LanguageModel.set_pass_seed(None)
+            Logger.record("pass", outcome="cancelled" if state.cancel_event.is_set() else "error" if result is None else "pass" if passed(result) else "fail", seed=seed, duration=time.time() - pass_start,
+                          **({"score": result} if isinstance(result, float) else {}))
+
+def log_decision(state: TestState, decision: bool, resumed: bool = False):
+    rate = f"success rate: {(state.success_count / state.completed) * 100 if state.completed else 0}%"
+    if resumed:
+        rate += ", resumed"
+    if decision:
+        Logger.log(f"\t[{Fore.GREEN}PASS{Fore.RESET}] {state.description} ({rate})")
+    else:
+        Logger.log(f"\t[{Fore.RED}FAIL{Fore.RESET}] {state.description} ({rate})")
 
-def run_tests(tests: list[tuple[str, Callable]], passes: int, specific_test: str | None) -> tuple[int, int, int]:
+def run_tests(tests: list[tuple[str, Callable]], rule: StoppingRule, specific_test: str | None, jobs: int = 1, suite: str = "", cell: str = "", results: dict | None = None, store: RunStore | None = None, executor: Executor | None = None, scored: bool = False) -> tuple[int, int, int]:
     failures = 0
     successes = 0
     skipped = 0
-    for description, test in tqdm(tests, bar_format="{l_bar}%s{bar}%s{r_bar}" % (Fore.GREEN, Fore.RESET), leave=False):
+
+    states = []
+    for description, test in tests:
         if specific_test is not None and specific_test.lower() != description.lower():
             Logger.log(f"\t[{Fore.WHITE}SKIP{Fore.RESET}] {description}")
+            Logger.record("test", suite=suite, test=description, outcome="skip")
             skipped += 1
             continue
-        Logger.log(f"Running test \"{description}\":", True)
-        success_count = 0
-        for progress in tqdm(range(passes), desc=f"Test \"{description}\"", bar_format="{l_bar}%s{bar}%s{r_bar}" % (Fore.GREEN, Fore.RESET), leave=False):
-            if test():
-                success_count += 1
-                if success_count >= passes // 2 + 1:
-                    Logger.log(f"\t[{Fore.GREEN}PASS{Fore.RESET}] {description} (success rate: {(success_count / (progress+1)) * 100}%)")
+        state = TestState(description, test, suite, cell)
+
+        if store is not None:
+            # Pick up where an interrupted run left the test.
+            record = store.load_test(cell, suite, description)
+            outcomes = [outcome for _, outcome in record.passes.values() if outcome is not None]
+            state.completed = state.submitted = len(outcomes)
+            state.success_count = sum(int(outcome) if outcome.is_integer() else outcome for outcome in outcomes)
+            state.retry = [(index, seed) for index, (seed, outcome) in record.passes.items() if outcome is None]
+            state.next_index = max(record.passes, default=-1) + 1
+            decision = record.decision
+            if decision is None and state.completed:
+                # The run may have stopped right before recording the decision.
+                decision = rule.decide(state.success_count, state.completed)
+            if decision is not None:
+                log_decision(state, decision, True)
+                Logger.record("test", suite=suite, test=description, outcome="pass" if decision else "fail",
+                              passes=state.completed, successes=state.success_count, resumed=True)
+                if decision:
                     successes += 1
+                else:
+                    failures += 1
+                if results is not None:
+                    results[(suite, description)] = (decision, state.success_count / state.completed if state.completed else 0)
+                continue
+        states.append(state)
+
+    tests_bar = tqdm(total=len(states), bar_format="{l_bar}%s{bar}%s{r_bar}" % (Fore.GREEN, Fore.RESET), leave=False)
+    passes_bar = tqdm(desc="Passes", bar_format="{desc}: {n_fmt} [{elapsed}, {rate_fmt}]", leave=False)
+    # The passes run in a local thread pool, unless they're handed to the workers of a coordinator.
+    pool = executor if executor is not None else ThreadPoolExecutor(max_workers=jobs)
+    in_flight: dict[Future, tuple[TestState, int]] = {}
+    try:
+        while True:
+            # Keep up to `jobs` passes in flight, favoring the earliest undecided tests. With a
+            # single job this runs the passes strictly one after another, like before.
+            while len(in_flight) < jobs:
+                # When the tests may be scored, the first pass of a test runs alone, as a scored
+                # test is decided by its first pass.
+                state = next((state for state in states if not state.decided and state.submitted < rule.max_passes and not (scored and state.submitted and not state.completed)), None)
+                if state is None:
                     break
+                if not state.start_time:
+                    Logger.log(f"Running test \"{state.description}\":", True)
+                    state.start_time = time.time()
+                if state.retry:
+                    pass_index, seed = state.retry.pop(0)
+                else:
+                    pass_index, seed = state.next_index, pass_seed(suite, state.description, state.next_index)
+                    state.next_index += 1
+                if store is not None:
+                    store.start_pass(cell, suite, state.description, pass_index, seed)
+                in_flight[pool.submit(run_pass, state, pass_index, seed)] = (state, pass_index)
+                state.submitted += 1
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                state, pass_index = in_flight.pop(future)
+                if state.decided:
+                    # The outcome was already decided while this pass was running.
+                    continue
+
+                result, duration = future.result()
+                state.completed += 1
+                passes_bar.update()
+                if isinstance(result, float):
+                    # The pass scored the test with the token probabilities, its score is the pass rate.
+                    state.success_count += result
+                    decision = passed(result)
+                else:
+                    if result:
+                        state.success_count += 1
+                    decision = rule.decide(state.success_count, state.completed)
+                if store is not None:
+                    # A scored pass keeps its score, so a resumed run shows the same pass rate.
+                    store.finish_pass(cell, suite, state.description, pass_index, result, duration, decision)
+                if decision is None:
+                    continue
+                log_decision(state, decision)
+                if decision:
+                    successes += 1
+                else:
+                    failures += 1
+                Logger.record("test", suite=suite, test=state.description, outcome="pass" if decision else "fail",
+                              passes=state.completed, successes=state.success_count, duration=time.time() - state.start_time)
+                if results is not None:
+                    results[(suite, state.description)] = (decision, state.success_count / state.completed)
+
+                # Cancel the remaining passes of the decided test.
+                state.decided = True
+                state.cancel_event.set()
+                tests_bar.update()
+    finally:
+        for state in states:
+            state.cancel_event.set()
+        if executor is None:
+            pool.shutdown(wait=True, cancel_futures=True)
         else:
-            Logger.log(f"\t[{Fore.RED}FAIL{Fore.RESET}] {description} (success rate: {(success_count / passes) * 100}%)")
-            failures += 1
+            for future in in_flight:
+                future.cancel()
+        passes_bar.close()
+        tests_bar.close()
     return failures, successes, skipped
 
+def run_suites(suites: list[SuiteInfo], scripts: dict, params: TestParams, rule: StoppingRule, args: argparse.Namespace, cell: str = "", results: dict | None = None, store: RunStore | None = None, coordinator: Coordinator | None = None) -> tuple[int, int, int, bool]:
+    tests_failed = 0
+    tests_passed = 0
+    tests_skipped = 0
+    for suite in suites:
+        script = scripts.get(suite.path)
+        if script is None:
+            # Filtered out before loading it.
+            Logger.log(f"Skipped test suite \"{suite.name}\".")
+            Logger.record("suite", suite=suite.name, outcome="skip", tests=len(suite.tests or []))
+            tests_skipped += len(suite.tests or [])
+            continue
+        suite_name, prepare = get_preparer(script)
+        tests = prepare(params)
+
+        if len(tests) == 0:
+            Logger.log(f"Skipped test suite \"{suite_name}\".")
+            Logger.record("suite", suite=suite_name, outcome="skip", tests=0)
+            continue
+
+        Logger.log(f"Running test suite \"{suite_name}\":")
+
+        if not args.keep_order:
+            tests = order_by_prefix(tests, prepare, params, args.test)
+
+        try:
+            # By default a coordinator keeps every slot of the connected workers busy.
+            jobs = args.jobs if args.jobs else coordinator.capacity() if coordinator is not None else 1
+            failures, successes, skipped = run_tests(tests, rule, args.test, max(jobs, 1), suite_name, cell, results, store, coordinator, args.scoring == "likelihood")
+        except KeyboardInterrupt:
+            return tests_failed, tests_passed, tests_skipped, True
+        except BackendError as e:
+            Logger.log_event("Error", Fore.RED, str(e))
+            return tests_failed, tests_passed, tests_skipped, True
+        tests_failed += failures
+        tests_passed += successes
+        tests_skipped += skipped
+    return tests_failed, tests_passed, tests_skipped, False
+
+def run_worker(worker: Worker, scripts: dict, params: TestParams):
+    tests = {}
+    for script in scripts.values():
+        suite_name, prepare = get_preparer(script)
+        for description, test in prepare(params):
+            tests[(suite_name, description)] = test
+
+    def run_item(message: dict, cancel_event: threading.Event) -> tuple[bool | float, float]:
+        state = TestState(message["test"], tests[(message["suite"], message["test"])], message["suite"], message["cell"], cancel_event=cancel_event)
+        return run_pass(state, message["pass_index"], message["seed"])
+
+    worker.connect()
+    worker.run(run_item)
+
+def log_matrix(cells: list[str], results: dict[str, dict]):
+    rows = list(dict.fromkeys(key for cell in cells for key in results[cell]))
+    width = max([len(cell) for cell in cells] + [9])
+    name_width = max([len(test) for _, test in rows] + [4])
+
+    Logger.log(f"\n{'Test':<{name_width}}  " + "  ".join(f"{cell:>{width}}" for cell in cells))
+    for suite, test in rows:
+        line = f"{test:<{name_width}}  "
+        for cell in cells:
+            outcome = results[cell].get((suite, test))
+            if outcome is None:
+                line += f"{'-':>{width}}  "
+            else:
+                text = f"{'PASS' if outcome[0] else 'FAIL'} {outcome[1] * 100:3.0f}%"
+                line += f"{Fore.GREEN if outcome[0] else Fore.RED}{text:>{width}}{Fore.RESET}  "
+        Logger.log(line.rstrip())
+    Logger.log(f"{'Passed':<{name_width}}  " + "  ".join(f"{sum(1 for outcome in results[cell].values() if outcome[0]):>{width}}" for cell in cells))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Roleplay Test Framework")
 
     parser.add_argument("--backend", type=str, choices={"koboldcpp", "llamacpp", "ooba", "llamapy"}, help="model backend type")
-    parser.add_argument("--preset", type=str, help="model preset (default: default)")
+    parser.add_argument("--preset", type=str, help="model preset, or comma separated presets to compare (default: default)")
     parser.add_argument("--context-size", type=int, help="model context size (default: 2048)")
-    parser.add_argument("--format", type=str, help="model prompt format (default: alpaca)")
+    parser.add_argument("--format", type=str, help="model prompt format, or comma separated formats to compare (default: alpaca)")
     if LPY_PRESENT:
         parser.add_argument("--model", type=str, help="model path for llama.py")
-    parser.add_argument("--host", type=str, help="host for the model backend")
+    parser.add_argument("--host", type=str, help="host for the model backend, or comma separated hosts serving the same model")
+    parser.add_argument("--tokenizer", type=str, help="sentencepiece model used to fit the prompts in the context size, \"backend\" to use the backend tokenizer or \"none\" to leave it to the backend (default: backend)")
+    parser.add_argument("--slots", type=int, help="number of llama.cpp server slots to pin the concurrent passes to (default: no pinning)")
 
     parser.add_argument("--auxiliary-backend", type=str, choices={"koboldcpp", "llamacpp", "ooba", "llamapy"}, help="auxiliary model backend type")
     parser.add_argument("--auxiliary-preset", type=str, help="auxiliary model preset (default: precise)")
@@ -95,22 +315,56 @@ if __name__ == "__main__":
     parser.add_argument("--auxiliary-format", type=str, help="auxiliary model prompt format (default: alpaca)")
     if LPY_PRESENT:
         parser.add_argument("--auxiliary-model", type=str, help="auxiliary model path for llama.py")
-    parser.add_argument("--auxiliary-host", type=str, help="host for the auxiliary model backend")
+    parser.add_argument("--auxiliary-host", type=str, help="host for the auxiliary model backend, or comma separated hosts serving the same model")
 
     parser.add_argument("--passes", type=int, help="number of test passes (default: 5)")
+    parser.add_argument("--confidence", type=float, help="stop the passes of a test once its outcome is settled with this confidence (sequential probability ratio test)")
+    parser.add_argument("--max-passes", type=int, help="maximum number of test passes when using --confidence (default: 20)")
+    parser.add_argument("--scoring", type=str, choices=SCORING_MODES, help="score the tests that check for a short answer by sampling passes, or with the token probabilities of the llama.cpp and llama.py backends in a single pass (default: sampling)")
+    parser.add_argument("--jobs", type=int, help="number of test passes that run concurrently against the backend (default: 1)")
     parser.add_argument("--seed", type=int, help="initial rng seed")
+    parser.add_argument("--cache", action=argparse.BooleanOptionalAction, help="reuse the generations of previous runs with the same model, preset, prompt and seed (default: enabled when --seed is used)")
+    parser.add_argument("--resume", type=str, help="resume an interrupted run, skipping the decided tests and replaying the seeds of the unfinished passes (run id, or \"last\")")
+    parser.add_argument("--no-stream", action="store_true", help="disable token streaming and resubmit the prompt for every chunk")
+    parser.add_argument("--http-pool-size", type=int, help="number of keep-alive connections per backend host (default: 10)")
+    parser.add_argument("--http-timeout", type=float, help="read timeout in seconds for backend requests (default: 600)")
+    parser.add_argument("--http-retries", type=int, help="number of attempts for backend requests that fail or find the server busy (default: 5)")
+
+    parser.add_argument("--coordinator", type=str, help="hand the test passes to the workers that connect to this address (host:port) instead of running them against a backend")
+    parser.add_argument("--worker", type=str, help="run the test passes handed out by the coordinator at this address (host:port) against the backend")
 
     parser.add_argument("--test-suite", type=str, help="run specific test suite")
     parser.add_argument("--test", type=str, help="run specific test")
+    parser.add_argument("--list-tests", action="store_true", help="list the test suites and their tests (filtered by --test-suite) without connecting to a backend")
+    parser.add_argument("--keep-order", action="store_true", help="run the tests in their declared order instead of grouping the tests that share a prompt prefix")
     #parser.add_argument("--skip-test-suite", type=str, help="skip specific test suite(s)", nargs="+")
     #parser.add_argument("--skip-test", type=str, help="skip specific test(s)", nargs="+")
 
     parser.add_argument("--verbose", action="store_true", help="enable verbose output")
+    parser.add_argument("--events-file", type=str, help="write the test, pass and seed events to this file as JSON lines")
+    parser.add_argument("--telemetry-file", type=str, help="save the generation timings per test, suite and run to this JSON file (default: next to the log file)")
     args = parser.parse_args()
 
     os.chdir(os.path.dirname(os.path.realpath(__file__)))
     colorama_init()
-    Logger.init()
+
+    # The suites are listed without importing them, so only the selected ones are loaded.
+    suites = TestManifest.load(["tests/*.csv", "tests/*.py", "tests/*/*.csv", "tests/*/*.py"])
+    if args.list_tests:
+        for suite in suites:
+            if not suite.matches(args.test_suite, None):
+                continue
+            print(f"{suite.name} ({suite.path})")
+            for test in suite.tests if suite.tests is not None else ["(the tests are only known once the suite is loaded)"]:
+                print(f"    {test}")
+        exit(0)
+
+    Logger.init(args.events_file)
+
+    selected_suites = [suite for suite in suites if suite.matches(args.test_suite, args.test)]
+    if not selected_suites:
+        Logger.log_event("Error", Fore.RED, "No test suite matches the given --test-suite and --test.")
+        exit(-1)
 
     if args.seed:
         random.seed(args.seed)
@@ -119,39 +373,111 @@ if __name__ == "__main__":
     if args.verbose:
         Logger.print_verbose = True
 
-    if args.backend == "llamapy":
+    if args.no_stream:
+        LanguageModel.use_streaming = False
+
+    if args.cache or (args.cache is None and args.seed):
+        LanguageModel.cache = GenerationCache("cache/generations.sqlite3")
+
+    if args.confidence is not None and not 0.5 < args.confidence < 1:
+        Logger.log_event("Error", Fore.RED, "The confidence must be between 0.5 and 1.")
+        exit(-1)
+
+    if args.coordinator and args.worker:
+        Logger.log_event("Error", Fore.RED, "A run can't be both the coordinator and a worker.")
+        exit(-1)
+    if (args.coordinator or args.worker) and ("," in (args.preset or "") or "," in (args.format or "")):
+        Logger.log_event("Error", Fore.RED, "Comparing presets and formats isn't supported by distributed runs.")
+        exit(-1)
+
+    # Every pass outcome is recorded as it completes, so the run can be resumed if it's interrupted.
+    # The workers only run the passes, the coordinator records them.
+    run_store_file = os.path.join(Logger.log_folder, "runs.sqlite3")
+    run_settings = {key: getattr(args, key) for key in ("backend", "preset", "context_size", "format", "passes", "confidence", "max_passes", "scoring", "seed", "test_suite", "test")}
+    run_store: RunStore | None = None
+    if args.worker:
+        pass
+    elif args.resume:
+        run_id = RunStore.last_run_id(run_store_file) if args.resume == "last" else args.resume
+        stored_settings = RunStore(run_store_file, run_id).load_settings() if run_id else None
+        if stored_settings is None:
+            Logger.log_event("Error", Fore.RED, f"There's no run \"{args.resume}\" to resume.")
+            exit(-1)
+        run_store = RunStore(run_store_file, run_id)  # type: ignore
+        for key, value in stored_settings.items():
+            if run_settings.get(key) != value:
+                Logger.log_event("Warning", Fore.YELLOW, f"The run was started with {key} = {value!r}, but is resumed with {run_settings.get(key)!r}.")
+        Logger.log(f"Resuming run {run_id}.")
+    else:
+        run_id = os.path.basename(Logger.log_file)[len("log_"):-len(".txt")]
+        run_store = RunStore(run_store_file, run_id)
+        run_store.save_settings(run_settings)
+        Logger.log(f"Run id: {run_id}", True)
+
+    if args.http_pool_size:
+        backends.HttpClient.pool_size = args.http_pool_size
+    if args.jobs:
+        backends.HttpClient.pool_size = max(backends.HttpClient.pool_size, args.jobs)
+    if args.http_timeout:
+        backends.HttpClient.read_timeout = args.http_timeout
+    if args.http_retries:
+        backends.HttpClient.max_retries = args.http_retries
+
+    if args.coordinator:
+        # The coordinator only needs the test lists and the prompts to order them, the workers generate.
+        model = PromptProbe(args.context_size if args.context_size else 2048)
+    elif args.backend == "llamapy":
         if not LPY_PRESENT:
             Logger.log_event("Error", Fore.RED, "Please install llama-cpp-python to use the llamapy backend (pip install llama-cpp-python).")
             exit(-1)
         if not args.model:
             Logger.log_event("Error", Fore.RED, "Specify the model path using the argument --model.")
             exit(-1)
-        model = LpyModel(args.model, args.context_size if args.context_size else 2048)  # type: ignore
+        model = backends.LpyModel(args.model, args.context_size if args.context_size else 2048)  # type: ignore
     elif args.backend == "llamacpp":
         if not args.host:
             Logger.log_event("Error", Fore.RED, "Specify the model backend host using the argument --host.")
             exit(-1)
-        model = LcppModel(args.host, args.context_size if args.context_size else 2048)
+        model = backends.LcppModel(args.host, args.context_size if args.context_size else 2048, slot_count=args.slots if args.slots else 0)
     elif args.backend == "koboldcpp":
         if not args.host:
             Logger.log_event("Error", Fore.RED, "Specify the model backend host using the argument --host.")
             exit(-1)
-        model = KcppModel(args.host, args.context_size if args.context_size else 2048)
+        model = backends.KcppModel(args.host, args.context_size if args.context_size else 2048)
     elif args.backend == "ooba":
         if not args.host:
             Logger.log_event("Error", Fore.RED, "Specify the model backend host using the argument --host.")
             exit(-1)
-        model = OobaModel(args.host, args.context_size if args.context_size else 2048)
+        model = backends.OobaModel(args.host, args.context_size if args.context_size else 2048)
     else:
         Logger.log_event("Error", Fore.RED, "Unknown model backend, currently supported: koboldcpp, llamacpp, ooba, llamapy.")
         exit(-1)
     model.wait()
-    model.load_preset(f"presets/{(args.preset if args.preset else 'default')}.json")
 
-    with open(f"formats/{(args.format if args.format else 'alpaca')}.json", "r") as file:
-        prompt_format = json.load(file)
+    # Every combination of the given presets and formats runs against the same loaded model.
+    presets = {}
+    for preset_name in (args.preset if args.preset else "default").split(","):
+        model.load_preset(f"presets/{preset_name}.json")
+        presets[preset_name] = model.presets
+
+    prompt_formats = {}
+    for format_name in (args.format if args.format else "alpaca").split(","):
+        with open(f"formats/{format_name}.json", "r") as file:
+            prompt_formats[format_name] = json.load(file)
+
+    cells = [(preset_name, format_name) for preset_name in presets for format_name in prompt_formats]
+
+    tokenizer: Tokenizer | None = None
+    if args.tokenizer and args.tokenizer not in ("backend", "none"):
+        tokenizer = LlamaTokenizer(args.tokenizer)
+    elif args.tokenizer != "none" and not args.coordinator:
+        tokenizer = BackendTokenizer(model)
+        try:
+            tokenizer.count_tokens("Hello world!")
+        except BackendError:
+            Logger.log_event("Warning", Fore.YELLOW, "The model backend can't count tokens, the prompts will be truncated by the backend if they don't fit in the context.")
+            tokenizer = None
 
-    prompt = RoleplayPrompt(prompt_format)
 
     auxiliary_model = None
     if args.auxiliary_backend == "llamapy":
@@ -161,29 +487,29 @@ if __name__ == "__main__":
         if not args.auxiliary_model:
             Logger.log_event("Error", Fore.RED, "Specify the auxiliary model path using the argument --auxiliary-model.")
             exit(-1)
-        auxiliary_model = LpyModel(args.auxiliary_model, args.auxiliary_context_size if args.auxiliary_context_size else 2048, True)  # type: ignore
+        auxiliary_model = backends.LpyModel(args.auxiliary_model, args.auxiliary_context_size if args.auxiliary_context_size else 2048, True)  # type: ignore
     elif args.auxiliary_backend == "llamacpp":
         if not args.auxiliary_host:
             Logger.log_event("Error", Fore.RED, "Specify the auxiliary model backend host using the argument --auxiliary-host.")
             exit(-1)
-        auxiliary_model = LcppModel(args.auxiliary_host, args.auxiliary_context_size if args.auxiliary_context_size else 2048, True)
+        auxiliary_model = backends.LcppModel(args.auxiliary_host, args.auxiliary_context_size if args.auxiliary_context_size else 2048, True)
     elif args.auxiliary_backend == "koboldcpp":
         if not args.auxiliary_host:
             Logger.log_event("Error", Fore.RED, "Specify the auxiliary model backend host using the argument --auxiliary-host.")
             exit(-1)
-        auxiliary_model = KcppModel(args.auxiliary_host, args.auxiliary_context_size if args.auxiliary_context_size else 2048, True)
+        auxiliary_model = backends.KcppModel(args.auxiliary_host, args.auxiliary_context_size if args.auxiliary_context_size else 2048, True)
     elif args.auxiliary_backend == "ooba":
         if not args.auxiliary_host:
             Logger.log_event("Error", Fore.RED, "Specify the auxiliary model backend host using the argument --auxiliary-host.")
             exit(-1)
-        auxiliary_model = OobaModel(args.auxiliary_host, args.auxiliary_context_size if args.auxiliary_context_size else 2048, True)
+        auxiliary_model = backends.OobaModel(args.auxiliary_host, args.auxiliary_context_size if args.auxiliary_context_size else 2048, True)
     elif not args.auxiliary_backend:
         Logger.log("Auxiliary model not specified, some tests will be skipped.")
     else:
         Logger.log_event("Error", Fore.RED, "Unknown auxiliary model backend, currently supported: koboldcpp, llamacpp, ooba, llamapy.")
         exit(-1)
 
-    auxiliary_prompt = None
+    auxiliary_prompt_format = None
     if auxiliary_model:
         auxiliary_model.wait()
         auxiliary_model.load_preset(f"presets/{(args.auxiliary_preset if args.auxiliary_preset else 'precise')}.json")
@@ -191,49 +517,52 @@ if __name__ == "__main__":
         with open(f"formats/{(args.auxiliary_format if args.auxiliary_format else 'alpaca')}.json", "r") as file:
             auxiliary_prompt_format = json.load(file)
 
-        auxiliary_prompt = InstructPrompt(auxiliary_prompt_format)
+    scripts = {suite.path: load_suite(suite) for suite in selected_suites}
 
-    scripts = []
-    scripts.extend(load_csvs("tests/*.csv"))
-    scripts.extend([script for script in load_scripts("tests/*.py") if hasattr(script, "prepare_test")])
-    scripts.extend(load_csvs("tests/*/*.csv"))
-    scripts.extend([script for script in load_scripts("tests/*/*.py") if hasattr(script, "prepare_test")])
+    Logger.log(f"Found {Fore.GREEN}{len(suites)}{Fore.RESET} test suites.")
 
-    Logger.log(f"Found {Fore.GREEN}{len(scripts)}{Fore.RESET} test suites.")
+    if args.worker:
+        preset_name, format_name = cells[0]
+        model.presets = presets[preset_name]
+        run_worker(Worker(args.worker, args.jobs if args.jobs else 1), scripts, TestParams(model, prompt_formats[format_name], auxiliary_model, auxiliary_prompt_format, tokenizer, args.scoring or "sampling"))
+        Telemetry.log_summary()
+        exit(0)
+
+    coordinator = None
+    if args.coordinator:
+        coordinator = Coordinator(args.coordinator)
+        Logger.log(f"Waiting for workers to connect to {coordinator.address}...")
+        coordinator.wait_for_workers()
 
     start_time = time.time()
 
+    if args.confidence:
+        stopping_rule = SprtRule(args.confidence, args.max_passes if args.max_passes else 20)
+    else:
+        stopping_rule = MajorityRule(args.passes if args.passes else 5)
+
     tests_failed = 0
     tests_passed = 0
     tests_skipped = 0
-    for script in scripts:
-        os.chdir("tests")
-        try:
-            if isinstance(script, dict):
-                suite_canonical_name = script["canonical_name"]
-                suite_name = script["name"]
-                tests = prepare_csv_test(model, prompt, script)
-            else:
-                suite_canonical_name = script.canonical_name
-                suite_name = script.name
-                tests = getattr(script, "prepare_test")(TestParams(model, prompt, auxiliary_model, auxiliary_prompt))
-
-            if len(tests) == 0 or args.test_suite and (suite_name.lower() != args.test_suite.lower() and suite_canonical_name.lower() != args.test_suite.lower()):
-                Logger.log(f"Skipped test suite \"{suite_name}\".")
-                tests_skipped += len(tests)
-                continue
-
-            Logger.log(f"Running test suite \"{suite_name}\":")
-
-            try:
-                failures, successes, skipped = run_tests(tests, args.passes if args.passes else 5, args.test)
-            except KeyboardInterrupt:
-                break
-            tests_failed += failures
-            tests_passed += successes
-            tests_skipped += skipped
-        finally:
-            os.chdir("..")
+    matrix_results: dict[str, dict] = {}
+    interrupted = False
+    for preset_name, format_name in cells:
+        cell = f"{preset_name}/{format_name}" if len(cells) > 1 else ""
+        if cell:
+            Logger.log(f"Running preset \"{preset_name}\" with format \"{format_name}\":")
+        model.presets = presets[preset_name]
+        test_params = TestParams(model, prompt_formats[format_name], auxiliary_model, auxiliary_prompt_format, tokenizer, args.scoring or "sampling")
+
+        matrix_results[cell] = {}
+        failures, successes, skipped, interrupted = run_suites(suites, scripts, test_params, stopping_rule, args, cell, matrix_results[cell], run_store, coordinator)
+        tests_failed += failures
+        tests_passed += successes
+        tests_skipped += skipped
+        if interrupted:
+            break
+
+    if coordinator is not None:
+        coordinator.shutdown()
 
     Logger.log(f"\nCompleted {tests_failed + tests_passed + tests_skipped} tests in {int(time.time() - start_time)} seconds.")
 
@@ -253,3 +582,14 @@ if __name__ == "__main__":
 
     Logger.log(report_str)
 
+    if interrupted:
+        Logger.log(f"The run was interrupted, continue it with --resume {run_id}")
+
+    if len(cells) > 1:
+        log_matrix([cell for cell in matrix_results], matrix_results)
+
+    Telemetry.log_summary()
+    telemetry_file = args.telemetry_file or os.path.join(Logger.log_folder, os.path.basename(Logger.log_file).replace("log_", "telemetry_", 1).replace(".txt", ".json"))
+    Telemetry.save(telemetry_file)
+    Logger.record("run", failed=tests_failed, passed=tests_passed, skipped=tests_skipped, duration=time.time() - start_time)
+
@@ -0,0 +1,3 @@
+from .protocol import Connection, parse_address
+from .coordinator import Coordinator
+from .worker import Worker
\ No newline at end of file
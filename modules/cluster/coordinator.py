@@ -0,0 +1,245 @@
+from concurrent.futures import Executor, Future
+from dataclasses import dataclass, field
+from collections import deque
+from colorama import Fore
+from modules.log import Logger
+from modules.model import BackendError
+from .protocol import Connection, parse_address
+import socketserver
+import threading
+import time
+
+__all__ = ("Coordinator",)
+
+
+@dataclass
+class WorkItem:
+    id: int
+    message: dict
+    future: Future
+    cancel_event: threading.Event
+    started: bool = False
+    cancel_sent: bool = False
+
+
+@dataclass(eq=False)
+class RemoteWorker:
+    name: str
+    slots: int
+    connection: Connection
+    assigned: dict[int, WorkItem] = field(default_factory=dict)
+
+
+class _WorkerHandler(socketserver.BaseRequestHandler):
+    server: '_CoordinatorServer'
+
+    def handle(self):
+        self.server.coordinator.serve_worker(Connection(self.request), f"{self.client_address[0]}:{self.client_address[1]}")
+
+
+class _CoordinatorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: tuple[str, int], coordinator: 'Coordinator'):
+        super().__init__(address, _WorkerHandler)
+        self.coordinator = coordinator
+
+
+class Coordinator(Executor):
+    """
+    Hands the test passes submitted by `run_tests` to the workers connected over the network, as
+    if they ran in a local thread pool. Every worker runs the passes against its own backend and
+    sends their outcomes back, and the passes of a worker that drops are queued again. A pass
+    that fails on a worker fails its future, like it would in a local thread pool.
+    """
+    poll_interval = 0.1
+    # How long the queued passes wait for a worker to connect once every worker is gone.
+    worker_timeout = 60.0
+
+    def __init__(self, address: str):
+        self.lock = threading.Condition()
+        self.queue: deque[WorkItem] = deque()
+        self.workers: list[RemoteWorker] = []
+        self.next_id = 0
+        self.closed = False
+        # When the last worker left, None while there are workers.
+        self.workers_gone_since: float | None = None
+        self.server = _CoordinatorServer(parse_address(address), self)
+        self._server_thread = threading.Thread(target=self.server.serve_forever, name="Coordinator", daemon=True)
+        self._server_thread.start()
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="Dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    @property
+    def address(self) -> str:
+        return f"{self.server.server_address[0]}:{self.server.server_address[1]}"
+
+    def capacity(self) -> int:
+        with self.lock:
+            return sum(worker.slots for worker in self.workers)
+
+    def wait_for_workers(self, count: int = 1):
+        with self.lock:
+            while len(self.workers) < count:
+                self.lock.wait()
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        # Called like `executor.submit(run_pass, state, pass_index, seed)`. `fn` runs on the
+        # workers, so only the test and the pass are sent to them.
+        state, pass_index, seed = args
+        future: Future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("The coordinator was shut down.")
+            message = {"type": "run", "id": self.next_id, "suite": state.suite, "test": state.description, "cell": state.cell, "pass_index": pass_index, "seed": seed}
+            self.queue.append(WorkItem(self.next_id, message, future, state.cancel_event))
+            self.next_id += 1
+            self.lock.notify_all()
+        return future
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            workers = list(self.workers)
+            for item in self.queue:
+                item.future.cancel()
+            self.queue.clear()
+            self.lock.notify_all()
+        for worker in workers:
+            try:
+                worker.connection.send({"type": "done"})
+            except OSError:
+                pass
+            worker.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+        if wait:
+            self._dispatcher.join()
+
+    def serve_worker(self, connection: Connection, address: str):
+        hello = connection.receive()
+        if hello is None or hello.get("type") != "hello":
+            connection.close()
+            return
+        worker = RemoteWorker(hello.get("name") or address, max(int(hello.get("slots", 1)), 1), connection)
+        with self.lock:
+            if self.closed:
+                connection.close()
+                return
+            self.workers.append(worker)
+            self.workers_gone_since = None
+            self.lock.notify_all()
+        Logger.log(f"Worker {worker.name} connected with {worker.slots} slots.")
+
+        try:
+            while (message := connection.receive()) is not None:
+                if message.get("type") == "result":
+                    with self.lock:
+                        item = worker.assigned.pop(message["id"], None)
+                        self.lock.notify_all()
+                    if item is not None:
+                        item.future.set_result((message["outcome"], message["duration"]))
+                elif message.get("type") == "error":
+                    with self.lock:
+                        item = worker.assigned.pop(message["id"], None)
+                        self.lock.notify_all()
+                    if item is None:
+                        continue
+                    # The pass would fail the same way on any worker, so it isn't queued again.
+                    Logger.log_event("Warning", Fore.YELLOW, f"Worker {worker.name} failed a pass: {message.get('message')}")
+                    if message.get("backend"):
+                        item.future.set_exception(BackendError(f"Worker {worker.name}: {message.get('message')}"))
+                    else:
+                        item.future.set_exception(RuntimeError(f"Worker {worker.name} failed the pass {item.message['pass_index']} of \"{item.message['test']}\": {message.get('message')}"))
+        finally:
+            self._drop_worker(worker)
+
+    def _drop_worker(self, worker: RemoteWorker):
+        with self.lock:
+            if worker not in self.workers:
+                return
+            self.workers.remove(worker)
+            # Queue the passes of the worker again, ahead of the passes that weren't started yet.
+            requeued = list(worker.assigned.values())
+            for item in reversed(requeued):
+                item.cancel_sent = False
+                self.queue.appendleft(item)
+            worker.assigned.clear()
+            if not self.workers:
+                self.workers_gone_since = time.monotonic()
+            closed = self.closed
+            self.lock.notify_all()
+        worker.connection.close()
+        if not closed:
+            Logger.log(f"Worker {worker.name} disconnected, {len(requeued)} passes were queued again.")
+
+    @staticmethod
+    def _finish(item: WorkItem):
+        # The test was already decided, `run_tests` ignores the outcome.
+        if item.started or item.future.set_running_or_notify_cancel():
+            item.future.set_result((False, 0.0))
+
+    def _dispatch_loop(self):
+        with self.lock:
+            while not self.closed:
+                self._dispatch()
+                self._send_cancels()
+                self._expire_queue()
+                self.lock.wait(self.poll_interval)
+
+    def _expire_queue(self):
+        # Must be called while holding the lock. Without workers the queued passes would wait
+        # forever, fail them once no worker came back in time.
+        if self.workers or self.workers_gone_since is None or not self.queue:
+            return
+        if time.monotonic() - self.workers_gone_since < self.worker_timeout:
+            return
+        Logger.log_event("Error", Fore.RED, f"No worker connected for {self.worker_timeout:.0f} seconds, the queued passes failed.")
+        while self.queue:
+            item = self.queue.popleft()
+            if item.started or item.future.set_running_or_notify_cancel():
+                item.future.set_exception(BackendError("No workers are connected to the coordinator."))
+
+    def _dispatch(self):
+        # Must be called while holding the lock.
+        while self.queue:
+            item = self.queue[0]
+            if item.future.cancelled():
+                self.queue.popleft()
+                continue
+            if item.cancel_event.is_set():
+                self.queue.popleft()
+                self._finish(item)
+                continue
+
+            # The least loaded worker that has a free slot.
+            available = [worker for worker in self.workers if len(worker.assigned) < worker.slots]
+            if not available:
+                return
+            worker = min(available, key=lambda worker: len(worker.assigned) / worker.slots)
+            self.queue.popleft()
+            if not item.started:
+                if not item.future.set_running_or_notify_cancel():
+                    continue
+                item.started = True
+            worker.assigned[item.id] = item
+            try:
+                worker.connection.send(item.message)
+            except OSError:
+                # The connection handler drops the worker and queues its passes again.
+                worker.connection.close()
+
+    def _send_cancels(self):
+        # Must be called while holding the lock.
+        for worker in self.workers:
+            for item in worker.assigned.values():
+                if item.cancel_event.is_set() and not item.cancel_sent:
+                    item.cancel_sent = True
+                    try:
+                        worker.connection.send({"type": "cancel", "id": item.id})
+                    except OSError:
+                        worker.connection.close()
+                        break
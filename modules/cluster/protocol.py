@@ -0,0 +1,46 @@
+import threading
+import socket
+import json
+
+__all__ = ("Connection", "parse_address",)
+
+
+def parse_address(address: str, default_port: int = 5555) -> tuple[str, int]:
+    # "host:port", or just the host. An empty host listens on every interface.
+    host, separator, port = address.rpartition(":")
+    if not separator:
+        return address, default_port
+    return host, int(port)
+
+
+class Connection:
+    """
+    One JSON message per line over a TCP socket. The messages can be sent from any thread.
+    """
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = sock.makefile("r", encoding='utf-8', newline="\n")
+        self.send_lock = threading.Lock()
+
+    def send(self, message: dict):
+        data = (json.dumps(message) + "\n").encode("utf-8")
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def receive(self) -> dict | None:
+        # Returns None once the other side closed the connection.
+        try:
+            line = self.reader.readline()
+        except (OSError, ValueError):
+            return None
+        if not line:
+            return None
+        return json.loads(line)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
@@ -0,0 +1,89 @@
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from colorama import Fore
+from modules.log import Logger
+from modules.model import BackendError
+from .protocol import Connection, parse_address
+import threading
+import socket
+import time
+import os
+
+__all__ = ("Worker",)
+
+
+class Worker:
+    """
+    Runs the test passes handed out by a coordinator against the local backend, and sends their
+    outcomes back.
+    """
+    retry_delay = 2.0
+
+    def __init__(self, address: str, slots: int, name: str | None = None):
+        self.address = parse_address(address)
+        self.slots = slots
+        self.name = name or f"{socket.gethostname()}/{os.getpid()}"
+        self.connection: Connection | None = None
+
+    def connect(self):
+        # The coordinator may not be listening yet, keep trying until it is.
+        wait_started = False
+        while True:
+            try:
+                self.connection = Connection(socket.create_connection(self.address))
+                break
+            except OSError as e:
+                if not wait_started:
+                    Logger.log(f"Waiting for the coordinator at {self.address[0]}:{self.address[1]}...")
+                    Logger.log(str(e), True)
+                    wait_started = True
+                time.sleep(self.retry_delay)
+        self.connection.send({"type": "hello", "name": self.name, "slots": self.slots})
+        Logger.log(f"Connected to the coordinator at {self.address[0]}:{self.address[1]}.")
+
+    def run(self, run_pass: Callable[[dict, threading.Event], tuple[bool | float, float]]):
+        """
+        Runs the passes until the coordinator is done. `run_pass` gets the pass message (suite,
+        test, cell, pass index and seed) and its cancellation event, and returns the outcome (or the
+        score) and the duration of the pass.
+        """
+        assert(self.connection is not None)
+        connection = self.connection
+        cancel_events: dict[int, threading.Event] = {}
+        executor = ThreadPoolExecutor(max_workers=self.slots)
+        try:
+            while (message := connection.receive()) is not None:
+                if message["type"] == "run":
+                    cancel_events[message["id"]] = threading.Event()
+                    executor.submit(self._run_item, run_pass, message, cancel_events)
+                elif message["type"] == "cancel":
+                    if (event := cancel_events.get(message["id"])) is not None:
+                        event.set()
+                elif message["type"] == "done":
+                    Logger.log("The coordinator finished the run.")
+                    break
+            else:
+                Logger.log_event("Warning", Fore.YELLOW, "The coordinator closed the connection.")
+        finally:
+            for event in list(cancel_events.values()):
+                event.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+            connection.close()
+
+    def _run_item(self, run_pass: Callable[[dict, threading.Event], tuple[bool | float, float]], message: dict, cancel_events: dict[int, threading.Event]):
+        assert(self.connection is not None)
+        try:
+            outcome, duration = run_pass(message, cancel_events[message["id"]])
+            reply = {"type": "result", "id": message["id"], "outcome": outcome if isinstance(outcome, float) else bool(outcome), "duration": duration}
+        except BackendError as e:
+            Logger.log_event("Error", Fore.RED, str(e))
+            reply = {"type": "error", "id": message["id"], "message": str(e), "backend": True}
+        except Exception as e:
+            Logger.log_event("Error", Fore.RED, f"The pass {message['pass_index']} of \"{message['test']}\" failed: {e!r}")
+            reply = {"type": "error", "id": message["id"], "message": repr(e)}
+        finally:
+            cancel_events.pop(message["id"], None)
+        try:
+            self.connection.send(reply)
+        except OSError:
+            pass
@@ -1 +1,2 @@
+from .context import RunContext
 from .logger import Logger
\ No newline at end of file
@@ -0,0 +1,28 @@
+from typing import Any, Iterator
+from contextlib import contextmanager
+import threading
+
+__all__ = ("RunContext",)
+
+
+class RunContext:
+    # What the current thread is running (suite, test, pass...), used to tag the logged events.
+    _state = threading.local()
+
+    @classmethod
+    def get(cls) -> dict[str, Any]:
+        return dict(getattr(cls._state, "fields", {}))
+
+    @classmethod
+    def update(cls, **fields):
+        cls._state.fields = {**getattr(cls._state, "fields", {}), **fields}
+
+    @classmethod
+    @contextmanager
+    def scope(cls, **fields) -> Iterator[None]:
+        previous = getattr(cls._state, "fields", {})
+        cls._state.fields = {**previous, **fields}
+        try:
+            yield
+        finally:
+            cls._state.fields = previous
\ No newline at end of file
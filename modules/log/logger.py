@@ -1,54 +1,124 @@
 import os
 import datetime
+import threading
+import atexit
+import signal
+import queue
+import json
+import time
 import re
 from tqdm import tqdm  # type: ignore
 from colorama import Fore
+from .context import RunContext
 
 __all__ = ("Logger",)
 
+ANSI_ESCAPE_PATTERN = re.compile(r"\x1b\[\d+m")
+
 
 class Logger:
     log_folder = str()
     log_file = str()
+    events_file = str()
     print_verbose = False
+    # Seconds after which the buffered lines are written to disk even if the log is still busy.
+    flush_interval = 1.0
+
+    _queue: "queue.SimpleQueue[tuple[str, float, object] | None]" = queue.SimpleQueue()
+    _writer: threading.Thread | None = None
+    _files: dict = {}
 
     @classmethod
-    def init(cls):
+    def init(cls, events_file: str | None = None):
         cls.log_folder = "logs"
         if not os.path.exists(cls.log_folder):
             os.makedirs(cls.log_folder)
         now = datetime.datetime.now()
         timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
-        cls.log_file = os.path.abspath(os.path.join(cls.log_folder, f"log_{timestamp}.txt"))
+        cls.events_file = os.path.abspath(events_file) if events_file else str()
+
+        # The files are only touched by the writer thread, so the callers never wait for the disk.
+        cls._files = {"log": cls._create_log_file(timestamp)}
+        if cls.events_file:
+            cls._files["events"] = open(cls.events_file, "a", encoding='utf-8', buffering=1 << 16)
+        cls._writer = threading.Thread(target=cls._write_loop, name="Logger", daemon=True)
+        cls._writer.start()
+
+        atexit.register(cls.close)
+        if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, cls._handle_signal)
 
     @classmethod
-    def log(cls, message: str, verbose: bool = False):
-        now = datetime.datetime.now()
-        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+    def _create_log_file(cls, timestamp: str):
+        # Runs started in the same second (e.g. by the test runner) must not share a log file.
+        suffix = str()
+        for attempt in range(2, 1000):
+            cls.log_file = os.path.abspath(os.path.join(cls.log_folder, f"log_{timestamp}{suffix}.txt"))
+            try:
+                return open(cls.log_file, "x", encoding='utf-8', buffering=1 << 16)
+            except FileExistsError:
+                suffix = f"_{attempt}"
+        return open(cls.log_file, "a", encoding='utf-8', buffering=1 << 16)
 
-        if cls.print_verbose or not verbose:
-            if cls.print_verbose and verbose:
-                message = f"{Fore.MAGENTA}{message.replace(Fore.RESET, Fore.RESET + Fore.MAGENTA)}{Fore.RESET}"
-            tqdm.write(message)
+    @classmethod
+    def close(cls):
+        if cls._writer is None:
+            return
+        writer, cls._writer = cls._writer, None
+        cls._queue.put(None)
+        writer.join()
+        for file in cls._files.values():
+            file.close()
+        cls._files = {}
 
-        if cls.log_file:
-            message = re.sub(r"\x1b\[\d+m", "", message)
-            with open(cls.log_file, "a", encoding='utf-8') as file:
-                file.write(f"[{timestamp}] {message}\n")
+    @classmethod
+    def _handle_signal(cls, signum, frame):
+        cls.close()
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
 
     @classmethod
-    def log_event(cls, event: str, color: str, message: str, verbose: bool = False):
-        now = datetime.datetime.now()
-        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+    def _write_loop(cls):
+        while True:
+            try:
+                item = cls._queue.get(timeout=cls.flush_interval)
+            except queue.Empty:
+                for file in cls._files.values():
+                    file.flush()
+                continue
+            if item is None:
+                break
 
-        message = f"{color}{event}{Fore.RESET}: {message}"
+            kind, created, payload = item
+            if kind == "log":
+                timestamp = datetime.datetime.fromtimestamp(created).strftime("%Y-%m-%d %H:%M:%S")
+                message = ANSI_ESCAPE_PATTERN.sub("", payload)  # type: ignore
+                cls._files["log"].write(f"[{timestamp}] {message}\n")
+            else:
+                cls._files["events"].write(json.dumps(payload, ensure_ascii=False) + "\n")
 
+    @classmethod
+    def _print(cls, message: str, verbose: bool):
         if cls.print_verbose or not verbose:
             if cls.print_verbose and verbose:
                 message = f"{Fore.MAGENTA}{message.replace(Fore.RESET, Fore.RESET + Fore.MAGENTA)}{Fore.RESET}"
             tqdm.write(message)
 
-        if cls.log_file:
-            message = re.sub(r"\x1b\[\d+m", "", message)
-            with open(cls.log_file, "a", encoding='utf-8') as file:
-                file.write(f"[{timestamp}] {message}\n")
+        if cls._writer is not None:
+            cls._queue.put(("log", time.time(), message))
+
+    @classmethod
+    def log(cls, message: str, verbose: bool = False):
+        cls._print(message, verbose)
+
+    @classmethod
+    def log_event(cls, event: str, color: str, message: str, verbose: bool = False):
+        cls._print(f"{color}{event}{Fore.RESET}: {message}", verbose)
+
+    @classmethod
+    def record(cls, event: str, **fields):
+        # Machine-readable events, tagged with the suite, test and pass the calling thread is running.
+        if cls._writer is None or not cls.events_file:
+            return
+        created = time.time()
+        cls._queue.put(("event", created, {"time": created, "event": event, **RunContext.get(), **fields}))
\ No newline at end of file
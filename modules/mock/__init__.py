@@ -0,0 +1 @@
+from .server import MockBehavior, MockServer
\ No newline at end of file
@@ -0,0 +1,27 @@
+from .server import MockBehavior, MockServer
+import argparse
+import json
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock inference server emulating the koboldcpp, llama.cpp and ooba APIs")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=5000, help="port to listen on (default: 5000)")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds per generated token (default: 0)")
+    parser.add_argument("--prompt-latency", type=float, default=0.0, help="seconds per processed prompt token (default: 0)")
+    parser.add_argument("--busy-rate", type=float, default=0.0, help="probability of answering a generation with 503 (default: 0)")
+    parser.add_argument("--script", type=str, help="JSON file with a list of outputs to return in order")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random outputs (default: 0)")
+    args = parser.parse_args()
+
+    script = []
+    if args.script:
+        with open(args.script, "r", encoding='utf-8') as file:
+            script = json.load(file)
+
+    server = MockServer(MockBehavior(args.token_latency, args.prompt_latency, args.busy_rate, script, args.seed), args.host, args.port)
+    print(f"Mock server listening on {server.host} (ooba streams on {server.stream_host}).")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
\ No newline at end of file
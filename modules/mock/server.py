@@ -0,0 +1,344 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from dataclasses import dataclass, field
+import threading
+import hashlib
+import base64
+import struct
+import random
+import json
+import time
+import re
+
+__all__ = ("MockBehavior", "MockServer")
+
+TOKEN_PATTERN = re.compile(r"\s*\S+|\s+")
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+DEFAULT_VOCABULARY = (
+    "I", "you", "she", "the", "a", "and", "but", "with", "her", "his", "my", "room", "tea", "school", "magic",
+    "smiles", "looks", "says", "walks", "away", "softly", "again", "today", "really", "is", "was", "old", "blue",
+    "eyes", "hair", "years", "\"Hello.\"", "\"Fine.\"", "*sighs*", "*nods*", "yes", "no", "18", "Jin", "."
+)
+
+
+@dataclass
+class MockBehavior:
+    # Seconds the server spends per generated token and per prompt token.
+    token_latency: float = 0.0
+    prompt_latency: float = 0.0
+    # Probability of answering a generation request with 503 (server busy).
+    busy_rate: float = 0.0
+    # Outputs returned in order, one per generation request. When empty the outputs are random words
+    # derived from the seed, the sampler seed and the prompt, so seeded requests are reproducible.
+    script: list[str] = field(default_factory=list)
+    seed: int = 0
+    vocabulary: tuple[str, ...] = DEFAULT_VOCABULARY
+    model_name: str = "mock-model"
+
+
+def count_tokens(text: str) -> int:
+    return len(TOKEN_PATTERN.findall(text))
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    A stand-in for the koboldcpp, llama.cpp and ooba servers that answers with fake generations,
+    used to measure the overhead of the framework without running a model. Like ooba, it also
+    listens five ports above the given one for the websocket streams.
+    """
+    daemon_threads = True
+
+    def __init__(self, behavior: MockBehavior, host: str = "127.0.0.1", port: int = 5000):
+        for attempt in range(20):
+            super().__init__((host, port), MockRequestHandler)
+            try:
+                self.stream_server = MockStreamServer(self, host, self.server_address[1] + 5)
+                break
+            except OSError:
+                # With any free port, try another one until the port of the streams is free too.
+                self.socket.close()
+                if port != 0 or attempt == 19:
+                    raise
+        self.behavior = behavior
+        self.lock = threading.Lock()
+        self.script_index = 0
+        self.busy_rng = random.Random(behavior.seed)
+        # The last prompt of every slot, to emulate the prompt cache of llama.cpp.
+        self.slot_prompts: dict[int, str] = {}
+        self.stats = {"requests": 0, "generations": 0, "busy": 0, "tokens": 0, "prompt_tokens": 0, "server_time": 0.0, "first_request": 0.0, "last_response": 0.0}
+        self._thread: threading.Thread | None = None
+
+    @property
+    def host(self) -> str:
+        return f"{self.server_address[0]}:{self.server_address[1]}"
+
+    @property
+    def stream_host(self) -> str:
+        return f"{self.stream_server.server_address[0]}:{self.stream_server.server_address[1]}"
+
+    def start(self) -> 'MockServer':
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self, poll_interval: float = 0.5):
+        threading.Thread(target=self.stream_server.serve_forever, args=(poll_interval,), daemon=True).start()
+        super().serve_forever(poll_interval)
+
+    def shutdown(self):
+        self.stream_server.shutdown()
+        super().shutdown()
+
+    def server_close(self):
+        self.stream_server.server_close()
+        super().server_close()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def reset_stats(self):
+        with self.lock:
+            for key in self.stats:
+                self.stats[key] = 0
+
+    def record(self, **values):
+        with self.lock:
+            for key, value in values.items():
+                self.stats[key] += value
+            now = time.time()
+            if not self.stats["first_request"]:
+                self.stats["first_request"] = now
+            self.stats["last_response"] = now
+
+    def is_busy(self) -> bool:
+        with self.lock:
+            return self.behavior.busy_rate > 0 and self.busy_rng.random() < self.behavior.busy_rate
+
+    def next_output(self, prompt: str, sampler_seed: int | None, max_tokens: int) -> str:
+        if self.behavior.script:
+            with self.lock:
+                output = self.behavior.script[self.script_index % len(self.behavior.script)]
+                self.script_index += 1
+            return output
+        digest = hashlib.sha256(f"{self.behavior.seed}:{sampler_seed}:{prompt}".encode()).digest()
+        rng = random.Random(digest)
+        return "".join(f" {rng.choice(self.behavior.vocabulary)}" for _ in range(max_tokens))
+
+    def next_token_probs(self, prompt: str, count: int) -> list[tuple[str, float]]:
+        # A fixed distribution over the vocabulary for every prompt, for the llama.cpp `n_probs`.
+        digest = hashlib.sha256(f"{self.behavior.seed}:probs:{prompt}".encode()).digest()
+        rng = random.Random(digest)
+        weights = [rng.random() ** 4 for _ in self.behavior.vocabulary]
+        total = sum(weights)
+        probs = sorted(((f" {token}", weight / total) for token, weight in zip(self.behavior.vocabulary, weights)), key=lambda entry: entry[1], reverse=True)
+        return probs[:count]
+
+    def prompt_tokens(self, prompt: str, slot_id: int | None, cache_prompt: bool) -> int:
+        # Only the part of the prompt after the prefix cached by the slot has to be processed.
+        if not cache_prompt or slot_id is None:
+            return count_tokens(prompt)
+        with self.lock:
+            cached = self.slot_prompts.get(slot_id, "")
+            self.slot_prompts[slot_id] = prompt
+        common = 0
+        for common, (lhs, rhs) in enumerate(zip(cached, prompt)):
+            if lhs != rhs:
+                break
+        else:
+            common = min(len(cached), len(prompt))
+        return count_tokens(prompt[common:])
+
+
+class MockStreamServer(ThreadingHTTPServer):
+    """
+    The port of the ooba websocket streams, it shares the behavior and the stats of its MockServer.
+    """
+    daemon_threads = True
+
+    def __init__(self, parent: MockServer, host: str, port: int):
+        super().__init__((host, port), MockRequestHandler)
+        self.parent = parent
+
+    def __getattr__(self, name: str):
+        if name == "parent":
+            raise AttributeError(name)
+        return getattr(self.parent, name)
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    server: MockServer
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are sent separately, Nagle's algorithm would delay every response.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, value, status: int = 200):
+        body = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_events(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+    def send_event(self, value: dict, event: str | None = None):
+        if event:
+            self.wfile.write(f"event: {event}\n".encode())
+        self.wfile.write(f"data: {json.dumps(value)}\n\n".encode())
+        self.wfile.flush()
+
+    def start_websocket(self):
+        accept = base64.b64encode(hashlib.sha1((self.headers.get("Sec-WebSocket-Key", "") + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+    def read_frame(self) -> tuple[int, bytes]:
+        # The clients send every message in a single frame, masked.
+        header = self.rfile.read(2)
+        if len(header) < 2:
+            raise ConnectionError("The websocket was closed.")
+        opcode = header[0] & 0x0F
+        length = header[1] & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self.rfile.read(8))[0]
+        mask = self.rfile.read(4) if header[1] & 0x80 else bytes(4)
+        payload = self.rfile.read(length)
+        return opcode, bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+    def send_frame(self, payload: bytes, opcode: int = 0x1):
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 1 << 16:
+            header += bytes([126]) + struct.pack(">H", len(payload))
+        else:
+            header += bytes([127]) + struct.pack(">Q", len(payload))
+        self.wfile.write(header + payload)
+        self.wfile.flush()
+
+    def do_GET(self):
+        self.server.record(requests=1)
+        name = self.server.behavior.model_name
+        if self.path == "/api/v1/stream" and self.headers.get("Upgrade", "").lower() == "websocket":
+            self.start_websocket()
+            try:
+                opcode, payload = self.read_frame()
+                if opcode == 0x1:
+                    self.generate(json.loads(payload or b"{}"), True)
+                self.send_frame(b"", 0x8)
+            except ConnectionError:
+                pass
+        elif self.path in ("/api/v1/model", "/api/latest_model"):
+            self.send_json({"result": name})
+        elif self.path == "/health":
+            self.send_json({"status": "ok"})
+        elif self.path == "/props":
+            self.send_json({"default_generation_settings": {"model": name}})
+        elif self.path == "/v1/models":
+            self.send_json({"data": [{"id": name}]})
+        else:
+            self.send_json({"result": "ok"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        data = json.loads(self.rfile.read(length) or b"{}")
+        self.server.record(requests=1)
+
+        if self.path == "/api/extra/tokencount":
+            self.send_json({"value": count_tokens(data.get("prompt", ""))})
+        elif self.path == "/tokenize":
+            self.send_json({"tokens": list(range(count_tokens(data.get("content", ""))))})
+        elif self.path == "/api/v1/token-count":
+            self.send_json({"results": [{"tokens": count_tokens(data.get("prompt", ""))}]})
+        elif self.path in ("/api/v1/generate", "/api/extra/generate/stream", "/completion"):
+            self.generate(data)
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def generate(self, data: dict, websocket: bool = False):
+        server = self.server
+        behavior = server.behavior
+        # ooba doesn't answer a websocket stream with busy, the request waits for its turn.
+        if not websocket and server.is_busy():
+            server.record(busy=1)
+            self.send_json({"error": "busy"}, 503)
+            return
+
+        is_lcpp = self.path == "/completion"
+        stream = websocket or self.path == "/api/extra/generate/stream" or (is_lcpp and data.get("stream", False))
+        prompt = data.get("prompt", "")
+        max_tokens = data.get("n_predict") or data.get("max_new_tokens") or data.get("max_length") or 16
+        stop = data.get("stop") or data.get("stopping_strings") or data.get("stop_sequence") or []
+        sampler_seed = data.get("seed", data.get("sampler_seed"))
+
+        output = server.next_output(prompt, sampler_seed, max_tokens)
+        tokens = TOKEN_PATTERN.findall(output)[:max_tokens]
+        output = "".join(tokens)
+        stopped_word = False
+        for sequence in stop:
+            if sequence and (index := output.find(sequence)) != -1:
+                output = output[:index]
+                stopped_word = True
+        tokens = TOKEN_PATTERN.findall(output)
+
+        slot_id = data.get("id_slot", data.get("slot_id")) if is_lcpp else None
+        prompt_tokens = server.prompt_tokens(prompt, slot_id, is_lcpp and data.get("cache_prompt", False))
+        prompt_time = prompt_tokens * behavior.prompt_latency
+        time.sleep(prompt_time)
+
+        timings = {
+            "prompt_n": prompt_tokens,
+            "prompt_ms": prompt_time * 1000,
+            "predicted_n": len(tokens),
+            "predicted_ms": len(tokens) * behavior.token_latency * 1000,
+        }
+        server.record(generations=1, tokens=len(tokens), prompt_tokens=prompt_tokens, server_time=prompt_time + len(tokens) * behavior.token_latency)
+
+        if not stream:
+            time.sleep(len(tokens) * behavior.token_latency)
+            if is_lcpp:
+                response = {"content": output, "stop": True, "stopped_eos": not stopped_word and len(tokens) < max_tokens, "stopped_word": stopped_word, "tokens_predicted": len(tokens), "tokens_evaluated": prompt_tokens, "timings": timings}
+                if data.get("n_probs"):
+                    response["completion_probabilities"] = [
+                        {"content": token, "probs": [{"tok_str": candidate, "prob": prob} for candidate, prob in server.next_token_probs(prompt + "".join(tokens[:index]), data["n_probs"])]}
+                        for index, token in enumerate(tokens)
+                    ]
+                self.send_json(response)
+            else:
+                self.send_json({"results": [{"text": output}]})
+            return
+
+        if not websocket:
+            self.start_events()
+        try:
+            for index, token in enumerate(tokens):
+                time.sleep(behavior.token_latency)
+                if websocket:
+                    self.send_frame(json.dumps({"event": "text_stream", "message_num": index, "text": token}).encode())
+                elif is_lcpp:
+                    self.send_event({"content": token, "stop": False})
+                else:
+                    self.send_event({"token": token}, "message")
+            if websocket:
+                self.send_frame(json.dumps({"event": "stream_end", "message_num": len(tokens)}).encode())
+            elif is_lcpp:
+                self.send_event({"content": "", "stop": True, "stopped_eos": not stopped_word and len(tokens) < max_tokens, "stopped_word": stopped_word, "timings": timings})
+        except ConnectionError:
+            # The client stops reading once it finds a stop sequence or the test is decided.
+            pass
\ No newline at end of file
@@ -1,2 +1,4 @@
-from .model import LanguageModel
-from .tokenizer import LlamaTokenizer
\ No newline at end of file
+from .model import LanguageModel, BackendError
+from .cache import GenerationCache
+from .telemetry import GenerationStats, Telemetry
+from .tokenizer import Tokenizer, LlamaTokenizer, BackendTokenizer
\ No newline at end of file
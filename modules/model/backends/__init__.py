@@ -1,8 +1,21 @@
-from .kcpp_backend import KcppModel
-from .lcpp_backend import LcppModel
-try:
-    from .lpy_backend import LpyModel
-    LPY_PRESENT = True
-except ModuleNotFoundError as e:
-    LPY_PRESENT = False
-from .ooba_backend import OobaModel
\ No newline at end of file
+import importlib.util
+import importlib
+
+# The backends are imported on first use, importing every HTTP client and llama.cpp binding slows
+# down the startup of runs that only need one backend, or none at all.
+LPY_PRESENT = importlib.util.find_spec("llama_cpp") is not None
+
+_modules = {
+    "HttpClient": ".http_client",
+    "AIOHTTP_PRESENT": ".http_client",
+    "KcppModel": ".kcpp_backend",
+    "LcppModel": ".lcpp_backend",
+    "LpyModel": ".lpy_backend",
+    "OobaModel": ".ooba_backend",
+}
+
+
+def __getattr__(name: str):
+    if name not in _modules:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(_modules[name], __name__), name)
@@ -0,0 +1,349 @@
+from modules.log import Logger
+from modules.model.telemetry import Telemetry
+from modules.model.model import BackendError
+from requests.adapters import HTTPAdapter
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Callable
+if TYPE_CHECKING:
+    import aiohttp
+import importlib.util
+import requests
+import threading
+import asyncio
+import weakref
+import random
+import json
+import time
+
+# aiohttp is only imported by the async API, it's slow to import.
+AIOHTTP_PRESENT = importlib.util.find_spec("aiohttp") is not None
+
+__all__ = ("HttpClient", "AIOHTTP_PRESENT")
+
+
+@dataclass(eq=False)
+class BackendHost:
+    url: str
+    # Requests sent to the host that haven't been answered (or fully streamed) yet.
+    outstanding: int = 0
+    # Consecutive requests that failed or found the host busy.
+    failures: int = 0
+    # Consecutive times the host was ejected, to back off the probes.
+    ejections: int = 0
+    # The host doesn't get requests until this time has passed and a probe found it ready.
+    ejected_until: float = 0.0
+    probing: bool = False
+
+    @property
+    def ejected(self) -> bool:
+        return self.ejected_until > 0
+
+
+class HttpClient:
+    """
+    Sends the requests of a backend to its host, or to the least busy of its hosts when it's given
+    several comma separated hosts serving the same model. A host that fails or is busy several
+    times in a row is left out until a probe finds it ready again.
+    """
+    pool_size = 10
+    connect_timeout = 10.0
+    read_timeout = 600.0
+    max_retries = 5
+    backoff_base = 1.0
+    backoff_max = 30.0
+    eject_after = 3
+    eject_duration = 5.0
+
+    _session: requests.Session | None = None
+    _session_lock = threading.Lock()
+    # aiohttp sessions are bound to the event loop that created them.
+    _async_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+    # The jitter must not consume the global rng, otherwise it would change the model seeds.
+    _jitter = random.Random()
+
+    def __init__(self, host: str, identifier: str, busy_status_codes: tuple[int, ...] = (503,)):
+        assert(isinstance(host, str))
+        self.hosts: list[BackendHost] = []
+        for url in host.split(','):
+            url = url.strip().strip('/')
+            if not url:
+                continue
+            if not url.startswith("http"):
+                url = f"http://{url}"
+            self.hosts.append(BackendHost(url))
+        assert(self.hosts)
+        # The first host stands for the backend, e.g. when the model name is unknown.
+        self.host = self.hosts[0].url
+        self.identifier = identifier
+        self.busy_status_codes = busy_status_codes
+        self.lock = threading.Lock()
+        self.turn = 0
+        # The path probed to bring back an ejected host, set by `wait`.
+        self.probe_path = "/"
+
+    @classmethod
+    def get_session(cls) -> requests.Session:
+        with cls._session_lock:
+            if cls._session is None:
+                # One keep-alive pool per host, shared by every backend in the process.
+                adapter = HTTPAdapter(pool_connections=cls.pool_size, pool_maxsize=cls.pool_size)
+                cls._session = requests.Session()
+                cls._session.mount("http://", adapter)
+                cls._session.mount("https://", adapter)
+            return cls._session
+
+    @classmethod
+    def get_async_session(cls) -> "aiohttp.ClientSession":
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        session = cls._async_sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=cls.pool_size)
+            timeout = aiohttp.ClientTimeout(sock_connect=cls.connect_timeout, sock_read=cls.read_timeout)
+            session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            cls._async_sessions[loop] = session
+        return session
+
+    @classmethod
+    async def aclose_sessions(cls):
+        session = cls._async_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    @classmethod
+    def backoff_delay(cls, attempt: int) -> float:
+        # Full jitter: spread the retries of concurrent clients over the whole backoff window.
+        return cls._jitter.uniform(0, min(cls.backoff_max, cls.backoff_base * (2 ** attempt)))
+
+    def host_name(self, host: BackendHost) -> str:
+        return self.identifier if len(self.hosts) == 1 else f"{self.identifier} at {host.url}"
+
+    def acquire_host(self) -> tuple[BackendHost, Callable[[], None]]:
+        """
+        Picks the host with the fewest outstanding requests among the hosts that weren't ejected,
+        and returns it with the function that releases the request once it was answered.
+        """
+        with self.lock:
+            now = time.monotonic()
+            for host in self.hosts:
+                if host.ejected and not host.probing and host.ejected_until <= now:
+                    host.probing = True
+                    threading.Thread(target=self._probe, args=(host,), name="HostProbe", daemon=True).start()
+            # The hosts take turns when they're equally busy.
+            self.turn = (self.turn + 1) % len(self.hosts)
+            rotated = self.hosts[self.turn:] + self.hosts[:self.turn]
+            healthy = [host for host in rotated if not host.ejected]
+            if healthy:
+                host = min(healthy, key=lambda host: host.outstanding)
+            else:
+                # Every host was ejected, keep trying the one that should come back first.
+                host = min(self.hosts, key=lambda host: host.ejected_until)
+            host.outstanding += 1
+
+        released = False
+        def release():
+            nonlocal released
+            with self.lock:
+                if not released:
+                    released = True
+                    host.outstanding -= 1
+        return host, release
+
+    def report(self, host: BackendHost, ok: bool):
+        # Only the failures in a row count, a single busy answer doesn't eject the host.
+        if len(self.hosts) == 1:
+            return
+        with self.lock:
+            if ok:
+                host.failures = 0
+                return
+            host.failures += 1
+            if host.failures < self.eject_after or host.ejected:
+                return
+            self._eject(host)
+        Logger.log(f"{self.host_name(host)} failed {host.failures} times in a row, the requests will go to the other hosts.", True)
+
+    def _eject(self, host: BackendHost):
+        # Must be called while holding the lock.
+        host.ejections += 1
+        host.ejected_until = time.monotonic() + min(self.backoff_max, self.eject_duration * (2 ** (host.ejections - 1)))
+
+    def _probe(self, host: BackendHost):
+        try:
+            with self.get_session().get(f"{host.url}{self.probe_path}", timeout=(self.connect_timeout, self.connect_timeout)) as response:
+                ready = response.status_code not in self.busy_status_codes
+        except Exception:
+            ready = False
+        with self.lock:
+            host.probing = False
+            if ready:
+                host.failures = 0
+                host.ejections = 0
+                host.ejected_until = 0.0
+            else:
+                self._eject(host)
+        if ready:
+            Logger.log(f"{self.host_name(host)} is ready again.", True)
+
+    def wait(self, path: str = "/"):
+        # Returns as soon as one of the hosts is ready, the others are probed later on.
+        self.probe_path = path
+        wait_started = False
+        attempt = 0
+        while True:
+            ready = []
+            loading = False
+            error = None
+            for host in self.hosts:
+                try:
+                    with self.get_session().get(f"{host.url}{path}", timeout=(self.connect_timeout, self.read_timeout)) as response:
+                        # The server is online but still loading the model.
+                        if response.status_code in self.busy_status_codes:
+                            loading = True
+                        else:
+                            ready.append(host)
+                except Exception as e:
+                    error = e
+            if ready:
+                with self.lock:
+                    for host in self.hosts:
+                        if host not in ready and not host.ejected:
+                            self._eject(host)
+                            Logger.log(f"{self.host_name(host)} isn't ready, the requests will go to the other hosts.", True)
+                break
+            if loading:
+                if not wait_started:
+                    Logger.log(f"{self.identifier} is loading the model, waiting for it to become ready...")
+                    wait_started = True
+            else:
+                if not wait_started:
+                    Logger.log(f"{self.identifier} is offline, waiting for it to become online...")
+                    Logger.log(str(error), True)
+                    wait_started = True
+            # Don't poll a server that is loading the model any faster than an offline one.
+            time.sleep(min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+            attempt = min(attempt + 1, 5)
+
+    def get_json(self, path: str) -> dict | None:
+        host, release = self.acquire_host()
+        try:
+            with self.get_session().get(f"{host.url}{path}", timeout=(self.connect_timeout, self.read_timeout)) as response:
+                if response.status_code != 200:
+                    return None
+                return response.json()
+        except Exception as e:
+            Logger.log(f"{self.host_name(host)} couldn't answer {path}: {e}", True)
+            return None
+        finally:
+            release()
+
+    def try_post_json(self, path: str, data: dict) -> dict | None:
+        host, release = self.acquire_host()
+        try:
+            with self.get_session().post(f"{host.url}{path}", data=json.dumps(data), headers={'Content-Type': 'application/json'}, timeout=(self.connect_timeout, self.read_timeout)) as response:
+                if response.status_code != 200:
+                    return None
+                return response.json()
+        except Exception as e:
+            Logger.log(f"{self.host_name(host)} couldn't answer {path}: {e}", True)
+            return None
+        finally:
+            release()
+
+    def post_json(self, path: str, data: dict, stream: bool = False) -> requests.Response:
+        body = json.dumps(data)
+        attempt = 0
+        while True:
+            last_attempt = attempt >= self.max_retries - 1
+            host, release = self.acquire_host()
+            name = self.host_name(host)
+            Telemetry.add_request(len(body))
+            try:
+                response = self.get_session().post(f"{host.url}{path}", data=body, headers={'Content-Type': 'application/json'}, timeout=(self.connect_timeout, self.read_timeout), stream=stream)
+            except Exception as e:
+                release()
+                self.report(host, False)
+                if last_attempt:
+                    Logger.log(str(e), True)
+                    raise BackendError(f"{name} is offline.") from e
+                delay = self.backoff_delay(attempt)
+                Logger.log(f"{name} couldn't be reached, trying again in {delay:.1f} seconds...", True)
+                Logger.log(str(e), True)
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            if response.status_code in self.busy_status_codes and not last_attempt: # Server busy.
+                response.close()
+                release()
+                self.report(host, False)
+                delay = self.backoff_delay(attempt)
+                Logger.log(f"{name} is busy, trying again in {delay:.1f} seconds...", True)
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            if response.status_code != 200:
+                response.close()
+                release()
+                raise BackendError(f"{name} returned an error. HTTP status code: {response.status_code}")
+
+            self.report(host, True)
+            if not stream:
+                Telemetry.add_response(len(response.content))
+                release()
+            else:
+                # The host is busy until the stream is closed.
+                close = response.close
+                def close_and_release():
+                    close()
+                    release()
+                response.close = close_and_release  # type: ignore
+            return response
+
+    async def apost_json(self, path: str, data: dict) -> "aiohttp.ClientResponse":
+        body = json.dumps(data)
+        attempt = 0
+        while True:
+            last_attempt = attempt >= self.max_retries - 1
+            host, release = self.acquire_host()
+            name = self.host_name(host)
+            Telemetry.add_request(len(body))
+            try:
+                response = await self.get_async_session().post(f"{host.url}{path}", data=body, headers={'Content-Type': 'application/json'})
+            except Exception as e:
+                release()
+                self.report(host, False)
+                if last_attempt:
+                    Logger.log(str(e), True)
+                    raise BackendError(f"{name} is offline.") from e
+                delay = self.backoff_delay(attempt)
+                Logger.log(f"{name} couldn't be reached, trying again in {delay:.1f} seconds...", True)
+                Logger.log(str(e), True)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            if response.status in self.busy_status_codes and not last_attempt: # Server busy.
+                response.release()
+                release()
+                self.report(host, False)
+                delay = self.backoff_delay(attempt)
+                Logger.log(f"{name} is busy, trying again in {delay:.1f} seconds...", True)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            if response.status != 200:
+                response.release()
+                release()
+                raise BackendError(f"{name} returned an error. HTTP status code: {response.status}")
+
+            self.report(host, True)
+            # The host is busy until the response is released, the body is read by the caller.
+            release_response = response.release
+            def release_response_and_host():
+                release()
+                return release_response()
+            response.release = release_response_and_host  # type: ignore
+            return response
@@ -1,61 +1,96 @@
-from modules.model import LanguageModel
+from modules.model import LanguageModel, Telemetry
 from modules.log import Logger
 from colorama import Fore
-import requests
+from typing import AsyncIterator, Iterator
+from .http_client import HttpClient, AIOHTTP_PRESENT
 import json
-import time
 
 __all__ = ("KcppModel",)
 
 
 class KcppModel(LanguageModel):
     def __init__(self, kcpp_host: str, max_context: int, auxiliary: bool = False):
-        assert(isinstance(kcpp_host, str))
-        self.kcpp_host = kcpp_host.strip('/')
-        if not self.kcpp_host.startswith("http"):
-            self.kcpp_host = f"http://{self.kcpp_host}"
         super().__init__(max_context, auxiliary)
+        self.client = HttpClient(kcpp_host, self.get_identifier())
 
     def wait(self):
-        wait_started = False
-        while True:
-            try:
-                requests.get(f"{self.kcpp_host}/")
-                break
-            except Exception as e:
-                if not wait_started:
-                    Logger.log(f"{self.get_identifier()} is offline, waiting for it to become online...")
-                    Logger.log(str(e), True)
-                    wait_started = True
-                time.sleep(1)
-                continue
+        self.client.wait("/api/v1/model")
+
+    def get_model_name(self) -> str:
+        response_dict = self.client.get_json("/api/v1/model")
+        if response_dict and response_dict.get("result"):
+            return response_dict["result"]
+        return self.client.host
+
+    def count_tokens(self, text: str) -> int | None:
+        response_dict = self.client.try_post_json("/api/extra/tokencount", {"prompt": text})
+        if response_dict is None or "value" not in response_dict:
+            return None
+        return response_dict["value"]
+
+    def _read_response(self, body: str) -> str | None:
+        try:
+            return json.loads(body)["results"][0]["text"]
+        except Exception as e:
+            Logger.log_event("Warning", Fore.YELLOW, f"{self.get_identifier()} returned an invalid response. Error while parsing: {e}", True)
+            return None
+
+    def _read_event(self, line: str) -> str | None:
+        if not line.startswith("data:"):
+            return None
+        try:
+            return json.loads(line[5:])["token"]
+        except Exception as e:
+            Logger.log_event("Warning", Fore.YELLOW, f"{self.get_identifier()} returned an invalid event. Error while parsing: {e}", True)
+            return None
 
     def _generate_once(self, data: dict) -> str:
         response_text = str()
 
         for _ in range(5):
-            try:
-                response = requests.post(f"{self.kcpp_host}/api/v1/generate", data=json.dumps(data), headers={'Content-Type': 'application/json'})
-            except Exception as e:
-                Logger.log_event("Error", Fore.RED, f"{self.get_identifier()} is offline.")
-                Logger.log(str(e), True)
-                exit(-1)
-
-            if response.status_code == 503: # Server busy.
-                Logger.log(f"{self.get_identifier()} is busy, trying again in ten seconds...", True)
-                time.sleep(10)
-                continue
-
-            if response.status_code != 200:
-                Logger.log_event("Error", Fore.RED, f"{self.get_identifier()} returned an error. HTTP status code: {response.status_code}")
-                exit(-1)
-
-            try:
-                response_text = response.json()["results"][0]["text"]
+            with self.client.post_json("/api/v1/generate", data) as response:
+                response_text = self._read_response(response.text)
+                if response_text:
+                    break
+
+        return response_text or str()
+
+    def supports_streaming(self) -> bool:
+        return True
+
+    def _generate_stream(self, data: dict) -> Iterator[str]:
+        with self.client.post_json("/api/extra/generate/stream", data, stream=True) as response:
+            # The SSE stream doesn't declare a charset, so requests would default to latin-1.
+            response.encoding = "utf-8"
+            for line in response.iter_lines(decode_unicode=True):
+                Telemetry.add_response(len(line))
+                if token := self._read_event(line):
+                    yield token
+
+    async def _agenerate_once(self, data: dict) -> str:
+        if not AIOHTTP_PRESENT:
+            return await super()._agenerate_once(data)
+
+        response_text = str()
+
+        for _ in range(5):
+            async with await self.client.apost_json("/api/v1/generate", data) as response:
+                body = await response.text()
+                Telemetry.add_response(len(body))
+                response_text = self._read_response(body)
                 if response_text:
                     break
-            except Exception as e:
-                Logger.log_event("Warning", Fore.YELLOW, f"{self.get_identifier()} returned an invalid response. Error while parsing: {e}", True)
-                continue
 
-        return response_text
\ No newline at end of file
+        return response_text or str()
+
+    async def _agenerate_stream(self, data: dict) -> AsyncIterator[str]:
+        if not AIOHTTP_PRESENT:
+            async for token in super()._agenerate_stream(data):
+                yield token
+            return
+
+        async with await self.client.apost_json("/api/extra/generate/stream", data) as response:
+            async for line in response.content:
+                Telemetry.add_response(len(line))
+                if token := self._read_event(line.decode("utf-8").strip()):
+                    yield token
\ No newline at end of file
@@ -1,37 +1,58 @@
-
-from modules.model import LanguageModel
+from modules.model import LanguageModel, Telemetry
 from modules.log import Logger
 from colorama import Fore
-import requests
+from typing import AsyncIterator, Iterator
+from .http_client import HttpClient, AIOHTTP_PRESENT
+import itertools
+import threading
 import json
-import time
+import math
 
 __all__ = ("LcppModel",)
 
 
 class LcppModel(LanguageModel):
-    def __init__(self, lcpp_host: str, max_context: int, auxiliary: bool = False):
-        assert(isinstance(lcpp_host, str))
-        self.lcpp_host = lcpp_host.strip('/')
-        if not self.lcpp_host.startswith("http"):
-            self.lcpp_host = f"http://{self.lcpp_host}"
+    def __init__(self, lcpp_host: str, max_context: int, auxiliary: bool = False, slot_count: int = 0):
         super().__init__(max_context, auxiliary)
+        # llama.cpp answers with 400 while all of its slots are busy.
+        self.client = HttpClient(lcpp_host, self.get_identifier(), (400, 503))
+        self.slot_count = slot_count
+        self._slot_counter = itertools.count()
+        self._slot_lock = threading.Lock()
+
+    def get_slot_id(self) -> int:
+        # Pin every worker thread to its own server slot, so the KV cache of the slot
+        # still holds the prompt prefix of the previous pass ran by the same thread.
+        if self.slot_count <= 0:
+            return -1
+        if not hasattr(self._thread_state, "slot_id"):
+            with self._slot_lock:
+                self._thread_state.slot_id = next(self._slot_counter) % self.slot_count
+        return self._thread_state.slot_id
 
     def wait(self):
-        wait_started = False
-        while True:
-            try:
-                response = requests.get(f"{self.lcpp_host}/")
-                break
-            except Exception as e:
-                if not wait_started:
-                    Logger.log(f"{self.get_identifier()} is offline, waiting for it to become online...")
-                    Logger.log(str(e), True)
-                    wait_started = True
-                time.sleep(1)
-                continue
+        self.client.wait("/health")
+
+    def get_model_name(self) -> str:
+        response_dict = self.client.get_json("/props")
+        if response_dict:
+            model_name = response_dict.get("model_path") or response_dict.get("default_generation_settings", {}).get("model")
+            if model_name:
+                return model_name
+        response_dict = self.client.get_json("/v1/models")
+        if response_dict and response_dict.get("data"):
+            return response_dict["data"][0]["id"]
+        return self.client.host
+
+    def count_tokens(self, text: str) -> int | None:
+        response_dict = self.client.try_post_json("/tokenize", {"content": text})
+        if response_dict is None or "tokens" not in response_dict:
+            return None
+        return len(response_dict["tokens"])
 
     def _convert_data(self, data: dict, stream: bool = False) -> dict:
+        # Work on a copy, the caller may reuse the data for the next request.
+        data = data.copy()
         def rename_dict_key(lhs: str, rhs: str):
             if lhs in data:
                 data[rhs] = data[lhs]
@@ -48,8 +69,34 @@ class LcppModel(LanguageModel):
         if "stop" not in data:
             data["stop"] = []
         data["n_keep"] = -1
+        data["stream"] = stream
+        # Reuse the KV cache of the common prompt prefix instead of processing the whole prompt again.
+        data["cache_prompt"] = True
+        data["id_slot"] = data["slot_id"] = self.get_slot_id()
         return data
 
+    def _read_response(self, body: str) -> dict | None:
+        try:
+            response_dict = json.loads(body)
+            response_dict["content"]
+            return response_dict
+        except Exception as e:
+            Logger.log_event("Warning", Fore.YELLOW, f"{self.get_identifier()} returned an invalid response. Error while parsing: {e}", True)
+            return None
+
+    def _record_timings(self, response_dict: dict):
+        if timings := response_dict.get("timings"):
+            Telemetry.add_server_timings(timings.get("prompt_n", 0), timings.get("prompt_ms", 0.0), timings.get("predicted_n", 0), timings.get("predicted_ms", 0.0))
+
+    def _read_event(self, line: str) -> dict | None:
+        if not line.startswith("data:"):
+            return None
+        try:
+            return json.loads(line[5:])
+        except Exception as e:
+            Logger.log_event("Warning", Fore.YELLOW, f"{self.get_identifier()} returned an invalid event. Error while parsing: {e}", True)
+            return None
+
     def _generate_once(self, data: dict) -> str:
         data = self._convert_data(data)
         response_text = str()
@@ -58,29 +105,103 @@ class LcppModel(LanguageModel):
             if response_text:
                 break
 
-            try:
-                response = requests.post(f"{self.lcpp_host}/completion", data=json.dumps(data), headers={'Content-Type': 'application/json'})
-            except Exception as e:
-                Logger.log_event("Error", Fore.RED, f"{self.get_identifier()} is offline.")
-                Logger.log(str(e), True)
-                exit(-1)
+            with self.client.post_json("/completion", data) as response:
+                response_dict = self._read_response(response.text)
+                if response_dict is None:
+                    continue
+                self._record_timings(response_dict)
+                response_text = response_dict["content"]
+                if not response_text and response_dict.get("stopped_eos"):
+                    return ""
+
+        return response_text
 
-            if response.status_code == 503 or response.status_code == 400: # Server busy.
-                Logger.log(f"{self.get_identifier()} is busy, trying again in ten seconds...", True)
-                time.sleep(10)
-                continue
+    def supports_streaming(self) -> bool:
+        return True
+
+    def supports_token_probs(self) -> bool:
+        return True
+
+    def _next_token_probs(self, data: dict) -> dict[str, float] | None:
+        data = self._convert_data(data)
+        data["n_predict"] = 1
+        data["n_probs"] = self.token_probs_count
 
-            if response.status_code != 200:
-                Logger.log_event("Error", Fore.RED, f"{self.get_identifier()} returned an error. HTTP status code: {response.status_code}")
-                exit(-1)
+        with self.client.post_json("/completion", data) as response:
+            response_dict = self._read_response(response.text)
+        if response_dict is None:
+            return None
+        self._record_timings(response_dict)
+        try:
+            candidates = response_dict["completion_probabilities"][0]
+            # The format changed over the llama.cpp versions: "probs" with "tok_str" and "prob",
+            # then "top_logprobs" with "token" and "logprob" ("top_probs" with "prob" after sampling).
+            if "probs" in candidates:
+                return {entry["tok_str"]: entry["prob"] for entry in candidates["probs"]}
+            if "top_probs" in candidates:
+                return {entry["token"]: entry["prob"] for entry in candidates["top_probs"]}
+            return {entry["token"]: math.exp(entry["logprob"]) for entry in candidates["top_logprobs"]}
+        except (KeyError, IndexError, TypeError) as e:
+            if not response_dict.get("content") and response_dict.get("stopped_eos"):
+                # The model ended the generation right away.
+                return {}
+            Logger.log_event("Warning", Fore.YELLOW, f"{self.get_identifier()} didn't return the token probabilities: {e!r}", True)
+            return None
 
-            try:
-                response_dict = response.json()
+    def _generate_stream(self, data: dict) -> Iterator[str]:
+        data = self._convert_data(data, True)
+
+        with self.client.post_json("/completion", data, stream=True) as response:
+            response.encoding = "utf-8"
+            for line in response.iter_lines(decode_unicode=True):
+                Telemetry.add_response(len(line))
+                if (response_dict := self._read_event(line)) is None:
+                    continue
+                if response_dict.get("content"):
+                    yield response_dict["content"]
+                if response_dict.get("stop"):
+                    self._record_timings(response_dict)
+                    break
+
+    async def _agenerate_once(self, data: dict) -> str:
+        if not AIOHTTP_PRESENT:
+            return await super()._agenerate_once(data)
+
+        data = self._convert_data(data)
+        response_text = str()
+
+        for _ in range(5):
+            if response_text:
+                break
+
+            async with await self.client.apost_json("/completion", data) as response:
+                body = await response.text()
+                Telemetry.add_response(len(body))
+                response_dict = self._read_response(body)
+                if response_dict is None:
+                    continue
+                self._record_timings(response_dict)
                 response_text = response_dict["content"]
-                if not response_text and response_dict["stopped_eos"]:
+                if not response_text and response_dict.get("stopped_eos"):
                     return ""
-            except Exception as e:
-                Logger.log_event("Warning", Fore.YELLOW, f"{self.get_identifier()} returned an invalid response. Error while parsing: {e}", True)
-                continue
 
-        return response_text
\ No newline at end of file
+        return response_text
+
+    async def _agenerate_stream(self, data: dict) -> AsyncIterator[str]:
+        if not AIOHTTP_PRESENT:
+            async for token in super()._agenerate_stream(data):
+                yield token
+            return
+
+        data = self._convert_data(data, True)
+
+        async with await self.client.apost_json("/completion", data) as response:
+            async for line in response.content:
+                Telemetry.add_response(len(line))
+                if (response_dict := self._read_event(line.decode("utf-8").strip())) is None:
+                    continue
+                if response_dict.get("content"):
+                    yield response_dict["content"]
+                if response_dict.get("stop"):
+                    self._record_timings(response_dict)
+                    break
\ No newline at end of file
@@ -1,15 +1,33 @@
 
-from modules.model import LanguageModel
+from modules.model import LanguageModel, BackendError, Telemetry
 from llama_cpp import Llama
+import llama_cpp
+try:
+    from llama_cpp import LlamaRAMCache
+except ImportError as e:
+    from llama_cpp import LlamaCache as LlamaRAMCache
+from typing import Iterator
+import threading
+import math
 
 __all__ = ("LpyModel",)
 
 
 class LpyModel(LanguageModel):
+    prompt_cache_size = 2 << 30
+
     def __init__(self, model_path: str, max_context: int, auxiliary: bool = False):
-        self.new_seed()
-        self.llm = Llama(model_path=model_path, n_ctx=max_context, seed=self.seed, verbose=False)  # type: ignore
         super().__init__(max_context, auxiliary)
+        self.model_path = model_path
+        self.new_seed()
+        # llama-cpp-python only gives the logprobs of the tokens when it keeps the logits of the whole
+        # batch, which the token probabilities (likelihood scoring and judges) need.
+        self.llm = Llama(model_path=model_path, n_ctx=max_context, seed=self.seed, logits_all=self.token_probs_count > 0, verbose=False)  # type: ignore
+        # Keep the saved states of recent prompts, so prompts sharing a prefix skip its processing.
+        self.llm.set_cache(LlamaRAMCache(capacity_bytes=self.prompt_cache_size))
+        # Llama isn't thread-safe, and concurrent passes or the async API call it from worker threads.
+        self.lock = threading.Lock()
+        self._grammars: dict[str, "llama_cpp.LlamaGrammar"] = {}
 
     def __del__(self):
         del self.llm
@@ -17,9 +35,15 @@ class LpyModel(LanguageModel):
     def wait(self):
         pass
 
-    def _generate_once(self, data: dict) -> str:
-        output = self.llm(
-            data["prompt"],
+    def get_model_name(self) -> str:
+        return self.model_path
+
+    def count_tokens(self, text: str) -> int | None:
+        with self.lock:
+            return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False))
+
+    def _completion_args(self, data: dict) -> dict:
+        args = dict(
             max_tokens=data["max_length"],
             temperature=data["temperature"],
             top_p=data["top_p"],
@@ -29,7 +53,62 @@ class LpyModel(LanguageModel):
             #presence_penalty=data["presence_penalty"],
             repeat_penalty=data["rep_pen"],
             top_k=data["top_k"],
-            #stream=True,
             tfs_z=data["tfs"]
         )
-        return output["choices"][0]["text"]  # type: ignore
\ No newline at end of file
+        if data.get("grammar"):
+            args["grammar"] = self._get_grammar(data["grammar"])
+        return args
+
+    def _get_grammar(self, grammar: str) -> "llama_cpp.LlamaGrammar":
+        # Parsing the grammar is slow, and the judges ask for the same few grammars all the time.
+        if grammar not in self._grammars:
+            self._grammars[grammar] = llama_cpp.LlamaGrammar.from_string(grammar, verbose=False)
+        return self._grammars[grammar]
+
+    def _record_timings(self, usage: dict | None = None):
+        # Must be called while holding the lock, right after the generation.
+        try:
+            timings = llama_cpp.llama_get_timings(self.llm.ctx)  # type: ignore
+            Telemetry.add_server_timings(timings.n_p_eval, timings.t_p_eval_ms, timings.n_eval, timings.t_eval_ms)
+        except Exception as e:
+            # Not every llama-cpp-python version exposes the timings, fall back to the token counts.
+            if usage:
+                Telemetry.add_server_timings(usage.get("prompt_tokens", 0), 0.0, usage.get("completion_tokens", 0), 0.0)
+
+    def _generate_once(self, data: dict) -> str:
+        with self.lock:
+            output = self.llm(data["prompt"], **self._completion_args(data))
+            self._record_timings(output.get("usage"))  # type: ignore
+        return output["choices"][0]["text"]  # type: ignore
+
+    def supports_streaming(self) -> bool:
+        return True
+
+    def supports_token_probs(self) -> bool:
+        return self.token_probs_count > 0
+
+    def _next_token_probs(self, data: dict) -> dict[str, float] | None:
+        args = self._completion_args(data)
+        args["max_tokens"] = 1
+        try:
+            with self.lock:
+                output = self.llm(data["prompt"], logprobs=self.token_probs_count, **args)
+                self._record_timings(output.get("usage"))  # type: ignore
+        except ValueError as e:
+            # The model is loaded with logits_all, so this is a bug rather than something to fall back from.
+            raise BackendError(f"{self.get_identifier()} didn't return the token probabilities: {e}") from e
+        logprobs = output["choices"][0].get("logprobs")  # type: ignore
+        if logprobs is None:
+            raise BackendError(f"{self.get_identifier()} didn't return the token probabilities.")
+        top_logprobs = logprobs["top_logprobs"]
+        if not top_logprobs:
+            return {}
+        return {token: math.exp(logprob) for token, logprob in top_logprobs[0].items()}
+
+    def _generate_stream(self, data: dict) -> Iterator[str]:
+        with self.lock:
+            try:
+                for output in self.llm(data["prompt"], stream=True, **self._completion_args(data)):
+                    yield output["choices"][0]["text"]  # type: ignore
+            finally:
+                self._record_timings()
\ No newline at end of file
@@ -1,36 +1,51 @@
-from modules.model import LanguageModel
+from modules.model import LanguageModel, BackendError, Telemetry
 from modules.log import Logger
 from colorama import Fore
-import requests
+from typing import AsyncIterator, Iterator
+from .http_client import HttpClient, AIOHTTP_PRESENT
 import json
-import time
+from urllib.parse import urlsplit
+try:
+    from websocket import create_connection
+    WEBSOCKET_PRESENT = True
+except ModuleNotFoundError as e:
+    WEBSOCKET_PRESENT = False
 
 __all__ = ("OobaModel",)
 
 
 class OobaModel(LanguageModel):
-    def __init__(self, ooba_host: str, max_context: int, auxiliary: bool = False):
-        assert(isinstance(ooba_host, str))
-        self.ooba_host = ooba_host.strip('/')
-        if not self.ooba_host.startswith("http"):
-            self.ooba_host = f"http://{self.ooba_host}"
+    def __init__(self, ooba_host: str, max_context: int, auxiliary: bool = False, ooba_stream_host: str | None = None):
         super().__init__(max_context, auxiliary)
+        self.client = HttpClient(ooba_host, self.get_identifier())
+        if ooba_stream_host is None:
+            # By default the streaming API listens five ports above the blocking API (5000 -> 5005),
+            # the streams always go to the first host.
+            url = urlsplit(self.client.host)
+            ooba_stream_host = f"{url.hostname}:{(url.port or 5000) + 5}"
+        self.ooba_stream_host = ooba_stream_host.strip('/').replace("http://", "ws://").replace("https://", "wss://")
+        if not self.ooba_stream_host.startswith("ws"):
+            self.ooba_stream_host = f"ws://{self.ooba_stream_host}"
 
     def wait(self):
-        wait_started = False
-        while True:
-            try:
-                requests.get(f"{self.ooba_host}/")
-                break
-            except Exception as e:
-                if not wait_started:
-                    Logger.log(f"{self.get_identifier()} is offline, waiting for it to become online...")
-                    Logger.log(str(e), True)
-                    wait_started = True
-                time.sleep(1)
-                continue
+        self.client.wait("/api/v1/model")
+
+    def get_model_name(self) -> str:
+        response_dict = self.client.get_json("/api/v1/model")
+        if response_dict and response_dict.get("result"):
+            return response_dict["result"]
+        return self.client.host
+
+    def count_tokens(self, text: str) -> int | None:
+        response_dict = self.client.try_post_json("/api/v1/token-count", {"prompt": text})
+        try:
+            return response_dict["results"][0]["tokens"]  # type: ignore
+        except Exception as e:
+            return None
 
     def _convert_data(self, data: dict, stream: bool = False) -> dict:
+        # Work on a copy, the caller may reuse the data for the next request.
+        data = data.copy()
         def rename_dict_key(lhs: str, rhs: str):
             if lhs in data:
                 data[rhs] = data[lhs]
@@ -43,35 +58,113 @@ class OobaModel(LanguageModel):
         rename_dict_key("typical", "typical_p")
         rename_dict_key("sampler_seed", "seed")
         rename_dict_key("stop_sequence", "stopping_strings")
+        rename_dict_key("grammar", "grammar_string")
         return data
 
+    def _read_response(self, body: str) -> str | None:
+        try:
+            return json.loads(body)["results"][0]["text"]
+        except Exception as e:
+            Logger.log_event("Warning", Fore.YELLOW, f"{self.get_identifier()} returned an invalid response. Error while parsing: {e}", True)
+            return None
+
+    def _read_event(self, message: str) -> dict | None:
+        try:
+            return json.loads(message)
+        except Exception as e:
+            Logger.log_event("Warning", Fore.YELLOW, f"{self.get_identifier()} returned an invalid event. Error while parsing: {e}", True)
+            return None
+
     def _generate_once(self, data: dict) -> str:
         data = self._convert_data(data)
         response_text = str()
 
         for _ in range(5):
-            try:
-                response = requests.post(f"{self.ooba_host}/api/v1/generate", data=json.dumps(data), headers={'Content-Type': 'application/json'})
-            except Exception as e:
-                Logger.log_event("Error", Fore.RED, f"{self.get_identifier()} is offline.")
-                Logger.log(str(e), True)
-                exit(-1)
-
-            if response.status_code == 503: # Server busy.
-                Logger.log(f"{self.get_identifier()} is busy, trying again in ten seconds...", True)
-                time.sleep(10)
-                continue
-
-            if response.status_code != 200:
-                Logger.log_event("Error", Fore.RED, f"{self.get_identifier()} returned an error. HTTP status code: {response.status_code}")
-                exit(-1)
-
-            try:
-                response_text = response.json()["results"][0]["text"]
+            with self.client.post_json("/api/v1/generate", data) as response:
+                response_text = self._read_response(response.text)
                 if response_text:
                     break
-            except Exception as e:
-                Logger.log_event("Warning", Fore.YELLOW, f"{self.get_identifier()} returned an invalid response. Error while parsing: {e}", True)
-                continue
 
-        return response_text
\ No newline at end of file
+        return response_text or str()
+
+    def supports_streaming(self) -> bool:
+        return WEBSOCKET_PRESENT
+
+    def _generate_stream(self, data: dict) -> Iterator[str]:
+        data = self._convert_data(data, True)
+
+        try:
+            connection = create_connection(f"{self.ooba_stream_host}/api/v1/stream")
+            connection.send(json.dumps(data))
+        except Exception as e:
+            Logger.log(str(e), True)
+            raise BackendError(f"{self.get_identifier()} is offline.") from e
+
+        try:
+            while True:
+                try:
+                    message = connection.recv()
+                except Exception as e:
+                    Logger.log_event("Warning", Fore.YELLOW, f"{self.get_identifier()} closed the stream: {e}", True)
+                    return
+                Telemetry.add_response(len(message))
+                response_dict = self._read_event(message)
+                if response_dict is None:
+                    return
+                if response_dict.get("event") == "text_stream":
+                    if response_dict.get("text"):
+                        yield response_dict["text"]
+                elif response_dict.get("event") == "stream_end":
+                    return
+        finally:
+            connection.close()
+
+    async def _agenerate_once(self, data: dict) -> str:
+        if not AIOHTTP_PRESENT:
+            return await super()._agenerate_once(data)
+
+        data = self._convert_data(data)
+        response_text = str()
+
+        for _ in range(5):
+            async with await self.client.apost_json("/api/v1/generate", data) as response:
+                body = await response.text()
+                Telemetry.add_response(len(body))
+                response_text = self._read_response(body)
+                if response_text:
+                    break
+
+        return response_text or str()
+
+    async def _agenerate_stream(self, data: dict) -> AsyncIterator[str]:
+        if not AIOHTTP_PRESENT:
+            async for token in super()._agenerate_stream(data):
+                yield token
+            return
+
+        import aiohttp
+        data = self._convert_data(data, True)
+
+        try:
+            connection = await self.client.get_async_session().ws_connect(f"{self.ooba_stream_host}/api/v1/stream")
+            await connection.send_str(json.dumps(data))
+        except Exception as e:
+            Logger.log(str(e), True)
+            raise BackendError(f"{self.get_identifier()} is offline.") from e
+
+        try:
+            async for message in connection:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    Logger.log_event("Warning", Fore.YELLOW, f"{self.get_identifier()} closed the stream: {message.type.name}", True)
+                    return
+                Telemetry.add_response(len(message.data))
+                response_dict = self._read_event(message.data)
+                if response_dict is None:
+                    return
+                if response_dict.get("event") == "text_stream":
+                    if response_dict.get("text"):
+                        yield response_dict["text"]
+                elif response_dict.get("event") == "stream_end":
+                    return
+        finally:
+            await connection.close()
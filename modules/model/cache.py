@@ -0,0 +1,87 @@
+from modules.log import Logger
+import threading
+import sqlite3
+import hashlib
+import json
+import time
+import os
+
+__all__ = ("GenerationCache",)
+
+
+class GenerationCache:
+    max_size = 512 * 1024 * 1024
+    max_age = 30 * 24 * 60 * 60
+    evict_interval = 100
+
+    def __init__(self, file_path: str):
+        folder = os.path.dirname(file_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        # Passes running concurrently share the connection, guarded by the lock.
+        self.connection = sqlite3.connect(file_path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS generations (
+                key TEXT PRIMARY KEY,
+                pieces TEXT NOT NULL,
+                complete INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self.connection.commit()
+        self.puts_since_eviction = 0
+        self.evict()
+
+    @staticmethod
+    def make_key(model_identity: str, data: dict, stream: bool) -> str:
+        # The request payload holds the prompt, the preset sampler fields, the stop sequences,
+        # the seed and the chunk size (max_length), so identical requests share a key.
+        payload = json.dumps({"model": model_identity, "stream": stream, "data": data}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> tuple[list[str], bool] | None:
+        with self.lock:
+            row = self.connection.execute("SELECT pieces, complete FROM generations WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE generations SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+        return json.loads(row[0]), bool(row[1])
+
+    def put(self, key: str, pieces: list[str], complete: bool):
+        value = json.dumps(pieces, ensure_ascii=False)
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO generations (key, pieces, complete, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET pieces = excluded.pieces, complete = excluded.complete, size = excluded.size, last_used = excluded.last_used",
+                (key, value, int(complete), len(value), now, now)
+            )
+            self.connection.commit()
+            self.puts_since_eviction += 1
+            if self.puts_since_eviction < self.evict_interval:
+                return
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            self.puts_since_eviction = 0
+            expired = self.connection.execute("DELETE FROM generations WHERE created < ?", (time.time() - self.max_age,)).rowcount
+            # Drop the least recently used entries that don't fit in the size budget.
+            evicted = self.connection.execute("""
+                DELETE FROM generations WHERE key IN (
+                    SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_used DESC) AS total FROM generations) WHERE total > ?
+                )
+            """, (self.max_size,)).rowcount
+            self.connection.commit()
+        if expired or evicted:
+            Logger.log(f"Evicted {expired + evicted} entries from the generation cache.", True)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
\ No newline at end of file
@@ -1,31 +1,97 @@
 
-from typing import Iterator
-from modules.log import Logger
+from typing import AsyncIterator, Iterator
+from modules.log import Logger, RunContext
 from modules.prompt import Prompt
 from modules.prompt.styles import *
+from .cache import GenerationCache
+from .telemetry import Telemetry
+from .stop import StopSequenceDetector
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+import threading
+import asyncio
+import hashlib
 import json
 import random
+import time
 import abc
 
-__all__ = ("LanguageModel",)
+__all__ = ("LanguageModel", "BackendError",)
+
+
+class BackendError(Exception):
+    # The backend is offline or failed to answer a request, even after retrying.
+    pass
 
 
 class LanguageModel(abc.ABC):
     base_seed = None
+    use_streaming = True
+    # Maximum number of tokens kept free for the generation when the prompt has a token budget.
+    generation_reserve = 512
+    # The scoring of continuations asks for this many next token probabilities per request, and
+    # follows the tokens down to this probability, with at most this many requests.
+    token_probs_count = 10
+    min_branch_probability = 0.01
+    max_probability_requests = 16
+    # The verdicts of the judges by (judge model, labels, question, normalized text).
+    _verdicts: dict[tuple[str, tuple[str, ...], str, str], str] = {}
+    _verdicts_lock = threading.Lock()
+    cache: GenerationCache | None = None
+    # The cancellation event, the seed and the seed calls of the test pass running on the current thread.
+    _pass_state = threading.local()
 
     def __init__(self, max_context: int, auxiliary: bool):
         self.max_context = max_context
         self.presets = dict()
-        self.seed = LanguageModel.base_seed
+        # The seed is per thread, so concurrent test passes can share the same model.
+        self._thread_state = threading.local()
         self.is_auxiliary = auxiliary
+        self._model_identity: str | None = None
+
+    @property
+    def seed(self) -> int | None:
+        return getattr(self._thread_state, "seed", LanguageModel.base_seed)
+
+    @seed.setter
+    def seed(self, value: int | None):
+        self._thread_state.seed = value
+
+    @classmethod
+    def set_cancel_event(cls, event: threading.Event | None):
+        cls._pass_state.cancel_event = event
+
+    @classmethod
+    def set_pass_seed(cls, seed: int | None):
+        # The model seeds of a pass are derived from its seed and the order they're asked for in,
+        # so a pass can be replayed on its own.
+        cls._pass_state.seed = seed
+        cls._pass_state.seed_calls = 0
+
+    @staticmethod
+    def derive_seed(*parts) -> int:
+        # Unlike hash(), the digest is the same in every process and on every machine.
+        digest = hashlib.sha256("\x1f".join(str(part) for part in parts).encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "little") % 0xFFFFFFFF + 1
+
+    @classmethod
+    def is_cancelled(cls) -> bool:
+        event = getattr(cls._pass_state, "cancel_event", None)
+        return event is not None and event.is_set()
 
     def load_preset(self, file_path: str):
         with open(file_path, "r") as file:
             self.presets = json.load(file)
 
     def new_seed(self):
-        self.seed = random.randint(1, 0xFFFFFFFF)
+        pass_seed = getattr(LanguageModel._pass_state, "seed", None)
+        if pass_seed is not None:
+            call_index = LanguageModel._pass_state.seed_calls
+            LanguageModel._pass_state.seed_calls += 1
+            self.seed = LanguageModel.derive_seed(pass_seed, call_index)
+        else:
+            self.seed = random.randint(1, 0xFFFFFFFF)
         Logger.log(f"New {'auxiliary ' if self.is_auxiliary else ''}model seed: {self.seed}", True)
+        Logger.record("seed", model="auxiliary" if self.is_auxiliary else "main", seed=self.seed)
 
     def clear_seed(self):
         self.seed = LanguageModel.base_seed
@@ -33,6 +99,17 @@ class LanguageModel(abc.ABC):
     def get_identifier(self) -> str:
         return f"Model backend{' (auxiliary)' if self.is_auxiliary else ''}"
 
+    def get_model_name(self) -> str:
+        return ""
+
+    def get_model_identity(self) -> str:
+        if self._model_identity is None:
+            self._model_identity = f"{type(self).__name__}:{self.get_model_name()}"
+        return self._model_identity
+
+    def count_tokens(self, text: str) -> int | None:
+        return None
+
     @abc.abstractmethod
     def wait(self):
         pass
@@ -41,11 +118,175 @@ class LanguageModel(abc.ABC):
     def _generate_once(self, data: dict) -> str:
         return ""
 
-    def generate_iter(self, prompt: Prompt | str, max_tokens_per_iter: int = 8, max_iter: int = 0xFFFFFFFF) -> Iterator[tuple[str, str]]:
-        if isinstance(prompt, RoleplayPrompt):
-            stop_sequences = [s.replace("{{char}}", prompt.card.name).replace("<BOT>", prompt.card.name).replace("{{user}}", prompt.user_name).replace("<USER>", prompt.user_name) for s in prompt.format["stop_sequences"]]
-        elif isinstance(prompt, InstructPrompt):
-            stop_sequences = [s for s in prompt.format["stop_sequences"] if "{{char}}" not in s and "{{user}}" not in s]
+    def supports_streaming(self) -> bool:
+        return False
+
+    def _generate_stream(self, data: dict) -> Iterator[str]:
+        raise NotImplementedError()
+
+    def supports_token_probs(self) -> bool:
+        return False
+
+    def _next_token_probs(self, data: dict) -> dict[str, float] | None:
+        # The probabilities of the most likely tokens that follow `data["prompt"]`.
+        raise NotImplementedError()
+
+    def _cache_key(self, data: dict, stream: bool) -> str | None:
+        # Generations are only reproducible when the request carries a seed.
+        if LanguageModel.cache is None or "sampler_seed" not in data:
+            return None
+        return GenerationCache.make_key(self.get_model_identity(), data, stream)
+
+    def _cached_generate_once(self, data: dict) -> str:
+        key = self._cache_key(data, False)
+        if key is not None and (entry := LanguageModel.cache.get(key)) is not None:  # type: ignore
+            return "".join(entry[0])
+        response_text = self._generate_once(data)
+        if key is not None and response_text:
+            LanguageModel.cache.put(key, [response_text], True)  # type: ignore
+        return response_text
+
+    def _cached_generate_stream(self, data: dict) -> Iterator[str]:
+        key = self._cache_key(data, True)
+        if key is None:
+            yield from self._generate_stream(data)
+            return
+
+        pieces, complete = LanguageModel.cache.get(key) or ([], False)  # type: ignore
+        yield from pieces
+        if complete:
+            return
+
+        # The stream was cut short the last time (e.g. the test had already decided), so
+        # regenerate it and only yield the tokens that come after the cached ones.
+        cached_count = len(pieces)
+        tokens = self._generate_stream(data)
+        try:
+            for index, token in enumerate(tokens):
+                if index < cached_count:
+                    continue
+                pieces.append(token)
+                yield token
+            complete = True
+        finally:
+            tokens.close()  # type: ignore
+            if len(pieces) > cached_count or complete:
+                LanguageModel.cache.put(key, pieces, complete)  # type: ignore
+
+    async def _acached_generate_once(self, data: dict) -> str:
+        key = self._cache_key(data, False)
+        if key is not None and (entry := LanguageModel.cache.get(key)) is not None:  # type: ignore
+            return "".join(entry[0])
+        response_text = await self._agenerate_once(data)
+        if key is not None and response_text:
+            LanguageModel.cache.put(key, [response_text], True)  # type: ignore
+        return response_text
+
+    async def _acached_generate_stream(self, data: dict) -> AsyncIterator[str]:
+        key = self._cache_key(data, True)
+        if key is None:
+            async for token in self._agenerate_stream(data):
+                yield token
+            return
+
+        pieces, complete = LanguageModel.cache.get(key) or ([], False)  # type: ignore
+        for token in list(pieces):
+            yield token
+        if complete:
+            return
+
+        cached_count = len(pieces)
+        tokens = self._agenerate_stream(data)
+        try:
+            index = 0
+            async for token in tokens:
+                index += 1
+                if index <= cached_count:
+                    continue
+                pieces.append(token)
+                yield token
+            complete = True
+        finally:
+            await tokens.aclose()  # type: ignore
+            if len(pieces) > cached_count or complete:
+                LanguageModel.cache.put(key, pieces, complete)  # type: ignore
+
+    def _iter_stream_chunks(self, data: dict, max_tokens_per_iter: int) -> Iterator[str]:
+        # Group the streamed tokens into chunks of `max_tokens_per_iter` tokens so
+        # callers observe the same granularity as the non-streaming mode.
+        tokens = self._cached_generate_stream(data)
+        try:
+            chunk = str()
+            token_count = 0
+            for token in tokens:
+                chunk += token
+                token_count += 1
+                if token_count >= max_tokens_per_iter:
+                    yield chunk
+                    chunk = str()
+                    token_count = 0
+            if chunk:
+                yield chunk
+        finally:
+            tokens.close()  # type: ignore
+
+    def _iter_resubmit_chunks(self, data: dict, prompt_str: str, max_iter: int) -> Iterator[str]:
+        output_str = str()
+        for _ in range(max_iter):
+            data["prompt"] = prompt_str + output_str
+            response_text = self._cached_generate_once(data)
+
+            # Return if we couldn't generate anything.
+            if not response_text:
+                return
+
+            output_str += response_text
+            yield response_text
+
+    async def _agenerate_once(self, data: dict) -> str:
+        return await asyncio.to_thread(self._generate_once, data)
+
+    async def _agenerate_stream(self, data: dict) -> AsyncIterator[str]:
+        # Backends without a native async client consume their blocking stream from a worker thread.
+        tokens = self._generate_stream(data)
+        try:
+            while (token := await asyncio.to_thread(next, tokens, None)) is not None:
+                yield token
+        finally:
+            await asyncio.to_thread(tokens.close)  # type: ignore
+
+    async def _aiter_stream_chunks(self, data: dict, max_tokens_per_iter: int) -> AsyncIterator[str]:
+        tokens = self._acached_generate_stream(data)
+        try:
+            chunk = str()
+            token_count = 0
+            async for token in tokens:
+                chunk += token
+                token_count += 1
+                if token_count >= max_tokens_per_iter:
+                    yield chunk
+                    chunk = str()
+                    token_count = 0
+            if chunk:
+                yield chunk
+        finally:
+            await tokens.aclose()  # type: ignore
+
+    async def _aiter_resubmit_chunks(self, data: dict, prompt_str: str, max_iter: int) -> AsyncIterator[str]:
+        output_str = str()
+        for _ in range(max_iter):
+            data["prompt"] = prompt_str + output_str
+            response_text = await self._acached_generate_once(data)
+
+            if not response_text:
+                return
+
+            output_str += response_text
+            yield response_text
+
+    def _prepare_request(self, prompt: Prompt | str, max_tokens_per_iter: int, max_iter: int, grammar: str | None = None) -> tuple[dict, str, list[str]]:
+        if isinstance(prompt, (RoleplayPrompt, InstructPrompt)):
+            stop_sequences = list(prompt.stop_sequences)
         else:
             stop_sequences = ["\n##"]
         data = self.presets.copy()
@@ -57,25 +298,255 @@ class LanguageModel(abc.ABC):
 
         if self.seed:
             data["sampler_seed"] = self.seed
+        if grammar:
+            # A GBNF grammar the output must follow, for the backends that support it.
+            data["grammar"] = grammar
+
+        if isinstance(prompt, RoleplayPrompt):
+            # Leave room for the generation, the output is appended to the prompt.
+            prompt_str = prompt.to_string(self.max_context - min(max_tokens_per_iter * max_iter, LanguageModel.generation_reserve))
+        else:
+            prompt_str = prompt.to_string() if not isinstance(prompt, str) else prompt
+        return data, prompt_str, stop_sequences
+
+    def _use_streaming(self, data: dict, prompt_str: str, max_tokens_per_iter: int, max_iter: int) -> bool:
+        if not LanguageModel.use_streaming or not self.supports_streaming():
+            return False
+        # A single request streams the whole generation, so the prompt is only processed once.
+        data["prompt"] = prompt_str
+        data["max_length"] = min(max_tokens_per_iter * max_iter, self.max_context)
+        return True
+
+    def generate_iter(self, prompt: Prompt | str, max_tokens_per_iter: int = 8, max_iter: int = 0xFFFFFFFF, grammar: str | None = None) -> Iterator[tuple[str, str]]:
+        if LanguageModel.is_cancelled():
+            return
+        data, prompt_str, stop_sequences = self._prepare_request(prompt, max_tokens_per_iter, max_iter, grammar)
+        if self._use_streaming(data, prompt_str, max_tokens_per_iter, max_iter):
+            chunks = self._iter_stream_chunks(data, max_tokens_per_iter)
+        else:
+            chunks = self._iter_resubmit_chunks(data, prompt_str, max_iter)
 
-        prompt_str = prompt.to_string() if not isinstance(prompt, str) else prompt
         output_str = str()
-        for _ in range(max_iter):
-            data["prompt"] = prompt_str + output_str
-            response_text = self._generate_once(data)
+        stop_detector = StopSequenceDetector(stop_sequences)
+        stats, previous_stats = Telemetry.start("auxiliary" if self.is_auxiliary else "main")
+        start_time = time.perf_counter()
+        try:
+            for response_text in chunks:
+                if stats.ttft is None:
+                    stats.ttft = time.perf_counter() - start_time
+                if LanguageModel.is_cancelled():
+                    break
+                cut = stop_detector.feed(response_text)
+                if cut is not None:
+                    # The stop sequence may have started in a previous chunk.
+                    yield response_text[:max(cut - len(output_str), 0)], (output_str + response_text)[:cut]
+                    break
+                output_str += response_text
+                yield response_text, output_str
+        finally:
+            chunks.close()  # type: ignore
+            stats.latency = time.perf_counter() - start_time
+            Telemetry.finish(stats, previous_stats)
 
-            # Return if we couldn't generate anything.
-            if not response_text:
-                return
+    def generate(self, prompt: Prompt | str, max_tokens_per_iter: int = 8, max_iter: int = 0xFFFFFFFF, grammar: str | None = None) -> str:
+        result = str()
+        for _, output in self.generate_iter(prompt, max_tokens_per_iter, max_iter, grammar):
+            result = output
+        return result
 
-            output_str += response_text
-            if any((match := s) in output_str for s in stop_sequences):
-                yield response_text.split(match, 2)[0], output_str.split(match, 2)[0]
-                break
-            yield response_text, output_str
+    def continuation_probability(self, prompt: Prompt | str, continuations: list[str], case_sensitive: bool = False) -> float | None:
+        """
+        Returns the probability that the generation starts with any of the `continuations`
+        (ignoring the leading whitespace), read from the token probabilities of the backend instead
+        of sampling generations. Returns None if the backend doesn't give the token probabilities.
+        """
+        if not self.supports_token_probs() or LanguageModel.is_cancelled():
+            return None
+        data, prompt_str, _ = self._prepare_request(prompt, 1, 1)
+        targets = [continuation.lstrip() if case_sensitive else continuation.lstrip().lower() for continuation in continuations if continuation.strip()]
+
+        probability = 0.0
+        requests = 0
+        # The outputs that are still the start of a continuation, the most likely ones are followed first.
+        branches = [(str(), 1.0)]
+        stats, previous_stats = Telemetry.start("auxiliary" if self.is_auxiliary else "main")
+        start_time = time.perf_counter()
+        try:
+            while branches and requests < self.max_probability_requests:
+                if LanguageModel.is_cancelled():
+                    return None
+                output, output_probability = branches.pop(0)
+                data["prompt"] = prompt_str + output
+                token_probs = self._next_token_probs(data)
+                requests += 1
+                if stats.ttft is None:
+                    stats.ttft = time.perf_counter() - start_time
+                if token_probs is None:
+                    if requests == 1:
+                        return None
+                    continue
+
+                for token, token_probability in token_probs.items():
+                    text = (output + token).lstrip()
+                    if not case_sensitive:
+                        text = text.lower()
+                    branch_probability = output_probability * token_probability
+                    if any(text.startswith(target) for target in targets):
+                        probability += branch_probability
+                    elif branch_probability >= self.min_branch_probability and any(target.startswith(text) for target in targets):
+                        branches.append((output + token, branch_probability))
+                branches.sort(key=lambda branch: branch[1], reverse=True)
+        finally:
+            stats.latency = time.perf_counter() - start_time
+            Telemetry.finish(stats, previous_stats)
+
+        Logger.log(f"Continuation probability: {probability:.3f} after {requests} requests", True)
+        return min(probability, 1.0)
+
+    def judge(self, prompt: InstructPrompt, text: str, question: str, labels: tuple[str, ...] = ("Yes", "No"), votes: int = 5) -> str | None:
+        """
+        Asks the model a question about the text, whose answer must be one of the labels. The label
+        is read from the token probabilities of the backend when it gives them, otherwise the model
+        votes (up to `votes` times, constrained by a grammar if the backend supports it) until a
+        label has the majority. Returns None if no label got the majority.
+        """
+        # The votes take their seeds from a single model seed, so the next seeds of the pass don't
+        # depend on how many votes were needed.
+        self.new_seed()
+        base_seed = self.seed
+        key = (self.get_model_identity(), tuple(labels), question, " ".join(text.split()).lower())
+        with LanguageModel._verdicts_lock:
+            verdict = LanguageModel._verdicts.get(key)
+        if verdict is not None:
+            Logger.log(f"Known verdict: {verdict}", True)
+            return verdict
+
+        prompt.init()
+        prompt.add_judge_question(text, question, labels)
+        verdict = self._judge_by_probs(prompt, labels)
+        if verdict is None:
+            verdict = self._judge_by_votes(prompt, labels, votes, base_seed)
+        if verdict is not None and not LanguageModel.is_cancelled():
+            with LanguageModel._verdicts_lock:
+                LanguageModel._verdicts[key] = verdict
+        return verdict
+
+    @staticmethod
+    def _find_label(answer: str, labels: tuple[str, ...]) -> str | None:
+        answer = answer.strip().lower()
+        return next((label for label in labels if answer.startswith(label.lower())), None) or next((label for label in labels if label.lower() in answer), None)
+
+    def _judge_by_probs(self, prompt: InstructPrompt, labels: tuple[str, ...]) -> str | None:
+        if not self.supports_token_probs() or LanguageModel.is_cancelled():
+            return None
+        data, prompt_str, _ = self._prepare_request(prompt, 1, 1)
+        data["prompt"] = prompt_str
+        stats, previous_stats = Telemetry.start("auxiliary" if self.is_auxiliary else "main")
+        start_time = time.perf_counter()
+        try:
+            token_probs = self._next_token_probs(data)
+            stats.ttft = time.perf_counter() - start_time
+        finally:
+            stats.latency = time.perf_counter() - start_time
+            Telemetry.finish(stats, previous_stats)
+        if not token_probs:
+            return None
+
+        label_probs = dict.fromkeys(labels, 0.0)
+        for token, token_probability in token_probs.items():
+            token = token.strip().lower()
+            if not token:
+                continue
+            matches = [label for label in labels if label.lower().startswith(token) or token.startswith(label.lower())]
+            if len(matches) > 1:
+                # The first token doesn't tell the labels apart.
+                return None
+            if matches:
+                label_probs[matches[0]] += token_probability
+        Logger.log(f"Label probabilities: {', '.join(f'{label}: {probability:.3f}' for label, probability in label_probs.items())}", True)
+        if sum(label_probs.values()) < 0.5:
+            # The model would mostly answer something else, let it vote.
+            return None
+        return max(label_probs, key=label_probs.__getitem__)
+
+    def _judge_by_votes(self, prompt: InstructPrompt, labels: tuple[str, ...], votes: int, base_seed: int | None) -> str | None:
+        majority = votes // 2 + 1
+        # Render the prompt once, so the votes only read it.
+        prompt.to_string()
+        # Backends that don't know the grammar ignore it, the label is then looked for in the answer.
+        grammar = "root ::= \" \"? (" + " | ".join(json.dumps(label) for label in labels) + ")"
+        run_context = RunContext.get()
+        stop_event = threading.Event()
+
+        def vote(index: int) -> str | None:
+            LanguageModel.set_cancel_event(stop_event)
+            try:
+                with RunContext.scope(**run_context):
+                    self.seed = LanguageModel.derive_seed(base_seed, index) if base_seed is not None else None
+                    answer = self.generate(prompt, max_iter=1, grammar=grammar)
+            finally:
+                LanguageModel.set_cancel_event(None)
+            Logger.log(f"{'Auxiliary model' if self.is_auxiliary else 'Model'} vote {index + 1}: {answer.strip()}", True)
+            return self._find_label(answer, labels)
+
+        counts = dict.fromkeys(labels, 0)
+        submitted = 0
+        in_flight: set[Future] = set()
+        pool = ThreadPoolExecutor(max_workers=majority)
+        try:
+            while True:
+                leading = max(counts.values())
+                if leading >= majority:
+                    break
+                # Only ask for the votes the leading label still needs to get the majority.
+                while submitted < votes and len(in_flight) < majority - leading:
+                    in_flight.add(pool.submit(vote, submitted))
+                    submitted += 1
+                if not in_flight or LanguageModel.is_cancelled():
+                    break
+                done, in_flight = wait(in_flight, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if (label := future.result()) is not None:
+                        counts[label] += 1
+        finally:
+            # The votes still running stop at their next chunk, there's no need to wait for them.
+            stop_event.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+        return next((label for label, count in counts.items() if count >= majority), None)
+
+    async def agenerate_iter(self, prompt: Prompt | str, max_tokens_per_iter: int = 8, max_iter: int = 0xFFFFFFFF, grammar: str | None = None) -> AsyncIterator[tuple[str, str]]:
+        if LanguageModel.is_cancelled():
+            return
+        data, prompt_str, stop_sequences = self._prepare_request(prompt, max_tokens_per_iter, max_iter, grammar)
+        if self._use_streaming(data, prompt_str, max_tokens_per_iter, max_iter):
+            chunks = self._aiter_stream_chunks(data, max_tokens_per_iter)
+        else:
+            chunks = self._aiter_resubmit_chunks(data, prompt_str, max_iter)
+
+        output_str = str()
+        stop_detector = StopSequenceDetector(stop_sequences)
+        stats, previous_stats = Telemetry.start("auxiliary" if self.is_auxiliary else "main")
+        start_time = time.perf_counter()
+        try:
+            async for response_text in chunks:
+                if stats.ttft is None:
+                    stats.ttft = time.perf_counter() - start_time
+                if LanguageModel.is_cancelled():
+                    break
+                cut = stop_detector.feed(response_text)
+                if cut is not None:
+                    # The stop sequence may have started in a previous chunk.
+                    yield response_text[:max(cut - len(output_str), 0)], (output_str + response_text)[:cut]
+                    break
+                output_str += response_text
+                yield response_text, output_str
+        finally:
+            await chunks.aclose()  # type: ignore
+            stats.latency = time.perf_counter() - start_time
+            Telemetry.finish(stats, previous_stats)
 
-    def generate(self, prompt: Prompt | str, max_tokens_per_iter: int = 8, max_iter: int = 0xFFFFFFFF) -> str:
+    async def agenerate(self, prompt: Prompt | str, max_tokens_per_iter: int = 8, max_iter: int = 0xFFFFFFFF, grammar: str | None = None) -> str:
         result = str()
-        for _, output in self.generate_iter(prompt, max_tokens_per_iter, max_iter):
+        async for _, output in self.agenerate_iter(prompt, max_tokens_per_iter, max_iter, grammar):
             result = output
         return result
\ No newline at end of file
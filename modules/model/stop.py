@@ -0,0 +1,31 @@
+from typing import Iterable
+
+__all__ = ("StopSequenceDetector",)
+
+
+class StopSequenceDetector:
+    """
+    Finds where a generation fed chunk by chunk must be cut. Only the new chunk and the tail of
+    the previous output that a stop sequence could have started in are searched, so a long
+    generation isn't searched again from the start after every chunk.
+    """
+    def __init__(self, stop_sequences: Iterable[str]):
+        self.stop_sequences = [s for s in stop_sequences if s]
+        self.overlap = max((len(s) for s in self.stop_sequences), default=1) - 1
+        self.tail = str()
+        self.length = 0
+
+    def feed(self, chunk: str) -> int | None:
+        # Returns the offset in the output where the earliest stop sequence starts, if any.
+        window = self.tail + chunk
+        cut = None
+        for stop_sequence in self.stop_sequences:
+            index = window.find(stop_sequence)
+            if index != -1 and (cut is None or index < cut):
+                cut = index
+        window_start = self.length - len(self.tail)
+        self.length += len(chunk)
+        if cut is not None:
+            return window_start + cut
+        self.tail = window[-self.overlap:] if self.overlap else str()
+        return None
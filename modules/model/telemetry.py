@@ -0,0 +1,129 @@
+from dataclasses import dataclass, asdict, fields
+from contextvars import ContextVar
+from modules.log import Logger, RunContext
+import threading
+import json
+
+__all__ = ("GenerationStats", "Telemetry")
+
+
+@dataclass
+class GenerationStats:
+    model: str
+    # Client-side timings in seconds, the time to first token is None if nothing was generated.
+    latency: float = 0.0
+    ttft: float | None = None
+    round_trips: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    # Timings reported by the backend, if it reports them.
+    prompt_tokens: int = 0
+    prompt_ms: float = 0.0
+    predicted_tokens: int = 0
+    predicted_ms: float = 0.0
+
+
+class Telemetry:
+    # The generation being measured by the current thread or task.
+    _current: ContextVar[GenerationStats | None] = ContextVar("generation_stats", default=None)
+    _lock = threading.Lock()
+    _records: list[tuple[str, str, GenerationStats]] = []
+
+    @classmethod
+    def start(cls, model: str) -> tuple[GenerationStats, GenerationStats | None]:
+        stats = GenerationStats(model)
+        previous = cls._current.get()
+        cls._current.set(stats)
+        return stats, previous
+
+    @classmethod
+    def finish(cls, stats: GenerationStats, previous: GenerationStats | None):
+        cls._current.set(previous)
+        context = RunContext.get()
+        suite = context.get("suite", "")
+        if context.get("cell"):
+            # Keep the cells of a preset/format matrix apart.
+            suite = f"{context['cell']}: {suite}"
+        with cls._lock:
+            cls._records.append((suite, context.get("test", ""), stats))
+        Logger.record("generation", **asdict(stats))
+
+    @classmethod
+    def add_request(cls, bytes_sent: int):
+        if (stats := cls._current.get()) is not None:
+            stats.round_trips += 1
+            stats.bytes_sent += bytes_sent
+
+    @classmethod
+    def add_response(cls, bytes_received: int):
+        if (stats := cls._current.get()) is not None:
+            stats.bytes_received += bytes_received
+
+    @classmethod
+    def add_server_timings(cls, prompt_tokens: int = 0, prompt_ms: float = 0.0, predicted_tokens: int = 0, predicted_ms: float = 0.0):
+        if (stats := cls._current.get()) is not None:
+            stats.prompt_tokens += prompt_tokens
+            stats.prompt_ms += prompt_ms
+            stats.predicted_tokens += predicted_tokens
+            stats.predicted_ms += predicted_ms
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._records.clear()
+
+    @staticmethod
+    def rollup(records: list[GenerationStats]) -> dict:
+        totals = {field.name: sum(getattr(stats, field.name) or 0 for stats in records) for field in fields(GenerationStats) if field.name != "model"}
+        first_tokens = [stats.ttft for stats in records if stats.ttft is not None]
+        return {
+            "generations": len(records),
+            **totals,
+            "avg_latency": totals["latency"] / len(records) if records else 0,
+            "avg_ttft": sum(first_tokens) / len(first_tokens) if first_tokens else None,
+            "prompt_tokens_per_second": totals["prompt_tokens"] / totals["prompt_ms"] * 1000 if totals["prompt_ms"] else None,
+            "tokens_per_second": totals["predicted_tokens"] / totals["predicted_ms"] * 1000 if totals["predicted_ms"] else None,
+        }
+
+    @classmethod
+    def summary(cls) -> dict:
+        """
+        Rolls up the recorded generations per model, and then per run, per suite and per test.
+        """
+        with cls._lock:
+            records = list(cls._records)
+
+        summary: dict = {}
+        for model in sorted({stats.model for _, _, stats in records}):
+            model_records = [(suite, test, stats) for suite, test, stats in records if stats.model == model]
+            suites: dict = {}
+            for suite in dict.fromkeys(suite for suite, _, _ in model_records):
+                suite_records = [(test, stats) for record_suite, test, stats in model_records if record_suite == suite]
+                tests = {test: cls.rollup([stats for record_test, stats in suite_records if record_test == test]) for test in dict.fromkeys(test for test, _ in suite_records)}
+                suites[suite] = {**cls.rollup([stats for _, stats in suite_records]), "tests": tests}
+            summary[model] = {**cls.rollup([stats for _, _, stats in model_records]), "suites": suites}
+        return summary
+
+    @classmethod
+    def log_summary(cls):
+        def format_value(value: float | None, scale: float = 1.0, precision: int = 2) -> str:
+            return "-" if value is None else f"{value * scale:.{precision}f}"
+
+        rows = []
+        for model, run in cls.summary().items():
+            for suite, rollup in run["suites"].items():
+                rows.append((model, suite or "-", rollup))
+            rows.append((model, "Total", run))
+        if not rows:
+            return
+
+        width = max(len(suite) for _, suite, _ in rows)
+        Logger.log(f"\n{'Model':<10} {'Suite':<{width}} {'Gens':>6} {'Latency (s)':>11} {'TTFT (s)':>9} {'Trips':>6} {'KB sent':>8} {'Prompt t/s':>10} {'Gen t/s':>8}")
+        for model, suite, rollup in rows:
+            Logger.log(f"{model:<10} {suite:<{width}} {rollup['generations']:>6} {format_value(rollup['avg_latency']):>11} {format_value(rollup['avg_ttft']):>9} "
+                       f"{rollup['round_trips']:>6} {format_value(rollup['bytes_sent'], 1 / 1024, 1):>8} {format_value(rollup['prompt_tokens_per_second'], 1, 1):>10} {format_value(rollup['tokens_per_second'], 1, 1):>8}")
+
+    @classmethod
+    def save(cls, file_path: str):
+        with open(file_path, "w", encoding='utf-8') as file:
+            json.dump(cls.summary(), file, indent=4)
@@ -1,14 +1,51 @@
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from . import LanguageModel
+from .model import BackendError
 from sentencepiece import SentencePieceProcessor
+import functools
+import abc
 
-__all__ = ('LlamaTokenizer',)
+__all__ = ('Tokenizer', 'LlamaTokenizer', 'BackendTokenizer',)
 
 
-class LlamaTokenizer:
+class Tokenizer(abc.ABC):
+    cache_size = 4096
+
     def __init__(self):
+        # The same texts (card, example chats, chat log messages) are counted on every pass.
+        self.count_tokens = functools.lru_cache(maxsize=self.cache_size)(self._count_tokens)
+
+    @abc.abstractmethod
+    def _count_tokens(self, text: str) -> int:
+        return 0
+
+
+class LlamaTokenizer(Tokenizer):
+    def __init__(self, model_file: str | None = None):
+        super().__init__()
         self.tokenizer = SentencePieceProcessor()
+        if model_file is not None:
+            self.tokenizer.Load(model_file)
 
     def encode(self, text: str) -> list[int]:
         return self.tokenizer.Encode(text)
 
     def decode(self, ids: list[int]) -> str:
-        return self.tokenizer.Decode(ids)
\ No newline at end of file
+        return self.tokenizer.Decode(ids)
+
+    def _count_tokens(self, text: str) -> int:
+        return len(self.encode(text))
+
+
+class BackendTokenizer(Tokenizer):
+    def __init__(self, model: 'LanguageModel'):
+        super().__init__()
+        self.model = model
+
+    def _count_tokens(self, text: str) -> int:
+        token_count = self.model.count_tokens(text)
+        if token_count is None:
+            # Like a failed generation, this interrupts the run so it can be resumed once the backend works.
+            raise BackendError(f"{self.model.get_identifier()} couldn't count the tokens of the text.")
+        return token_count
\ No newline at end of file
@@ -0,0 +1 @@
+from .manager import BackendProcess, ProcessManager
\ No newline at end of file
@@ -0,0 +1,165 @@
+from logging.handlers import RotatingFileHandler
+import urllib.request
+import urllib.error
+import subprocess
+import threading
+import logging
+import shlex
+import json
+import time
+import os
+
+__all__ = ("BackendProcess", "ProcessManager")
+
+
+class BackendProcess:
+    # Endpoints that only answer successfully once the model is loaded.
+    readiness_paths = {
+        "koboldcpp": "/api/v1/model",
+        "llamacpp": "/health",
+        "ooba": "/api/v1/model",
+    }
+
+    def __init__(self, key: tuple, model_backend: str, run_command: str, cwd: str, port: int, context_size: int, thread_number: int, memory: float, log_file: str):
+        self.key = key
+        self.model_backend = model_backend
+        self.run_command = run_command
+        self.cwd = cwd
+        self.port = port
+        self.context_size = context_size
+        self.thread_number = thread_number
+        self.memory = memory
+        self.log_file = log_file
+        self.users = 0
+        self.process: subprocess.Popen | None = None
+        self.ready = threading.Event()
+        self._ready_lock = threading.Lock()
+
+    @property
+    def host(self) -> str:
+        return f"127.0.0.1:{self.port}"
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        args = self.run_command if os.name == "nt" else shlex.split(self.run_command)
+        self.process = subprocess.Popen(args, cwd=self.cwd, shell=False, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        threading.Thread(target=self._capture_output, args=(self.process,), daemon=True).start()
+
+    def _capture_output(self, process: subprocess.Popen):
+        # The servers are chatty while loading, so their output goes to rotating files instead of the console.
+        handler = RotatingFileHandler(self.log_file, maxBytes=10 << 20, backupCount=3, encoding='utf-8')
+        handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+        try:
+            for line in iter(process.stdout.readline, b''):  # type: ignore
+                handler.emit(logging.makeLogRecord({"msg": line.decode('utf-8', errors='replace').rstrip()}))
+        finally:
+            handler.close()
+
+    def probe(self) -> bool:
+        path = self.readiness_paths.get(self.model_backend, "/")
+        try:
+            with urllib.request.urlopen(f"http://{self.host}{path}", timeout=5) as response:
+                if self.model_backend == "ooba":
+                    # ooba answers before a model is loaded.
+                    return json.loads(response.read()).get("result", "None") not in ("None", "")
+                return True
+        except urllib.error.HTTPError as e:
+            # Older llama.cpp servers have no health endpoint, but they only listen once the model is loaded.
+            return self.model_backend == "llamacpp" and e.code == 404
+        except Exception:
+            return False
+
+    def wait_ready(self, timeout: float, backoff_base: float = 0.1, backoff_max: float = 2.0) -> bool:
+        with self._ready_lock:
+            if self.ready.is_set():
+                return self.alive
+            deadline = time.time() + timeout
+            delay = backoff_base
+            while self.alive and time.time() < deadline:
+                if self.probe():
+                    self.ready.set()
+                    return True
+                time.sleep(min(delay, max(deadline - time.time(), 0)))
+                delay = min(delay * 2, backoff_max)
+            return False
+
+    def stop(self):
+        if self.alive:
+            self.process.terminate()  # type: ignore
+            try:
+                self.process.wait(timeout=30)  # type: ignore
+            except subprocess.TimeoutExpired:
+                self.process.kill()  # type: ignore
+                self.process.wait()  # type: ignore
+
+
+class ProcessManager:
+    """
+    Starts the backend servers of the test plan and keeps them running, so the items that only differ
+    in the prompt format or preset (or that use the same model as main and auxiliary model) share them.
+    """
+    def __init__(self, log_folder: str = "logs/backends", base_port: int = 5000, startup_timeout: float = 600.0):
+        self.log_folder = log_folder
+        self.base_port = base_port
+        self.startup_timeout = startup_timeout
+        self.processes: list[BackendProcess] = []
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def make_key(model_backend: str, model_backend_path: str, model_path: str, thread_number: int, backend_args: str) -> tuple:
+        return (model_backend, os.path.realpath(model_backend_path), os.path.realpath(model_path), thread_number, backend_args.strip())
+
+    def find(self, key: tuple, context_size: int) -> BackendProcess | None:
+        # A server with a larger context can also serve the requests that need a smaller one.
+        with self.lock:
+            return next((process for process in self.processes if process.key == key and process.alive and process.context_size >= context_size), None)
+
+    def next_port(self) -> int:
+        # Every server gets a block of ports, as ooba also listens on the port + 5 for streaming.
+        with self.lock:
+            used_ports = {process.port for process in self.processes if process.alive}
+            port = self.base_port
+            while port in used_ports:
+                port += 10
+            return port
+
+    def acquire(self, key: tuple, model_backend: str, run_command_factory, cwd: str, context_size: int, thread_number: int, memory: float) -> BackendProcess:
+        with self.lock:
+            process = self.find(key, context_size)
+            if process is None:
+                port = self.next_port()
+                os.makedirs(self.log_folder, exist_ok=True)
+                log_file = os.path.join(self.log_folder, f"{model_backend}_{port}.log")
+                process = BackendProcess(key, model_backend, run_command_factory(port), cwd, port, context_size, thread_number, memory, log_file)
+                process.start()
+                self.processes.append(process)
+            process.users += 1
+            return process
+
+    def release(self, process: BackendProcess):
+        with self.lock:
+            process.users -= 1
+
+    def used_threads(self) -> int:
+        with self.lock:
+            return sum(process.thread_number for process in self.processes if process.alive)
+
+    def used_memory(self) -> float:
+        with self.lock:
+            return sum(process.memory for process in self.processes if process.alive)
+
+    def stop_idle(self, keep: tuple = ()):
+        with self.lock:
+            idle = [process for process in self.processes if process.users == 0 and process.key not in keep]
+            self.processes = [process for process in self.processes if process not in idle and process.alive]
+        for process in idle:
+            process.stop()
+
+    def stop_all(self):
+        with self.lock:
+            processes, self.processes = self.processes, []
+        for process in processes:
+            process.stop()
@@ -1,3 +1,5 @@
 from .character_card import CharacterCard
 from .chat_log import ChatMessage, ChatLog
-from .prompt import Prompt
\ No newline at end of file
+from .prompt import Prompt, replace_names
+from .template import PromptTemplate
+from .asset_store import AssetStore
\ No newline at end of file
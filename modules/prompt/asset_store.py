@@ -0,0 +1,46 @@
+from .character_card import CharacterCard
+from .chat_log import ChatLog
+import threading
+import os
+
+__all__ = ("AssetStore",)
+
+
+class AssetStore:
+    # The loaded assets keyed by path, along with the modification time of the file they were loaded from.
+    _cards: dict[str, tuple[int, CharacterCard]] = {}
+    _chat_logs: dict[tuple[str, str], tuple[int, ChatLog]] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def load_card(cls, file_path: str) -> CharacterCard:
+        path = os.path.abspath(file_path)
+        mtime = os.stat(path).st_mtime_ns
+        with cls._lock:
+            cached = cls._cards.get(path)
+            if cached is None or cached[0] != mtime:
+                card = CharacterCard()
+                card.load(path)
+                cached = (mtime, card.freeze())
+                cls._cards[path] = cached
+            return cached[1]
+
+    @classmethod
+    def load_chat_log(cls, file_path: str, card: CharacterCard) -> ChatLog:
+        # Text logs tell the user and character messages apart by the character name.
+        key = (os.path.abspath(file_path), card.name)
+        mtime = os.stat(key[0]).st_mtime_ns
+        with cls._lock:
+            cached = cls._chat_logs.get(key)
+            if cached is None or cached[0] != mtime:
+                log = ChatLog(card)
+                log.load(key[0])
+                cached = (mtime, log.freeze())
+                cls._chat_logs[key] = cached
+            return cached[1]
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._cards.clear()
+            cls._chat_logs.clear()
\ No newline at end of file
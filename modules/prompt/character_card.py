@@ -17,6 +17,18 @@ class CharacterCard:
         self.description = str()
         self.greeting: ChatMessage
         self.example_messages: list[ChatLog] = []
+        self.frozen = False
+
+    def __setattr__(self, name: str, value):
+        if getattr(self, "frozen", False):
+            raise AttributeError("The character card is read-only.")
+        super().__setattr__(name, value)
+
+    def freeze(self) -> 'CharacterCard':
+        # Frozen cards are shared between tests, so they must not change anymore.
+        self.example_messages = tuple(log.freeze() for log in self.example_messages)  # type: ignore
+        self.frozen = True
+        return self
 
     def read_json(self, json: dict):
         self.name = json["name"].strip()
@@ -1,17 +1,20 @@
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from . import CharacterCard
+    from modules.model import Tokenizer
 import json
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from .prompt import replace_names
 
 __all__ = ("ChatMessage", "ChatLog",)
 
 
-@dataclass
+@dataclass(frozen=True)
 class ChatMessage:
     sender: str
     is_user: bool
     message: str
+    _token_counts: dict = field(default_factory=dict, init=False, repr=False, compare=False)
 
     def __repr__(self) -> str:
         return f"{self.sender}: {self.message}"
@@ -19,10 +22,17 @@ class ChatMessage:
     def to_string(self, msg_format: str) -> str:
         return msg_format.format(name=self.sender, maybe_space=" " if self.message else "", msg=self.message)
 
+    def count_tokens(self, tokenizer: 'Tokenizer', msg_format: str, char_name: str, user_name: str) -> int:
+        key = (tokenizer, msg_format, char_name, user_name)
+        if key not in self._token_counts:
+            self._token_counts[key] = tokenizer.count_tokens(replace_names(self.to_string(msg_format), char_name, user_name))
+        return self._token_counts[key]
+
 class ChatLog:
     def __init__(self, character: 'CharacterCard'):
         self.character = character
         self.entries: list[ChatMessage] = []
+        self.frozen = False
 
     def __repr__(self) -> str:
         return repr("\n".join([str(entry) for entry in self.entries]))
@@ -62,15 +72,31 @@ class ChatLog:
                 continue
             self.entries.append(ChatMessage(entry['name'], entry['is_user'], entry['mes']))
 
+    def freeze(self) -> 'ChatLog':
+        # Frozen logs are shared between tests, so they must not change anymore.
+        self.entries = tuple(self.entries)  # type: ignore
+        self.frozen = True
+        return self
+
+    def copy(self) -> 'ChatLog':
+        # The messages are immutable, so the copy can share them with the original log.
+        log = ChatLog(self.character)
+        log.entries = list(self.entries)
+        return log
+
     def add_message(self, sender: str, message: str, is_user: bool | None = None):
+        if self.frozen:
+            raise ValueError("The chat log is read-only, add the messages to a copy of it.")
         self.entries.append(ChatMessage(sender, is_user if is_user else sender != self.character.name and sender != "{{char}}", message))
 
     def add_messages(self, log: 'ChatLog'):
+        if self.frozen:
+            raise ValueError("The chat log is read-only, add the messages to a copy of it.")
         self.entries.extend(log.entries)
 
-    def to_string(self, user_msg_format: str, char_msg_format: str) -> str:
+    def to_string(self, user_msg_format: str, char_msg_format: str, start: int = 0) -> str:
         result = str()
-        for entry in self.entries:
+        for entry in self.entries[start:]:
             result += entry.to_string(user_msg_format if entry.is_user else char_msg_format)
         return result
 
@@ -1,6 +1,13 @@
 import abc
+import re
 
-__all__ = ("Prompt",)
+__all__ = ("Prompt", "replace_names",)
+
+_names_pattern = re.compile(r"\{\{char\}\}|<BOT>|\{\{user\}\}|<USER>")
+
+
+def replace_names(text: str, char_name: str, user_name: str) -> str:
+    return _names_pattern.sub(lambda match: user_name if match[0] in ("{{user}}", "<USER>") else char_name, text)
 
 
 class Prompt(abc.ABC):
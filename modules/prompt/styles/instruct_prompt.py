@@ -12,6 +12,8 @@ class ExchangeItem:
 class InstructPrompt(Prompt):
     def __init__(self, format: dict):
         self.exchange: list[ExchangeItem] = []
+        # There are no names to substitute in, so the stop sequences that need them are left out.
+        self.stop_sequences = tuple(s for s in format["stop_sequences"] if "{{char}}" not in s and "{{user}}" not in s)
         super().__init__(format)
 
     def init(self):
@@ -23,6 +25,11 @@ class InstructPrompt(Prompt):
     def add_question(self, text, question):
         self.exchange.append(ExchangeItem(False, f"Read the following message:\n{text.strip()}\n\nQuestion: {question}"))
 
+    def add_judge_question(self, text, question, labels):
+        # The question is followed by the labels the answer must be one of.
+        choices = f"{', '.join(labels[:-1])} or {labels[-1]}" if len(labels) > 1 else labels[0]
+        self.add_question(text, f"{question} Answer with {choices}.")
+
     def add_response(self, text):
         self.exchange.append(ExchangeItem(True, text))
 
@@ -1,26 +1,41 @@
-from modules.prompt import CharacterCard, ChatLog, Prompt
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from modules.model import Tokenizer
+from modules.prompt import AssetStore, CharacterCard, ChatLog, Prompt, PromptTemplate
+from modules.log import Logger
 
 __all__ = ("RoleplayPrompt",)
 
 
 class RoleplayPrompt(Prompt):
-    def __init__(self, format: dict):
+    # The last messages hold what the test is about, so they're never dropped to fit the budget.
+    min_kept_messages = 2
+
+    def __init__(self, format: dict, tokenizer: 'Tokenizer | None' = None):
         self.user_name = str()
         self.card: CharacterCard
         self.chat_log: ChatLog
+        self.tokenizer = tokenizer
+        self.template = PromptTemplate.compile(format)
+        # The rendered messages of the chat log, rendered as the messages are added.
+        self._rendered_log: ChatLog | None = None
+        self._rendered_messages: list[str] = []
         super().__init__(format)
 
     def init(self, user_name: str, card: CharacterCard, add_greeting: bool = True):
         self.user_name = user_name
         self.card = card
         self.chat_log = ChatLog(card)
+        self._rendered_log = None
         if add_greeting:
             self.add_message(self.card.greeting.sender, self.card.greeting.message)
 
+    @property
+    def stop_sequences(self) -> tuple[str, ...]:
+        return self.template.stop_sequences(self.card.name, self.user_name)
+
     def add_messages_from_file(self, file_path: str):
-        log = ChatLog(self.card)
-        log.load(file_path)
-        self.add_messages(log)
+        self.add_messages(AssetStore.load_chat_log(file_path, self.card))
 
     def add_messages(self, log: ChatLog):
         self.chat_log.add_messages(log)
@@ -28,17 +43,37 @@ class RoleplayPrompt(Prompt):
     def add_message(self, sender: str, msg: str, is_user: bool | None = None):
         self.chat_log.add_message(sender, msg, is_user)
 
-    def to_string(self) -> str:
-        value: str = self.format["system"]
-        value += self.card.to_string(self.format)
-        value += self.format["new_chat"]
-        value += self.chat_log.to_string(self.format["user_msg"], self.format["char_msg"])
-        value = value.replace("\r\n", "\n")
+    def _render_messages(self) -> list[str]:
+        entries = self.chat_log.entries
+        if self._rendered_log is not self.chat_log or len(self._rendered_messages) > len(entries):
+            self._rendered_log = self.chat_log
+            self._rendered_messages = []
+        for entry in entries[len(self._rendered_messages):]:
+            self._rendered_messages.append(self.template.render_message(entry, self.card.name, self.user_name))
+        return self._rendered_messages
+
+    def _first_message_in_budget(self, header: str, max_tokens: int) -> int:
+        assert(self.tokenizer is not None)
+        used_tokens = self.tokenizer.count_tokens(header)
+
+        # Keep the newest messages that fit, dropping the oldest ones.
+        entries = self.chat_log.entries
+        first_kept = len(entries)
+        for index in range(len(entries) - 1, -1, -1):
+            entry = entries[index]
+            token_count = entry.count_tokens(self.tokenizer, self.format["user_msg" if entry.is_user else "char_msg"], self.card.name, self.user_name)
+            if used_tokens + token_count > max_tokens and index < len(entries) - self.min_kept_messages:
+                break
+            used_tokens += token_count
+            first_kept = index
 
-        # Merge consecutive linebreaks into one to mimic the simple-proxy behavior
-        replaced_value = value.replace("\n\n", "\n")
-        while replaced_value != value:
-            value = replaced_value
-            replaced_value = value.replace("\n\n", "\n")
+        if first_kept > 0:
+            Logger.log(f"Dropped the {first_kept} oldest chat messages to fit the prompt in {max_tokens} tokens.", True)
+        return first_kept
 
-        return value.replace("{{char}}", self.card.name).replace("<BOT>", self.card.name).replace("{{user}}", self.user_name).replace("<USER>", self.user_name)
\ No newline at end of file
+    def to_string(self, max_tokens: int | None = None) -> str:
+        header = self.template.render_header(self.card, self.user_name)
+        messages = self._render_messages()
+        if max_tokens is not None and self.tokenizer is not None:
+            messages = messages[self._first_message_in_budget(header, max_tokens):]
+        return PromptTemplate.join([header, *messages])
\ No newline at end of file
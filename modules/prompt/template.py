@@ -0,0 +1,72 @@
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from . import CharacterCard, ChatMessage
+from .prompt import replace_names
+import threading
+import weakref
+import json
+import re
+
+__all__ = ("PromptTemplate",)
+
+
+class PromptTemplate:
+    _compiled: dict[str, 'PromptTemplate'] = {}
+    _compiled_lock = threading.Lock()
+    _linebreaks_pattern = re.compile(r"\n{2,}")
+
+    def __init__(self, format: dict):
+        self.format = format
+        self.system = format["system"]
+        self.new_chat = format["new_chat"]
+        self.user_msg = format["user_msg"]
+        self.char_msg = format["char_msg"]
+        # The rendered header (system prompt, card and example chats) per card and user name.
+        self._headers: weakref.WeakKeyDictionary['CharacterCard', dict[str, str]] = weakref.WeakKeyDictionary()
+        self._headers_lock = threading.Lock()
+        # The stop sequences with the names substituted, per character and user name.
+        self._stop_sequences: dict[tuple[str, str], tuple[str, ...]] = {}
+
+    @classmethod
+    def compile(cls, format: dict) -> 'PromptTemplate':
+        key = json.dumps(format, sort_keys=True)
+        with cls._compiled_lock:
+            if key not in cls._compiled:
+                cls._compiled[key] = PromptTemplate(format)
+            return cls._compiled[key]
+
+    @classmethod
+    def normalize(cls, text: str) -> str:
+        # Merge consecutive linebreaks into one to mimic the simple-proxy behavior
+        return cls._linebreaks_pattern.sub("\n", text.replace("\r\n", "\n"))
+
+    @staticmethod
+    def join(pieces: list[str]) -> str:
+        # The pieces are normalized on their own, so only a linebreak at the end of a piece
+        # followed by one at the start of the next can still need to be merged.
+        parts = []
+        ends_with_linebreak = False
+        for piece in pieces:
+            if ends_with_linebreak and piece.startswith("\n"):
+                piece = piece[1:]
+            if piece:
+                parts.append(piece)
+                ends_with_linebreak = piece.endswith("\n")
+        return "".join(parts)
+
+    def render_header(self, card: 'CharacterCard', user_name: str) -> str:
+        with self._headers_lock:
+            headers = self._headers.setdefault(card, {})
+            if user_name not in headers:
+                header = self.system + card.to_string(self.format) + self.new_chat
+                headers[user_name] = replace_names(self.normalize(header), card.name, user_name)
+            return headers[user_name]
+
+    def render_message(self, entry: 'ChatMessage', char_name: str, user_name: str) -> str:
+        return replace_names(self.normalize(entry.to_string(self.user_msg if entry.is_user else self.char_msg)), char_name, user_name)
+
+    def stop_sequences(self, char_name: str, user_name: str) -> tuple[str, ...]:
+        key = (char_name, user_name)
+        if key not in self._stop_sequences:
+            self._stop_sequences[key] = tuple(replace_names(s, char_name, user_name) for s in self.format["stop_sequences"])
+        return self._stop_sequences[key]
@@ -1 +1,7 @@
-from .test_params import TestParams
\ No newline at end of file
+from .test_params import TestParams
+from .stopping import StoppingRule, MajorityRule, SprtRule
+from .ordering import PromptProbe, order_by_prefix
+from .matcher import Matcher, KeywordMatcher, RegexMatcher, NotMatcher, AllOf, AnyOf
+from .scoring import SCORING_MODES, score_keywords
+from .run_store import RunStore, TestRecord
+from .manifest import SuiteInfo, TestManifest
\ No newline at end of file
@@ -3,10 +3,23 @@ from modules.model import *
 from modules.prompt import *
 from modules.prompt.styles import *
 from modules.log import Logger
+from modules.test import TestParams, Matcher, KeywordMatcher, RegexMatcher, NotMatcher, AllOf, score_keywords
 from colorama import Fore
+import os
 
 
-def csv_test(model: LanguageModel, prompt: RoleplayPrompt, card: CharacterCard, log: ChatLog | None, settings: dict, test_info: dict) -> bool:
+def split_keywords(value: str) -> list[str]:
+    return [keyword.strip() for keyword in value.split("|") if keyword.strip()]
+
+def create_matcher(match_type: str, value: str) -> Matcher:
+    # "text" looks for the exact text, "keywords" for any of the "|" separated keywords ignoring the case.
+    if match_type == "keywords":
+        return KeywordMatcher(split_keywords(value))
+    if match_type == "regex":
+        return RegexMatcher(value)
+    return KeywordMatcher([value], True)
+
+def csv_test(model: LanguageModel, prompt: RoleplayPrompt, card: CharacterCard, log: ChatLog | None, settings: dict, test_info: dict, scoring: str = "sampling") -> bool | float:
     greeting = True
     if "greeting" in settings:
         greeting = settings["greeting"]
@@ -23,31 +36,42 @@ def csv_test(model: LanguageModel, prompt: RoleplayPrompt, card: CharacterCard,
     prompt.add_message(settings["user"], test_info["message_input"])
     prompt.add_message(card.name, test_info["message_output"])
 
-    for part, output in model.generate_iter(prompt, max_iter=max_iter):
-        if test_info["expected_output"] in output:
-            Logger.log_event("Success", Fore.GREEN, f"\"{test_info['expected_output']}\" found in {repr(part)}", True)
-            return True
-        Logger.log_event("Failure", Fore.RED, f"\"{test_info['expected_output']}\" not found in {repr(part)}", True)
+    match_type = test_info.get("match_type") or "text"
+    # The row may choose its own scoring, the likelihood can only be told for texts and keywords.
+    scoring = test_info.get("scoring") or scoring
+    if match_type in ("text", "keywords") and not test_info.get("rejected_output"):
+        keywords = [test_info["expected_output"]] if match_type == "text" else split_keywords(test_info["expected_output"])
+        if (score := score_keywords(model, prompt, keywords, scoring, match_type == "text")) is not None:
+            return score
+
+    matcher = create_matcher(match_type, test_info["expected_output"])
+    if test_info.get("rejected_output"):
+        matcher = AllOf(matcher, NotMatcher(create_matcher(match_type, test_info["rejected_output"])))
+
+    success, output = matcher.run(model.generate_iter(prompt, max_iter=max_iter))
+    if success:
+        Logger.log_event("Success", Fore.GREEN, f"\"{test_info['expected_output']}\" found in {repr(output)}", True)
+        return True
+    Logger.log_event("Failure", Fore.RED, f"\"{test_info['expected_output']}\" not found in {repr(output)}", True)
     return False
 
-def prepare_csv_test(model: LanguageModel, prompt: RoleplayPrompt, csv_info: dict) -> list[tuple[str, Callable]]:
+def prepare_csv_test(params: TestParams, csv_info: dict) -> list[tuple[str, Callable]]:
     settings = csv_info["settings"]
     tests = csv_info["tests"]
 
     try:
-        card = CharacterCard()
-        card.load(settings["card"])
+        # The asset paths are relative to the folder of the test suite.
+        card = AssetStore.load_card(os.path.join(csv_info["folder"], settings["card"]))
 
         log = None
         if "log" in settings:
-            log = ChatLog(card)
-            log.load(settings["log"])
+            log = AssetStore.load_chat_log(os.path.join(csv_info["folder"], settings["log"]), card)
     except:
         Logger.log_event("Error", Fore.RED, "Failed to load test suite.")
         return []
 
     # https://stackoverflow.com/a/2295368
     def create_test(test_info):
-        return lambda: csv_test(model, prompt, card, log, settings, test_info)
+        return lambda: csv_test(params.model, params.prompt, card, log, settings, test_info, params.scoring)
 
     return [(test_info["description"], create_test(test_info)) for test_info in tests]
\ No newline at end of file
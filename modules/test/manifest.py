@@ -0,0 +1,107 @@
+from dataclasses import dataclass, asdict
+import threading
+import glob
+import json
+import ast
+import csv
+import os
+
+__all__ = ("SuiteInfo", "TestManifest",)
+
+
+@dataclass
+class SuiteInfo:
+    path: str
+    canonical_name: str
+    name: str
+    # The test descriptions, or None if they're only known once the suite is prepared.
+    tests: list[str] | None
+
+    def matches(self, suite_name: str | None, test_name: str | None) -> bool:
+        if suite_name and suite_name.lower() not in (self.name.lower(), self.canonical_name.lower()):
+            return False
+        if test_name and self.tests is not None:
+            return any(test.lower() == test_name.lower() for test in self.tests)
+        return True
+
+
+class TestManifest:
+    """
+    Lists the test suites and their tests without importing or preparing them. The test
+    descriptions are read from the CSV rows and from the `prepare_test` source of the Python
+    suites, and cached per file until the file is modified.
+    """
+    cache_file = "cache/test_manifest.json"
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _suite_names(path: str) -> tuple[str, str]:
+        canonical_name = os.path.splitext(os.path.basename(path))[0]
+        return canonical_name, ' '.join(word.capitalize() for word in canonical_name.split('_'))
+
+    @staticmethod
+    def _literal_string(node: ast.expr) -> str | None:
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            return node.value
+        # f-strings without placeholders are used for some descriptions.
+        if isinstance(node, ast.JoinedStr) and all(isinstance(value, ast.Constant) for value in node.values):
+            return "".join(value.value for value in node.values)  # type: ignore
+        return None
+
+    @classmethod
+    def read_script(cls, path: str) -> SuiteInfo | None:
+        with open(path, "r", encoding='utf-8') as file:
+            tree = ast.parse(file.read(), path)
+
+        prepare = next((node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name == "prepare_test"), None)
+        if prepare is None:
+            return None
+
+        tests: list[str] | None = None
+        returns = [node for node in ast.walk(prepare) if isinstance(node, ast.Return)]
+        if len(returns) == 1 and isinstance(returns[0].value, (ast.List, ast.Tuple)):
+            tests = []
+            for item in returns[0].value.elts:
+                description = cls._literal_string(item.elts[0]) if isinstance(item, ast.Tuple) and item.elts else None
+                if description is None:
+                    # The tests are built at runtime, they're only known once the suite is prepared.
+                    tests = None
+                    break
+                tests.append(description)
+        return SuiteInfo(path, *cls._suite_names(path), tests)
+
+    @classmethod
+    def read_csv(cls, path: str) -> SuiteInfo:
+        with open(path, "r") as file:
+            tests = [row["description"] for row in csv.DictReader(file)]
+        return SuiteInfo(path, *cls._suite_names(path), tests)
+
+    @classmethod
+    def load(cls, patterns: list[str]) -> list[SuiteInfo]:
+        with cls._lock:
+            try:
+                with open(cls.cache_file, "r", encoding='utf-8') as file:
+                    cache = json.load(file)
+            except (OSError, ValueError):
+                cache = {}
+
+            suites = []
+            updated_cache = {}
+            for pattern in patterns:
+                for path in glob.glob(pattern):
+                    mtime = os.stat(path).st_mtime_ns
+                    entry = cache.get(path)
+                    if entry is None or entry["mtime"] != mtime:
+                        suite = cls.read_csv(path) if path.endswith(".csv") else cls.read_script(path)
+                        entry = {"mtime": mtime, "suite": asdict(suite) if suite is not None else None}
+                    updated_cache[path] = entry
+                    if entry["suite"] is not None:
+                        suites.append(SuiteInfo(**entry["suite"]))
+
+            if updated_cache != cache:
+                folder = os.path.dirname(cls.cache_file)
+                if folder and not os.path.exists(folder):
+                    os.makedirs(folder)
+                with open(cls.cache_file, "w", encoding='utf-8') as file:
+                    json.dump(updated_cache, file, indent=4)
+            return suites
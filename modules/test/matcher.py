@@ -0,0 +1,184 @@
+from typing import Iterable
+import threading
+import abc
+import re
+
+__all__ = ("Matcher", "KeywordMatcher", "RegexMatcher", "NotMatcher", "AllOf", "AnyOf",)
+
+
+class KeywordAutomaton:
+    # Aho-Corasick automaton, finds any of the keywords in a single pass over the text.
+    def __init__(self, keywords: Iterable[str]):
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        self.accepting: list[bool] = [False]
+
+        for keyword in keywords:
+            state = 0
+            for char in keyword:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.accepting.append(False)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.accepting[state] = True
+
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.accepting[next_state] = self.accepting[next_state] or self.accepting[self.fail[next_state]]
+
+    def step(self, state: int, char: str) -> int:
+        while state and char not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(char, 0)
+
+
+class Matcher(abc.ABC):
+    """
+    Checks a generation chunk by chunk. `feed` returns True/False as soon as the output is
+    accepted/rejected no matter what comes after, or None while it's still undecided.
+    """
+    @abc.abstractmethod
+    def feed(self, chunk: str) -> bool | None:
+        return None
+
+    # The decision once the generation is over.
+    @abc.abstractmethod
+    def finish(self) -> bool:
+        return False
+
+    def match(self, text: str) -> bool:
+        decision = self.feed(text)
+        return decision if decision is not None else self.finish()
+
+    def run(self, chunks: Iterable[tuple[str, str]]) -> tuple[bool, str]:
+        """
+        Consumes the (chunk, output) pairs of `LanguageModel.generate_iter`, stopping the
+        generation as soon as the outcome is certain. Returns the decision and the output.
+        """
+        output = str()
+        for chunk, output in chunks:
+            decision = self.feed(chunk)
+            if decision is not None:
+                return decision, output
+        return self.finish(), output
+
+
+class KeywordMatcher(Matcher):
+    _automatons: dict[tuple[str, ...], KeywordAutomaton] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, keywords: Iterable[str], case_sensitive: bool = False):
+        self.case_sensitive = case_sensitive
+        key = tuple(keywords if case_sensitive else (keyword.lower() for keyword in keywords))
+        with KeywordMatcher._lock:
+            if key not in KeywordMatcher._automatons:
+                KeywordMatcher._automatons[key] = KeywordAutomaton(key)
+            self.automaton = KeywordMatcher._automatons[key]
+        self.state = 0
+        self.found = False
+
+    def feed(self, chunk: str) -> bool | None:
+        if self.found:
+            return True
+        # Only the new chunk is scanned, the automaton state carries the keywords cut between chunks.
+        if not self.case_sensitive:
+            chunk = chunk.lower()
+        automaton = self.automaton
+        state = self.state
+        for char in chunk:
+            state = automaton.step(state, char)
+            if automaton.accepting[state]:
+                self.found = True
+                return True
+        self.state = state
+        return None
+
+    def finish(self) -> bool:
+        return self.found
+
+
+class RegexMatcher(Matcher):
+    def __init__(self, pattern: str, flags: int = re.IGNORECASE, max_span: int | None = None, at_end: bool = False):
+        """
+        `max_span` is the longest text the pattern can match, which lets the search skip the output
+        that was already searched. Patterns anchored to the end of the output must use `at_end`.
+        """
+        self.pattern = re.compile(pattern, flags)
+        self.max_span = max_span
+        self.at_end = at_end
+        self.text = str()
+        self.searched = 0
+        self.found = False
+
+    def feed(self, chunk: str) -> bool | None:
+        if self.found:
+            return True
+        self.text += chunk
+        if self.at_end:
+            return None
+        start = max(self.searched - self.max_span, 0) if self.max_span is not None else 0
+        self.searched = len(self.text)
+        if self.pattern.search(self.text, start):
+            self.found = True
+            return True
+        return None
+
+    def finish(self) -> bool:
+        if self.at_end and not self.found:
+            self.found = self.pattern.search(self.text) is not None
+        return self.found
+
+
+class NotMatcher(Matcher):
+    # Decides as soon as the inner matcher does, with the opposite outcome.
+    def __init__(self, matcher: Matcher):
+        self.matcher = matcher
+
+    def feed(self, chunk: str) -> bool | None:
+        decision = self.matcher.feed(chunk)
+        return None if decision is None else not decision
+
+    def finish(self) -> bool:
+        return not self.matcher.finish()
+
+
+class AllOf(Matcher):
+    def __init__(self, *matchers: Matcher):
+        self.matchers = matchers
+        self.decisions: list[bool | None] = [None] * len(matchers)
+
+    def feed(self, chunk: str) -> bool | None:
+        for index, matcher in enumerate(self.matchers):
+            if self.decisions[index] is None:
+                self.decisions[index] = matcher.feed(chunk)
+            if self.decisions[index] is False:
+                return False
+        return True if all(self.decisions) else None
+
+    def finish(self) -> bool:
+        return all(decision if decision is not None else matcher.finish() for decision, matcher in zip(self.decisions, self.matchers))
+
+
+class AnyOf(Matcher):
+    def __init__(self, *matchers: Matcher):
+        self.matchers = matchers
+        self.decisions: list[bool | None] = [None] * len(matchers)
+
+    def feed(self, chunk: str) -> bool | None:
+        for index, matcher in enumerate(self.matchers):
+            if self.decisions[index] is None:
+                self.decisions[index] = matcher.feed(chunk)
+            if self.decisions[index] is True:
+                return True
+        return False if all(decision is False for decision in self.decisions) else None
+
+    def finish(self) -> bool:
+        return any(decision if decision is not None else matcher.finish() for decision, matcher in zip(self.decisions, self.matchers))
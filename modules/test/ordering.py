@@ -0,0 +1,65 @@
+from typing import Callable, Iterator
+from modules.model import LanguageModel
+from modules.prompt import Prompt
+from modules.log import Logger
+from .test_params import TestParams
+
+__all__ = ("PromptProbe", "order_by_prefix",)
+
+
+class _ProbeFinished(Exception):
+    pass
+
+
+class PromptProbe(LanguageModel):
+    # A stand-in model that records the first prompt a test sends and then aborts the test,
+    # so the prompts can be known without generating anything.
+    def __init__(self, max_context: int, auxiliary: bool = False):
+        super().__init__(max_context, auxiliary)
+        self.prompt = str()
+
+    def new_seed(self):
+        # Don't consume the global rng, the seeds of the real passes must stay the same.
+        pass
+
+    def wait(self):
+        pass
+
+    def _generate_once(self, data: dict) -> str:
+        return ""
+
+    def generate_iter(self, prompt: Prompt | str, max_tokens_per_iter: int = 8, max_iter: int = 0xFFFFFFFF, grammar: str | None = None) -> Iterator[tuple[str, str]]:
+        self.prompt = prompt.to_string() if not isinstance(prompt, str) else prompt
+        raise _ProbeFinished()
+
+    def probe(self, test: Callable) -> str:
+        self.prompt = str()
+        try:
+            test()
+        except _ProbeFinished:
+            pass
+        except Exception as e:
+            Logger.log(f"Couldn't probe the prompt of a test: {e}", True)
+        return self.prompt
+
+
+def order_by_prefix(tests: list[tuple[str, Callable]], prepare: Callable[[TestParams], list[tuple[str, Callable]]], params: TestParams, specific_test: str | None = None) -> list[tuple[str, Callable]]:
+    # Only the tests that will run are probed and reordered, the skipped ones keep their place.
+    selected = [index for index, (description, _) in enumerate(tests) if specific_test is None or specific_test.lower() == description.lower()]
+    if len(selected) < 2:
+        return tests
+
+    probe = PromptProbe(params.model.max_context)
+    probe_params = TestParams(probe, params.prompt_format, PromptProbe(params.model.max_context, True) if params.auxiliary_model else None, params.auxiliary_prompt_format)
+    probe_tests = prepare(probe_params)
+    if len(probe_tests) != len(tests):
+        return tests
+
+    # Sorting the prompts lexicographically places the prompts that share the longest prefixes next
+    # to each other, so consecutive requests find that prefix still in the backend's cache. The sort
+    # is stable, so tests with the same prompt keep their relative order.
+    prompts = {index: probe.probe(probe_tests[index][1]) for index in selected}
+    ordered = list(tests)
+    for index, source in zip(selected, sorted(selected, key=lambda index: prompts[index])):
+        ordered[index] = tests[source]
+    return ordered
@@ -0,0 +1,116 @@
+from dataclasses import dataclass, field
+import threading
+import sqlite3
+import json
+import time
+import os
+
+__all__ = ("RunStore", "TestRecord",)
+
+
+@dataclass
+class TestRecord:
+    # The outcome of the test if it was already decided.
+    decision: bool | None = None
+    # The seed and outcome of every started pass by pass index, the outcome is None if the pass
+    # was interrupted before completing. A pass outcome is 1.0 or 0.0, or the score of a scored pass.
+    passes: dict[int, tuple[int, float | None]] = field(default_factory=dict)
+
+
+class RunStore:
+    """
+    Records the outcome of every test pass as soon as it completes, so an interrupted run can be
+    resumed with the same seeds instead of starting over.
+    """
+    def __init__(self, file_path: str, run_id: str):
+        folder = os.path.dirname(file_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.file_path = file_path
+        self.run_id = run_id
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY,
+                settings TEXT NOT NULL,
+                created REAL NOT NULL
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS passes (
+                run_id TEXT NOT NULL,
+                cell TEXT NOT NULL,
+                suite TEXT NOT NULL,
+                test TEXT NOT NULL,
+                pass_index INTEGER NOT NULL,
+                seed INTEGER NOT NULL,
+                outcome REAL,
+                duration REAL,
+                PRIMARY KEY (run_id, cell, suite, test, pass_index)
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS tests (
+                run_id TEXT NOT NULL,
+                cell TEXT NOT NULL,
+                suite TEXT NOT NULL,
+                test TEXT NOT NULL,
+                decision INTEGER NOT NULL,
+                PRIMARY KEY (run_id, cell, suite, test)
+            )
+        """)
+        self.connection.commit()
+
+    @staticmethod
+    def last_run_id(file_path: str) -> str | None:
+        if not os.path.exists(file_path):
+            return None
+        connection = sqlite3.connect(file_path, timeout=30)
+        try:
+            row = connection.execute("SELECT run_id FROM runs ORDER BY created DESC LIMIT 1").fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        finally:
+            connection.close()
+        return row[0] if row is not None else None
+
+    def load_settings(self) -> dict | None:
+        with self.lock:
+            row = self.connection.execute("SELECT settings FROM runs WHERE run_id = ?", (self.run_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def save_settings(self, settings: dict):
+        with self.lock:
+            self.connection.execute("INSERT OR IGNORE INTO runs (run_id, settings, created) VALUES (?, ?, ?)", (self.run_id, json.dumps(settings), time.time()))
+            self.connection.commit()
+
+    def load_test(self, cell: str, suite: str, test: str) -> TestRecord:
+        with self.lock:
+            row = self.connection.execute("SELECT decision FROM tests WHERE run_id = ? AND cell = ? AND suite = ? AND test = ?", (self.run_id, cell, suite, test)).fetchone()
+            rows = self.connection.execute("SELECT pass_index, seed, outcome FROM passes WHERE run_id = ? AND cell = ? AND suite = ? AND test = ? ORDER BY pass_index", (self.run_id, cell, suite, test)).fetchall()
+        return TestRecord(bool(row[0]) if row is not None else None, {index: (seed, float(outcome) if outcome is not None else None) for index, seed, outcome in rows})
+
+    def start_pass(self, cell: str, suite: str, test: str, pass_index: int, seed: int):
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO passes (run_id, cell, suite, test, pass_index, seed) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(run_id, cell, suite, test, pass_index) DO UPDATE SET seed = excluded.seed, outcome = NULL, duration = NULL",
+                (self.run_id, cell, suite, test, pass_index, seed)
+            )
+            self.connection.commit()
+
+    def finish_pass(self, cell: str, suite: str, test: str, pass_index: int, outcome: bool | float, duration: float, decision: bool | None = None):
+        # The pass and the decision it led to are committed together, a resumed run never finds
+        # the last pass of a test without its decision.
+        with self.lock:
+            self.connection.execute("UPDATE passes SET outcome = ?, duration = ? WHERE run_id = ? AND cell = ? AND suite = ? AND test = ? AND pass_index = ?",
+                                    (float(outcome), duration, self.run_id, cell, suite, test, pass_index))
+            if decision is not None:
+                self.connection.execute("INSERT OR REPLACE INTO tests (run_id, cell, suite, test, decision) VALUES (?, ?, ?, ?, ?)", (self.run_id, cell, suite, test, int(decision)))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,24 @@
+from modules.model import LanguageModel
+from modules.prompt import Prompt
+from modules.log import Logger
+from colorama import Fore
+
+__all__ = ("SCORING_MODES", "score_keywords",)
+
+# "sampling" runs passes that sample a generation, "likelihood" scores the expected answer with the
+# token probabilities of the backend in a single pass.
+SCORING_MODES = ("sampling", "likelihood")
+
+
+def score_keywords(model: LanguageModel, prompt: Prompt | str, keywords: list[str], scoring: str, case_sensitive: bool = False) -> float | None:
+    """
+    With the likelihood scoring, returns the probability that the model answers the prompt with any
+    of the keywords, which is the pass rate of the test. Returns None with the sampling scoring, or
+    if the backend can't score, and the test samples a generation as usual.
+    """
+    if scoring != "likelihood":
+        return None
+    score = model.continuation_probability(prompt, keywords, case_sensitive)
+    if score is not None:
+        Logger.log_event("Score", Fore.CYAN, f"{score * 100:.1f}% for {keywords!r}", True)
+    return score
@@ -0,0 +1,49 @@
+import abc
+import math
+
+__all__ = ("StoppingRule", "MajorityRule", "SprtRule",)
+
+
+class StoppingRule(abc.ABC):
+    def __init__(self, max_passes: int):
+        self.max_passes = max_passes
+
+    # Returns True/False once the test passed/failed, or None while it's still undecided.
+    @abc.abstractmethod
+    def decide(self, success_count: int, completed: int) -> bool | None:
+        return None
+
+
+class MajorityRule(StoppingRule):
+    def decide(self, success_count: int, completed: int) -> bool | None:
+        needed = self.max_passes // 2 + 1
+        if success_count >= needed:
+            return True
+        # Stop as soon as the remaining passes can't reach the majority anymore.
+        if success_count + (self.max_passes - completed) < needed:
+            return False
+        return None
+
+
+class SprtRule(StoppingRule):
+    # Wald's sequential probability ratio test between a failing model (H0: p = p0) and a
+    # passing model (H1: p = p1), where p is the success probability of a single pass.
+    def __init__(self, confidence: float, max_passes: int, p0: float = 0.3, p1: float = 0.7):
+        assert(0.5 < confidence < 1)
+        super().__init__(max_passes)
+        error = 1 - confidence
+        self.upper_bound = math.log((1 - error) / error)
+        self.lower_bound = math.log(error / (1 - error))
+        self.success_llr = math.log(p1 / p0)
+        self.failure_llr = math.log((1 - p1) / (1 - p0))
+
+    def decide(self, success_count: int, completed: int) -> bool | None:
+        llr = success_count * self.success_llr + (completed - success_count) * self.failure_llr
+        if llr >= self.upper_bound:
+            return True
+        if llr <= self.lower_bound:
+            return False
+        if completed >= self.max_passes:
+            # The test didn't settle within the allowed passes, fall back to the majority.
+            return success_count * 2 > completed
+        return None
\ No newline at end of file
@@ -1,11 +1,33 @@
-from modules.model import LanguageModel
+from modules.model import LanguageModel, Tokenizer
 from modules.prompt.styles import *
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import threading
 
 
 @dataclass
 class TestParams:
     model: LanguageModel
-    prompt: RoleplayPrompt
+    prompt_format: dict
     auxiliary_model: LanguageModel | None
-    auxiliary_prompt: InstructPrompt | None
\ No newline at end of file
+    auxiliary_prompt_format: dict | None
+    tokenizer: Tokenizer | None = None
+    # How the tests that check for a short expected answer are scored, see `score_keywords`.
+    scoring: str = "sampling"
+    # Results a test keeps for the next tests of the same preset and format, e.g. a reply that can be checked again.
+    shared: dict = field(default_factory=dict, repr=False, compare=False)
+    # Every worker thread gets its own prompts, so concurrent passes don't overwrite each other.
+    _thread_state: threading.local = field(default_factory=threading.local, repr=False, compare=False)
+
+    @property
+    def prompt(self) -> RoleplayPrompt:
+        if not hasattr(self._thread_state, "prompt"):
+            self._thread_state.prompt = RoleplayPrompt(self.prompt_format, self.tokenizer)
+        return self._thread_state.prompt
+
+    @property
+    def auxiliary_prompt(self) -> InstructPrompt | None:
+        if self.auxiliary_prompt_format is None:
+            return None
+        if not hasattr(self._thread_state, "auxiliary_prompt"):
+            self._thread_state.auxiliary_prompt = InstructPrompt(self.auxiliary_prompt_format)
+        return self._thread_state.auxiliary_prompt
\ No newline at end of file
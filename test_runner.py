@@ -1,13 +1,16 @@
 import subprocess
+import argparse
+import threading
 import json
 import signal
 import sys
 import shutil
+import time
 import os
 from dataclasses import dataclass
+from modules.process import BackendProcess, ProcessManager
 
-current_process = None
-current_auxiliary_process = None
+process_manager: ProcessManager | None = None
 
 @dataclass
 class ModelParams:
@@ -27,7 +30,7 @@ def find_program_path(program_name):
 
 def get_run_command(model: ModelParams, context_size: int, thread_number: int, port: int, extra_args: str) -> str:
     if model.model_backend == "ooba":
-        command = f"\"{sys.executable}\" {model.model_backend_path} --model \"{model.model_path}\" --n_ctx {context_size} --max_seq_len {context_size} --compress_pos_emb {context_size // 2048} --threads {thread_number} --api --api-blocking-port {port} {extra_args}"
+        command = f"\"{sys.executable}\" {model.model_backend_path} --model \"{model.model_path}\" --n_ctx {context_size} --max_seq_len {context_size} --compress_pos_emb {context_size // 2048} --threads {thread_number} --api --api-blocking-port {port} --api-streaming-port {port + 5} {extra_args}"
     elif model.model_backend == "koboldcpp":
         command = f"{model.model_backend_path} --model \"{model.model_path}\" --contextsize {context_size} --threads {thread_number} --stream --port {port} {extra_args}"
     elif model.model_backend == "llamacpp":
@@ -36,7 +39,7 @@ def get_run_command(model: ModelParams, context_size: int, thread_number: int, p
         return ""
     return command
 
-def run_python_script(model: ModelParams, auxiliary_model: ModelParams | None, context_size: int, extra_args: str):
+def run_python_script(model: ModelParams, auxiliary_model: ModelParams | None, context_size: int, extra_args: str, quiet: bool = False):
     command = f"\"{sys.executable}\" main.py --backend {model.model_backend} --format {model.model_format} --context {context_size} --preset {model.model_preset} {extra_args}"
 
     if model.model_backend in ["koboldcpp", "llamacpp", "ooba"]:
@@ -52,31 +55,84 @@ def run_python_script(model: ModelParams, auxiliary_model: ModelParams | None, c
         elif auxiliary_model.model_backend == "llamapy":
             command += f" --auxiliary-model {auxiliary_model.model_path}"
 
-    subprocess.run(command, shell=True)
+    # The output of concurrent runs would be interleaved, their results are still saved in the logs folder.
+    subprocess.run(command, shell=True, stdout=subprocess.DEVNULL if quiet else None, stderr=subprocess.DEVNULL if quiet else None)
 
-def exit_gracefully(signum, frame):
-    global current_process
-    if current_process is not None and current_process.poll() is None:
-        current_process.terminate()
-        current_process.wait()
-        current_process = None
-    global current_auxiliary_process
-    if current_auxiliary_process is not None and current_auxiliary_process.poll() is None:
-        current_auxiliary_process.terminate()
-        current_auxiliary_process.wait()
-        current_auxiliary_process = None
-    exit()
+@dataclass
+class ProcessSpec:
+    key: tuple
+    model: ModelParams
+    models: list[ModelParams]
+    context_size: int
+    thread_number: int
+    backend_args: str
+    memory: float
+
+@dataclass
+class PlanItem:
+    index: int
+    model: ModelParams
+    model_backend_args: str
+    auxiliary_model: ModelParams | None
+    auxiliary_model_backend_args: str
+    context_size: int
+    thread_number: int
+    extra_args: str
+    memory: float | None
+
+    @property
+    def name(self) -> str:
+        model_name = os.path.basename(self.model.model_path) if self.model.model_path else self.model.model_backend_host
+        return f"#{self.index + 1} ({model_name}, {self.model.model_format}, {self.model.model_preset})"
+
+    def process_specs(self) -> list[ProcessSpec]:
+        """
+        The backend servers the item needs, the main and auxiliary models share one if they are the same.
+        """
+        specs: list[ProcessSpec] = []
+        models = [(self.model, self.context_size, self.model_backend_args)]
+        if self.auxiliary_model:
+            models.append((self.auxiliary_model, 2048, self.auxiliary_model_backend_args))
+        for model, context_size, backend_args in models:
+            if model.model_backend_host or model.model_backend not in ["koboldcpp", "llamacpp", "ooba"]:
+                continue
+            key = ProcessManager.make_key(model.model_backend, model.model_backend_path, model.model_path, self.thread_number, backend_args)
+            spec = next((spec for spec in specs if spec.key == key), None)
+            if spec is not None:
+                spec.models.append(model)
+                spec.context_size = max(spec.context_size, context_size)
+                continue
+            specs.append(ProcessSpec(key, model, [model], context_size, self.thread_number, backend_args, estimate_memory(model)))
+        if self.memory is not None:
+            for spec in specs:
+                spec.memory = self.memory / len(specs)
+        return specs
+
+    @property
+    def inline_threads(self) -> int:
+        # llama.py runs the models inside the main script.
+        return self.thread_number if any(model and model.model_backend == "llamapy" for model in (self.model, self.auxiliary_model)) else 0
 
-def run_test_plan(test_plan_file):
-    global current_process
-    global current_auxiliary_process
+    @property
+    def inline_memory(self) -> float:
+        if not any(model and model.model_backend == "llamapy" for model in (self.model, self.auxiliary_model)):
+            return 0
+        if self.memory is not None:
+            return self.memory
+        return sum(estimate_memory(model) for model in (self.model, self.auxiliary_model) if model and model.model_backend == "llamapy")
 
+def estimate_memory(model: ModelParams) -> float:
+    # The weights are the bulk of the memory used by a local model, in GB.
+    if model.model_backend_host or not model.model_path or not os.path.exists(model.model_path):
+        return 0
+    return os.path.getsize(model.model_path) / (1 << 30)
+
+def load_test_plan(test_plan_file: str) -> list[PlanItem]:
     with open(test_plan_file, "r") as f:
         test_plan = json.load(f)
 
-    signal.signal(signal.SIGINT, exit_gracefully)
-
-    for item in test_plan:
+    items = []
+    for index, item in enumerate(test_plan):
         model_backend = item["model_backend"]
         if model_backend not in ["koboldcpp", "llamacpp", "llamapy", "ooba"]:
             print(f"Invalid model_backend: {model_backend}")
@@ -90,15 +146,13 @@ def run_test_plan(test_plan_file):
             item["model_format"],
             item.get("model_preset", "default")
         )
-        model_backend_args = item.get("model_backend_args", "")
 
         auxiliary_model_backend = item.get("auxiliary_model_backend", "")
-        auxiliary_model_backend_args = item.get("auxiliary_model_backend_args", "")
 
         auxiliary_model = None
         if auxiliary_model_backend:
-            if model_backend not in ["koboldcpp", "llamacpp", "llamapy", "ooba"]:
-                print(f"Invalid auxiliary_model_backend: {model_backend}")
+            if auxiliary_model_backend not in ["koboldcpp", "llamacpp", "llamapy", "ooba"]:
+                print(f"Invalid auxiliary_model_backend: {auxiliary_model_backend}")
                 continue
 
             auxiliary_model = ModelParams(
@@ -110,50 +164,114 @@ def run_test_plan(test_plan_file):
                 item.get("auxiliary_model_preset", "default")
             )
 
-        context_size = item.get("context_size", 2048)
-        thread_number = item["thread_number"]
-        extra_args = item.get("extra_args", "")
-
-        if not model.model_backend_host:
-            model.model_backend_host = "127.0.0.1:5000"
-            run_command = get_run_command(model, context_size, thread_number, 5000, model_backend_args)
-            if run_command:
-                if current_process is not None and current_process.poll() is None:
-                    # Terminate the current process if the parameters don't match
-                    if current_process.args != run_command:
-                        current_process.terminate()
-                        current_process.wait()
-                        current_process = subprocess.Popen(run_command, cwd=os.path.dirname(os.path.realpath(model.model_backend_path)), shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                else:
-                    current_process = subprocess.Popen(run_command, cwd=os.path.dirname(os.path.realpath(model.model_backend_path)), shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-        if auxiliary_model:
-            if not auxiliary_model.model_backend_host:
-                auxiliary_model.model_backend_host = "127.0.0.1:5001"
-                run_command = get_run_command(auxiliary_model, 2048, thread_number, 5001, auxiliary_model_backend_args)
-                if run_command:
-                    if current_auxiliary_process is not None and current_auxiliary_process.poll() is None:
-                        # Terminate the current process if the parameters don't match
-                        if current_auxiliary_process.args != run_command:
-                            current_auxiliary_process.terminate()
-                            current_auxiliary_process.wait()
-                            current_auxiliary_process = subprocess.Popen(run_command, cwd=os.path.dirname(os.path.realpath(auxiliary_model.model_backend_path)), shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                    else:
-                        current_auxiliary_process = subprocess.Popen(run_command, cwd=os.path.dirname(os.path.realpath(auxiliary_model.model_backend_path)), shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-        run_python_script(model, auxiliary_model, context_size, extra_args)
-
-    # If the script is exiting, terminate the current process
-    if current_process is not None and current_process.poll() is None:
-        current_process.terminate()
-        current_process.wait()
-        current_process = None
-
-    if current_auxiliary_process is not None and current_auxiliary_process.poll() is None:
-        current_auxiliary_process.terminate()
-        current_auxiliary_process.wait()
-        current_auxiliary_process = None
+        items.append(PlanItem(
+            index,
+            model,
+            item.get("model_backend_args", ""),
+            auxiliary_model,
+            item.get("auxiliary_model_backend_args", ""),
+            item.get("context_size", 2048),
+            item["thread_number"],
+            item.get("extra_args", ""),
+            item.get("memory")
+        ))
+
+    return items
+
+def exit_gracefully(signum, frame):
+    if process_manager is not None:
+        process_manager.stop_all()
+    exit()
+
+def run_test_plan(test_plan_file: str, max_lanes: int = 1, thread_budget: int | None = None, memory_budget: float | None = None, base_port: int = 5000, startup_timeout: float = 600.0):
+    global process_manager
+
+    pending = load_test_plan(test_plan_file)
+
+    signal.signal(signal.SIGINT, exit_gracefully)
+
+    manager = process_manager = ProcessManager(base_port=base_port, startup_timeout=startup_timeout)
+    max_lanes = max(max_lanes, 1)
+    quiet = max_lanes > 1
+    running: list[PlanItem] = []
+    finished = threading.Condition()
+
+    def run_item(item: PlanItem, processes: list[BackendProcess]):
+        start_time = time.time()
+        try:
+            for process in processes:
+                if not process.wait_ready(manager.startup_timeout):
+                    print(f"The {process.model_backend} server on port {process.port} didn't load the model, skipping plan item {item.name}. See {process.log_file}.")
+                    return
+            run_python_script(item.model, item.auxiliary_model, item.context_size, item.extra_args, quiet)
+            if quiet:
+                print(f"Finished plan item {item.name} in {int(time.time() - start_time)} seconds.")
+        finally:
+            for process in processes:
+                manager.release(process)
+            with finished:
+                running.remove(item)
+                finished.notify()
+
+    def fits(item: PlanItem) -> bool:
+        new_specs = [spec for spec in item.process_specs() if manager.find(spec.key, spec.context_size) is None]
+        if thread_budget is not None:
+            threads = manager.used_threads() + sum(other.inline_threads for other in running) + sum(spec.thread_number for spec in new_specs) + item.inline_threads
+            if threads > thread_budget:
+                return False
+        if memory_budget is not None:
+            memory = manager.used_memory() + sum(other.inline_memory for other in running) + sum(spec.memory for spec in new_specs) + item.inline_memory
+            if memory > memory_budget:
+                return False
+        return True
+
+    def admit(item: PlanItem) -> bool:
+        if len(running) >= max_lanes:
+            return False
+        if fits(item):
+            return True
+        # Free the servers that no running item uses before giving up.
+        manager.stop_idle(keep=tuple(spec.key for spec in item.process_specs()))
+        # An item larger than the whole budget still runs, alone.
+        return fits(item) or not running
+
+    with finished:
+        while pending or running:
+            # Only keep the idle servers that a pending item can reuse.
+            manager.stop_idle(keep=tuple(spec.key for item in pending for spec in item.process_specs()))
+
+            # Start every pending item that fits, in plan order, letting smaller items fill the gaps.
+            for item in list(pending):
+                if not admit(item):
+                    continue
+                pending.remove(item)
+                running.append(item)
+
+                processes = []
+                for spec in item.process_specs():
+                    process = manager.acquire(spec.key, spec.model.model_backend, lambda port, spec=spec: get_run_command(spec.model, spec.context_size, spec.thread_number, port, spec.backend_args),
+                                              os.path.dirname(os.path.realpath(spec.model.model_backend_path)), spec.context_size, spec.thread_number, spec.memory)
+                    for model in spec.models:
+                        model.model_backend_host = process.host
+                    processes.append(process)
+
+                if quiet:
+                    print(f"Starting plan item {item.name}.")
+                threading.Thread(target=run_item, args=(item, processes), daemon=True).start()
+
+            finished.wait()
+
+    # If the script is exiting, terminate the current processes
+    manager.stop_all()
 
 if __name__ == "__main__":
-    test_plan_file = "test_plan.json"
-    run_test_plan(test_plan_file)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Roleplay Test Framework - Test Plan Runner")
+    parser.add_argument("--test-plan", type=str, default="test_plan.json", help="test plan file (default: test_plan.json)")
+    parser.add_argument("--lanes", type=int, default=1, help="number of plan items that can run at the same time (default: 1)")
+    parser.add_argument("--threads", type=int, help="total number of CPU threads the concurrent plan items can use, summing their thread_number (default: no limit)")
+    parser.add_argument("--memory", type=float, help="total memory in GB the concurrent plan items can use, estimated from the model files or the item \"memory\" field (default: no limit)")
+    parser.add_argument("--base-port", type=int, default=5000, help="first port used for the backend servers started by the runner (default: 5000)")
+    parser.add_argument("--startup-timeout", type=float, default=600, help="seconds to wait for a backend server to load its model (default: 600)")
+    args = parser.parse_args()
+
+    run_test_plan(args.test_plan, args.lanes, args.threads, args.memory, args.base_port, args.startup_timeout)
\ No newline at end of file
@@ -3,64 +3,76 @@ from modules.model import *
 from modules.prompt import *
 from modules.prompt.styles import *
 from modules.log import Logger
-from modules.test import TestParams
+from modules.test import TestParams, KeywordMatcher, score_keywords
 from colorama import Fore
+import os
 
+CHARACTERS_FOLDER = os.path.join(os.path.dirname(__file__), "characters")
 
-def ask_for_age(model: LanguageModel, prompt: RoleplayPrompt, long_context: bool) -> bool:
+
+def ask_for_age(model: LanguageModel, prompt: RoleplayPrompt, long_context: bool, scoring: str = "sampling") -> bool | float:
     model.new_seed()
 
-    card = CharacterCard()
-    card.load("characters/Rin Tohsaka.json")
+    card = AssetStore.load_card(os.path.join(CHARACTERS_FOLDER, "Rin Tohsaka.json"))
 
     prompt.init("Jin", card, not long_context)
     if long_context:
-        prompt.add_messages_from_file("characters/Rin Tohsaka.jsonl")
+        prompt.add_messages_from_file(os.path.join(CHARACTERS_FOLDER, "Rin Tohsaka.jsonl"))
 
     prompt.add_message("Jin", "\"Hey, what is your age?\"")
     prompt.add_message(card.name, "\"Huh, what kind of question is this? I'm")
 
-    result = model.generate(prompt, max_iter=1)
-    if any(word in result.lower() for word in ["18", "eighteen"]):
+    keywords = ["18", "eighteen"]
+    if (score := score_keywords(model, prompt, keywords, scoring)) is not None:
+        return score
+
+    success, result = KeywordMatcher(keywords).run(model.generate_iter(prompt, max_iter=1))
+    if success:
         Logger.log_event("Success", Fore.GREEN, repr(result), True)
         return True
     Logger.log_event("Failure", Fore.RED, repr(result), True)
     return False
 
-def ask_for_eye_color(model: LanguageModel, prompt: RoleplayPrompt, long_context: bool) -> bool:
+def ask_for_eye_color(model: LanguageModel, prompt: RoleplayPrompt, long_context: bool, scoring: str = "sampling") -> bool | float:
     model.new_seed()
 
-    card = CharacterCard()
-    card.load("characters/Rin Tohsaka.json")
+    card = AssetStore.load_card(os.path.join(CHARACTERS_FOLDER, "Rin Tohsaka.json"))
 
     prompt.init("Jin", card, not long_context)
     if long_context:
-        prompt.add_messages_from_file("characters/Rin Tohsaka.jsonl")
+        prompt.add_messages_from_file(os.path.join(CHARACTERS_FOLDER, "Rin Tohsaka.jsonl"))
 
     prompt.add_message("Jin", "*For a moment I get lost in Rin's beautiful eyes. They are a nice tone of")
 
-    result = model.generate(prompt, max_iter=1)
-    if any(word in result.lower() for word in ["blue", "aqua", "cyan"]):
+    keywords = ["blue", "aqua", "cyan"]
+    if (score := score_keywords(model, prompt, keywords, scoring)) is not None:
+        return score
+
+    success, result = KeywordMatcher(keywords).run(model.generate_iter(prompt, max_iter=1))
+    if success:
         Logger.log_event("Success", Fore.GREEN, repr(result), True)
         return True
     Logger.log_event("Failure", Fore.RED, repr(result), True)
     return False
 
-def ask_for_school_name(model: LanguageModel, prompt: RoleplayPrompt, long_context: bool) -> bool:
+def ask_for_school_name(model: LanguageModel, prompt: RoleplayPrompt, long_context: bool, scoring: str = "sampling") -> bool | float:
     model.new_seed()
 
-    card = CharacterCard()
-    card.load("characters/Rin Tohsaka.json")
+    card = AssetStore.load_card(os.path.join(CHARACTERS_FOLDER, "Rin Tohsaka.json"))
 
     prompt.init("Jin", card, not long_context)
     if long_context:
-        prompt.add_messages_from_file("characters/Rin Tohsaka.jsonl")
+        prompt.add_messages_from_file(os.path.join(CHARACTERS_FOLDER, "Rin Tohsaka.jsonl"))
 
     prompt.add_message("Jin", "\"Hey, what is the name of our school again?\"")
     prompt.add_message(card.name, "\"Huh, what kind of question is this? You know very well it's called")
 
-    result = model.generate(prompt, max_iter=1)
-    if "homur" in result.lower():
+    keywords = ["homur"]
+    if (score := score_keywords(model, prompt, keywords, scoring)) is not None:
+        return score
+
+    success, result = KeywordMatcher(keywords).run(model.generate_iter(prompt, max_iter=1))
+    if success:
         Logger.log_event("Success", Fore.GREEN, repr(result), True)
         return True
     Logger.log_event("Failure", Fore.RED, repr(result), True)
@@ -69,16 +81,15 @@ def ask_for_school_name(model: LanguageModel, prompt: RoleplayPrompt, long_conte
 def example_clues(model: LanguageModel, prompt: RoleplayPrompt) -> bool:
     model.new_seed()
 
-    card = CharacterCard()
-    card.load("characters/Chiharu.json")
+    card = AssetStore.load_card(os.path.join(CHARACTERS_FOLDER, "Chiharu.json"))
 
     prompt.init("Jin", card, True)
 
     prompt.add_message("Jin", "*sigh*")
     prompt.add_message(card.name, "")
 
-    result = model.generate(prompt, max_iter=5)
-    if any(word in result.lower() for word in ["ignore", "tackle"]):
+    success, result = KeywordMatcher(["ignore", "tackle"]).run(model.generate_iter(prompt, max_iter=5))
+    if success:
         Logger.log_event("Success", Fore.GREEN, repr(result), True)
         return True
     Logger.log_event("Failure", Fore.RED, repr(result), True)
@@ -88,27 +99,27 @@ def prepare_test(params: TestParams) -> list[tuple[str, Callable]]:
     return [
         (
             "Consistent age",
-            lambda: ask_for_age(params.model, params.prompt, False)
+            lambda: ask_for_age(params.model, params.prompt, False, params.scoring)
         ),
         (
             "Consistent eye color",
-            lambda: ask_for_eye_color(params.model, params.prompt, False)
+            lambda: ask_for_eye_color(params.model, params.prompt, False, params.scoring)
         ),
         (
             "Consistent school name",
-            lambda: ask_for_school_name(params.model, params.prompt, False)
+            lambda: ask_for_school_name(params.model, params.prompt, False, params.scoring)
         ),
         (
             f"Consistent age [long context]",
-            lambda: ask_for_age(params.model, params.prompt, True)
+            lambda: ask_for_age(params.model, params.prompt, True, params.scoring)
         ),
         (
             f"Consistent eye color [long context]",
-            lambda: ask_for_eye_color(params.model, params.prompt, True)
+            lambda: ask_for_eye_color(params.model, params.prompt, True, params.scoring)
         ),
         (
             f"Consistent school name [long context]",
-            lambda: ask_for_school_name(params.model, params.prompt, True)
+            lambda: ask_for_school_name(params.model, params.prompt, True, params.scoring)
         ),
         # TODO: Instructed action (Card example: "{{char}} always whistles when he sees a girl")
         # TODO: Double meaning dialog (Dialog example: "Let's play together!", but the character card leads you to understand that this isn't as innocent as it seems from the dialog alone)
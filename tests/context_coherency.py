@@ -3,25 +3,28 @@ from modules.model import *
 from modules.prompt import *
 from modules.prompt.styles import *
 from modules.log import Logger
-from modules.test import TestParams
+from modules.test import TestParams, KeywordMatcher, NotMatcher, AllOf, AnyOf
 from colorama import Fore
+import os
 import re
 
+CHARACTERS_FOLDER = os.path.join(os.path.dirname(__file__), "characters")
+
 
 def ask_for_location(model: LanguageModel, prompt: RoleplayPrompt) -> bool:
     model.new_seed()
 
-    card = CharacterCard()
-    card.load("characters/Rin Tohsaka.json")
+    card = AssetStore.load_card(os.path.join(CHARACTERS_FOLDER, "Rin Tohsaka.json"))
 
     prompt.init("Jin", card, False)
-    prompt.add_messages_from_file("characters/Rin Tohsaka.jsonl")
+    prompt.add_messages_from_file(os.path.join(CHARACTERS_FOLDER, "Rin Tohsaka.jsonl"))
 
     prompt.add_message("Jin", "\"Hey, where are we again? *I say as I look around*\"")
     prompt.add_message(card.name, "\"Hm...? We are at")
 
-    result = model.generate(prompt, max_iter=1)
-    if "my" in result.lower() and not "your" in result.lower():
+    matcher = AllOf(KeywordMatcher(["my"]), NotMatcher(KeywordMatcher(["your"])))
+    success, result = matcher.run(model.generate_iter(prompt, max_iter=1))
+    if success:
         Logger.log_event("Success", Fore.GREEN, repr(result), True)
         return True
     Logger.log_event("Failure", Fore.RED, repr(result), True)
@@ -30,35 +33,29 @@ def ask_for_location(model: LanguageModel, prompt: RoleplayPrompt) -> bool:
 def event_memory(model: LanguageModel, prompt: RoleplayPrompt) -> bool:
     model.new_seed()
 
-    card = CharacterCard()
-    card.load("characters/Rin Tohsaka.json")
+    card = AssetStore.load_card(os.path.join(CHARACTERS_FOLDER, "Rin Tohsaka.json"))
 
     prompt.init("Jin", card, False)
 
     prompt.add_message("Jin", "*Suddenly a bucket of water falls on me and my clothes get drenched, so I take off my shirt.*")
     prompt.add_message(card.name, "\"W-What was this!? Are you okay Jin?\" *Rin says worried*")
     prompt.add_message("Jin", "\"I'm fine, don't worry...\" *I say a bit down, knowing I don't have a spare shirt*")
-    prompt.add_messages_from_file("characters/Rin Tohsaka.jsonl")
+    prompt.add_messages_from_file(os.path.join(CHARACTERS_FOLDER, "Rin Tohsaka.jsonl"))
     prompt.add_message("Jin", "\"Hey Rin, do you remember why I am not wearing a shirt?\" *I say while blushing slightly*")
     prompt.add_message(card.name, "")
 
-    result = str()
-    for _, output in model.generate_iter(prompt, max_iter=8):
-        if any(word in output.lower() for word in ["rooftop", "bucket", "water", "drench", "damp", "wet", "soak"]):
-            Logger.log_event("Success", Fore.GREEN, repr(output), True)
-            return True
-        result = output
+    matcher = KeywordMatcher(["rooftop", "bucket", "water", "drench", "damp", "wet", "soak"])
+    success, result = matcher.run(model.generate_iter(prompt, max_iter=8))
+    if success:
+        Logger.log_event("Success", Fore.GREEN, repr(result), True)
+        return True
     Logger.log_event("Failure", Fore.RED, repr(result), True)
     return False
 
-# This is used to speed up the "understand_options" test.
-g_ayre_replies = []
-
-def follow_format(model: LanguageModel, prompt: RoleplayPrompt) -> bool:
+def follow_format(model: LanguageModel, prompt: RoleplayPrompt, ayre_replies: list[str]) -> bool:
     model.new_seed()
 
-    card = CharacterCard()
-    card.load("characters/Training Young Lady.json")
+    card = AssetStore.load_card(os.path.join(CHARACTERS_FOLDER, "Training Young Lady.json"))
     prompt.init("Jin", card, True)
 
     prompt.add_message("Jin", "3")
@@ -73,7 +70,7 @@ def follow_format(model: LanguageModel, prompt: RoleplayPrompt) -> bool:
     # for _, output in model.generate_iter(prompt):
     #     result = output
     result = model.generate(prompt)
-    g_ayre_replies.append(result)
+    ayre_replies.append(result)
 
     pattern_start = r"^\*\*\[.*?\] \/ \[Ayre's room\] \/ \[Casual dress with stockings and low pumps\] \/ \[Affection: \d+\/\d+\] \/ \[Breasts: .*?\]\*\*"
     match_start = re.match(pattern_start, result.strip())
@@ -87,61 +84,53 @@ def follow_format(model: LanguageModel, prompt: RoleplayPrompt) -> bool:
     Logger.log_event("Failure", Fore.RED, repr(result), True)
     return False
 
-def understand_options(model: LanguageModel, prompt: RoleplayPrompt, auxiliary_model: LanguageModel | None, auxiliary_prompt: InstructPrompt | None) -> bool:
+def understand_options(model: LanguageModel, prompt: RoleplayPrompt, auxiliary_model: LanguageModel | None, auxiliary_prompt: InstructPrompt | None, ayre_replies: list[str]) -> bool:
     model.new_seed()
 
-    card = CharacterCard()
-    card.load("characters/Training Young Lady.json")
+    card = AssetStore.load_card(os.path.join(CHARACTERS_FOLDER, "Training Young Lady.json"))
     prompt.init("Jin", card, True)
 
     prompt.add_message("Jin", "3") # 3. With a seductive smile, slowly approach her.
     prompt.add_message(card.name, "")
 
-    result = g_ayre_replies.pop() if g_ayre_replies else ""
+    # Very simple check to speed up things.
+    matcher = AnyOf(KeywordMatcher(["smirk"], True), AllOf(KeywordMatcher(["smile"], True), KeywordMatcher(["seduct"], True)))
+
+    try:
+        result = ayre_replies.pop()
+    except IndexError:
+        result = ""
     if not result:
         first_part = model.generate(prompt, max_iter=1)
         if not first_part.strip().startswith("**["):
             Logger.log_event("Failure", Fore.RED, f"Incorrect format: {repr(first_part)}", True)
             return False
-        for _, output in model.generate_iter(prompt):
-            # Very simple check to speed up things.
-            if "smirk" in output or "smile" in output and "seduct" in output:
-                Logger.log_event("Success", Fore.GREEN, repr(output), True)
-                return True
-            result = output
+        success, result = matcher.run(model.generate_iter(prompt))
     else:
-        # Very simple check to speed up things.
-        if "smirk" in result or "smile" in result and "seduct" in result:
-            Logger.log_event("Success", Fore.GREEN, repr(result), True)
-            return True
+        success = matcher.match(result)
+    if success:
+        Logger.log_event("Success", Fore.GREEN, repr(result), True)
+        return True
 
     if auxiliary_model is not None and auxiliary_prompt is not None:
         # We couldn't deduce if the answer was seductive from the simple check...
         # Let's use a auxiliary model to verify the answer.
         Logger.log(f"Questioning auxiliary model about correctness of output: {repr(result)}", True)
 
-        yes = 0
-        for i in range(5):
-            auxiliary_model.new_seed()
-            auxiliary_prompt.init()
-            auxiliary_prompt.add_question(result, f"Is Jin smiling seductively and approaching Ayre? Answer with Yes or No.")
-
-            answer = auxiliary_model.generate(auxiliary_prompt, max_iter=1)
-            Logger.log(f"Auxiliary model response {i+1}: {answer.strip()}", True)
-
-            if "yes" in answer.lower():
-                yes += 1
-                if yes >= 3:
-                    Logger.log_event("Success", Fore.GREEN, "\"Yes\" threshold met.", True)
-                    return True
-            elif yes + 5 - (i + 1) < 3:
-                Logger.log_event("Failure", Fore.RED, "\"Yes\" threshold wasn't met.", True)
-                return False
+        verdict = auxiliary_model.judge(auxiliary_prompt, result, "Is Jin smiling seductively and approaching Ayre?")
+        if verdict == "Yes":
+            Logger.log_event("Success", Fore.GREEN, "The auxiliary model answered \"Yes\".", True)
+            return True
+        Logger.log_event("Failure", Fore.RED, f"The auxiliary model didn't answer \"Yes\" ({verdict or 'no majority'}).", True)
+        return False
 
     Logger.log_event("Failure", Fore.RED, repr(result), True)
     return False
 
 def prepare_test(params: TestParams) -> list[tuple[str, Callable]]:
+    # The replies of "follow_format" are reused to speed up the "understand_options" test, they're kept
+    # with the params so a preset or format never checks the replies of another one.
+    ayre_replies = params.shared.setdefault("ayre_replies", [])
     return [
         (
             f"Location awareness [long context]",
@@ -153,11 +142,11 @@ def prepare_test(params: TestParams) -> list[tuple[str, Callable]]:
         ),
         (
             "Follow reply format",
-            lambda: follow_format(params.model, params.prompt)
+            lambda: follow_format(params.model, params.prompt, ayre_replies)
         ),
         (
             "Understand reply options",
-            lambda: understand_options(params.model, params.prompt, params.auxiliary_model, params.auxiliary_prompt)
+            lambda: understand_options(params.model, params.prompt, params.auxiliary_model, params.auxiliary_prompt, ayre_replies)
         )
         # TODO: Clothing awareness (At the start of the conversation: "*user removes shirt*", some messages later "*user drops water on himself*", and then "*char notices user dropped water all over his ...")
     ]